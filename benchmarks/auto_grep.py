@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# benchmarks/auto_grep.py - measures the matching done by --auto-grep
+#
+# This is free and unencumbered software released into the public domain.
+# 
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+# 
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# 
+# For more information, please refer to <http://unlicense.org/>
+
+
+"""Measures how long --auto-grep takes to match a large library.
+
+This makes up a sorted list of "-n" pathnames (shaped like those of a real music
+collection: artists, albums, and numbered tracks), and greps it for each of the
+given regular expressions, the way --auto-grep does.  The matching is timed
+once with grep() for each expression (which is what --auto-grep used to do),
+and then with grep_each() using 1 process and using each of the numbers of
+processes given with "-p".  Every result is checked against the first one.  No
+files are created; only the matching is measured.
+
+usage: auto_grep.py [-n <paths>] [-p <processes>[,<processes>...]] [<regex> ...]
+(The defaults are 1000000 paths, 2 and 4 processes and as many as there are
+CPUs, and the regular expressions "Song 1", "(?i)artist 12/", and "7\\.ogg$".)
+"""
+
+import sys, os, os.path, time, getopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from moosic.utilities import grep, grep_each
+
+
+def make_library(size):
+    """Returns a sorted list of made-up pathnames of music files."""
+    paths = ['/music/Artist %d/Album %d/%02d Song %d.ogg' %
+             (i // 1000, (i // 20) % 50, i % 20, i) for i in xrange(size)]
+    paths.sort()
+    return paths
+
+
+def main(argv):
+    size = 1000000
+    try:
+        import multiprocessing
+        process_counts = [2, 4, multiprocessing.cpu_count()]
+    except (ImportError, NotImplementedError):
+        process_counts = [2, 4]
+    try:
+        opts, regexes = getopt.getopt(argv[1:], 'n:p:')
+    except getopt.GetoptError, e:
+        sys.exit(str(e) + '\n' + __doc__)
+    for opt, val in opts:
+        if opt == '-n':
+            size = int(val)
+        elif opt == '-p':
+            process_counts = [int(i) for i in val.split(',')]
+    regexes = regexes or ['Song 1', '(?i)artist 12/', r'7\.ogg$']
+    counts = [1]
+    for n in process_counts:
+        if n not in counts:
+            counts.append(n)
+
+    paths = make_library(size)
+    start = time.time()
+    expected = [grep(regex, paths) for regex in regexes]
+    baseline = time.time() - start
+    print '%d paths, %d regexes, %d matches' % \
+          (size, len(regexes), sum([len(i) for i in expected]))
+    print '%-20s %10s %8s' % ('matcher', 'seconds', 'speedup')
+    print '%-20s %10.3f %8.2f' % ('grep()', baseline, 1.0)
+    for n in counts:
+        start = time.time()
+        result = grep_each(regexes, paths, n)
+        elapsed = time.time() - start
+        if result != expected:
+            sys.exit('grep_each() with %d processes gave a different result!'
+                     % n)
+        print '%-20s %10.3f %8.2f' % ('grep_each(), %d' % n, elapsed,
+                                      baseline / elapsed)
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
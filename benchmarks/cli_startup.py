@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# benchmarks/cli_startup.py - measures how long the moosic client takes to run
+#
+# This is free and unencumbered software released into the public domain.
+# 
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+# 
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# 
+# For more information, please refer to <http://unlicense.org/>
+
+
+"""Measures how long a run of the moosic client takes, for each command.
+
+Programs like status bars run "moosic current" over and over, so most of the
+time that such a command takes is spent starting Python and loading the client.
+This script starts a moosicd the way load_test.py does (with 100 items in its
+queue), and then runs scripts/moosic with each of the given commands "-n" times,
+printing the median and fastest wall-clock time of each command.  For
+comparison, the time taken by a Python interpreter that does nothing, and by
+"moosic -S" (which prints the documentation of every command), are printed
+too, along with the number of modules that the client loads before it runs a
+command.
+
+usage: cli_startup.py [-n <runs>] [<command> ...]
+(The default is 20 runs each of current, next, list, status, and help.)
+"""
+
+import sys, os, os.path, time, getopt, tempfile, subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from moosic.client.factory import LocalMoosicProxy
+from xmlrpclib import Binary
+from load_test import TOP, free_port, start_server, stop_server, percentile
+
+
+def time_runs(argv, runs, env):
+    """Returns the sorted wall-clock times of "runs" runs of a program."""
+    devnull = open(os.devnull, 'w')
+    times = []
+    for i in range(runs):
+        start = time.time()
+        subprocess.call(argv, stdout=devnull, stderr=devnull, env=env)
+        times.append(time.time() - start)
+    devnull.close()
+    times.sort()
+    return times
+
+
+def main(argv):
+    runs = 20
+    opts, commands = getopt.getopt(argv[1:], 'n:')
+    for opt, val in opts:
+        if opt == '-n':
+            runs = int(val)
+    commands = commands or ['current', 'next', 'list', 'status', 'help']
+
+    env = os.environ.copy()
+    env['PYTHONPATH'] = TOP
+    modules = subprocess.Popen([sys.executable, '-c', 'import sys; '
+                                'import moosic.client.cli.main; '
+                                'print len(sys.modules)'], env=env,
+                               stdout=subprocess.PIPE).communicate()[0]
+    print 'The client loads %d modules.' % int(modules)
+
+    confdir = tempfile.mkdtemp()
+    server = start_server(confdir, free_port(), ['-q'])
+    try:
+        proxy = LocalMoosicProxy(os.path.join(confdir, 'socket'))
+        proxy.set_loop_mode(True)
+        proxy.append([Binary('/startup/test/%d.ogg' % i) for i in range(100)])
+        moosic = [sys.executable, os.path.join(TOP, 'scripts', 'moosic'),
+                  '-c', confdir, '-N']
+        runs_of = [('(python)', [sys.executable, '-c', 'pass']),
+                   ('(-S)', moosic + ['-S'])]
+        runs_of.extend([(command, moosic + [command]) for command in commands])
+        print '%-10s %10s %10s' % ('command', 'median ms', 'min ms')
+        for name, command_argv in runs_of:
+            times = time_runs(command_argv, runs, env)
+            print '%-10s %10.1f %10.1f' % (name, percentile(times, 0.5) * 1000,
+                                           times[0] * 1000)
+            sys.stdout.flush()
+    finally:
+        stop_server(server, confdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
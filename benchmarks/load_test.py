@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# benchmarks/load_test.py - drives moosicd with many concurrent clients
+#
+# This is free and unencumbered software released into the public domain.
+# 
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+# 
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# 
+# For more information, please refer to <http://unlicense.org/>
+
+
+"""Measures how moosicd holds up when many clients use it at once.
+
+A fresh moosicd is started in a temporary configuration directory, listening
+both to its usual Unix socket and to a TCP port, with a player configuration
+that plays every item with a program that does nothing but wait.  Its queue is
+filled with synthetic items, and then a number of client processes hammer it
+for a while:
+  * Readers repeatedly call list() or current().
+  * Writers repeatedly call append() (with one item), cut() (of one item), or
+    move() (of one item), so that the queue keeps roughly the same size.
+Half of the clients of each kind connect through the Unix socket (with
+LocalMoosicProxy) and the other half through TCP (with InetMoosicProxy), unless
+-u or -i is given.  Every client is a separate process, so that the clients
+don't compete with each other for Python's global interpreter lock.
+
+At the end, the number of calls per second and the median, 95th percentile, and
+99th percentile latencies of each method on each transport are printed.
+
+usage: load_test.py [-r <readers>] [-w <writers>] [-d <seconds>] [-q <items>]
+                    [-u | -i] [-- <extra moosicd options>]
+(The defaults are 8 readers, 2 writers, 10 seconds, and 1000 items.  For
+example, "load_test.py -r 100 -- -e" measures the single-threaded event loop
+with 100 readers.)
+"""
+
+import sys, os, os.path, time, getopt, random, socket, signal, tempfile, shutil
+import subprocess, multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from moosic.client.factory import LocalMoosicProxy, InetMoosicProxy
+from xmlrpclib import Binary
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+
+def free_port():
+    """Returns a TCP port number that nothing is listening to right now."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_server(confdir, port, options, player='exec sleep 86400'):
+    """Starts moosicd with the given extra options, and returns its process
+    once it answers requests.
+
+    Every item is played by a shell script that ignores the item it's given
+    (which doesn't exist anyway), and runs the "player" command line instead.
+    By default, it just waits until it's killed.
+    """
+    script = os.path.join(confdir, 'null-player')
+    f = open(script, 'w')
+    f.write('#!/bin/sh\n%s\n' % player)
+    f.close()
+    os.chmod(script, 0755)
+    config = open(os.path.join(confdir, 'config'), 'w')
+    config.write('.*\n%s\n' % script)
+    config.close()
+    env = os.environ.copy()
+    env['PYTHONPATH'] = TOP
+    server = subprocess.Popen([sys.executable,
+                               os.path.join(TOP, 'scripts', 'moosicd'),
+                               '-c', confdir, '-f', '-T', str(port)] + options,
+                              env=env)
+    proxy = LocalMoosicProxy(os.path.join(confdir, 'socket'))
+    deadline = time.time() + 10
+    while True:
+        try:
+            proxy.no_op()
+            return server
+        except (socket.error, IOError):
+            if server.poll() is not None or time.time() > deadline:
+                sys.exit('moosicd could not be started.')
+            time.sleep(0.05)
+
+
+def stop_server(server, confdir):
+    """Tells moosicd to quit (or kills it if it won't), and then removes its
+    configuration directory.
+    """
+    try:
+        LocalMoosicProxy(os.path.join(confdir, 'socket')).die()
+    except (socket.error, IOError):
+        pass
+    if server.poll() is None:
+        time.sleep(0.5)
+    if server.poll() is None:
+        os.kill(server.pid, signal.SIGTERM)
+    server.wait()
+    shutil.rmtree(confdir)
+
+
+def make_proxy(transport, confdir, port):
+    if transport == 'unix':
+        return LocalMoosicProxy(os.path.join(confdir, 'socket'))
+    else:
+        return InetMoosicProxy('127.0.0.1', port)
+
+
+def client(kind, transport, confdir, port, start, stop, results):
+    """Makes calls until the time "stop", and then puts a mapping from each
+    method name to a list of latencies (and a count of errors) on the
+    "results" queue.
+    """
+    proxy = make_proxy(transport, confdir, port)
+    latencies = {}
+    errors = {}
+    rand = random.Random(os.getpid())
+    serial = 0
+    while time.time() < start:
+        time.sleep(0.001)
+    while time.time() < stop:
+        if kind == 'reader':
+            method = rand.choice(('list', 'current'))
+            args = ()
+        else:
+            method = rand.choice(('append', 'cut', 'move'))
+            length = proxy.queue_length()
+            i = rand.randrange(max(1, length))
+            if method == 'append':
+                serial = serial + 1
+                args = ([Binary('/load/test/%d/%d.ogg' %
+                                (os.getpid(), serial))],)
+            elif method == 'cut':
+                args = ([i, i + 1],)
+            else:
+                args = ([i, i + 1], rand.randrange(max(1, length)))
+        began = time.time()
+        try:
+            apply(getattr(proxy, method), args)
+        except Exception:
+            errors[method] = errors.get(method, 0) + 1
+            continue
+        latencies.setdefault(method, []).append(time.time() - began)
+    results.put((transport, latencies, errors))
+
+
+def start_clients(readers, writers, transports, confdir, port, start, stop):
+    """Starts the given numbers of reader and writer client processes, which
+    use each of the transports in turn.  Returns the list of processes and the
+    queue on which they will put their results.
+    """
+    results = multiprocessing.Queue()
+    clients = []
+    for kind, count in (('reader', readers), ('writer', writers)):
+        for i in range(count):
+            transport = transports[i % len(transports)]
+            p = multiprocessing.Process(target=client, args=(kind, transport,
+                                        confdir, port, start, stop, results))
+            p.start()
+            clients.append(p)
+    return clients, results
+
+
+def collect(clients, results):
+    """Waits for the clients to finish, and returns a mapping from each
+    (method, transport) pair to a list of latencies, and another mapping from
+    each such pair to the number of calls that failed.
+    """
+    latencies = {}
+    errors = {}
+    for p in clients:
+        transport, client_latencies, client_errors = results.get()
+        for method, values in client_latencies.items():
+            latencies.setdefault((method, transport), []).extend(values)
+        for method, count in client_errors.items():
+            errors[(method, transport)] = \
+                    errors.get((method, transport), 0) + count
+    for p in clients:
+        p.join()
+    return latencies, errors
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main(argv):
+    readers, writers, duration, items = 8, 2, 10.0, 1000
+    transports = ['unix', 'tcp']
+    try:
+        opts, extra_options = getopt.getopt(argv[1:], 'r:w:d:q:ui')
+    except getopt.GetoptError, e:
+        sys.exit(str(e) + '\n' + __doc__)
+    for opt, val in opts:
+        if opt == '-r':
+            readers = int(val)
+        elif opt == '-w':
+            writers = int(val)
+        elif opt == '-d':
+            duration = float(val)
+        elif opt == '-q':
+            items = int(val)
+        elif opt == '-u':
+            transports = ['unix']
+        elif opt == '-i':
+            transports = ['tcp']
+
+    confdir = tempfile.mkdtemp()
+    port = free_port()
+    server = start_server(confdir, port, ['-q'] + extra_options)
+    try:
+        proxy = LocalMoosicProxy(os.path.join(confdir, 'socket'))
+        proxy.append([Binary('/load/test/initial/%d.ogg' % i)
+                      for i in range(items)])
+        start = time.time() + 1.0
+        stop = start + duration
+        clients, results = start_clients(readers, writers, transports,
+                                         confdir, port, start, stop)
+        latencies, errors = collect(clients, results)
+        final_length = proxy.queue_length()
+    finally:
+        stop_server(server, confdir)
+
+    print '%d readers, %d writers, %g seconds, %d items in the queue at first ' \
+          'and %d at the end.' % (readers, writers, duration, items,
+                                  final_length)
+    print '%-8s %-5s %8s %8s %10s %9s %9s %9s' % ('method', 'via', 'calls',
+          'errors', 'calls/s', 'p50 ms', 'p95 ms', 'p99 ms')
+    keys = latencies.keys()
+    keys.sort()
+    total = 0
+    for key in keys:
+        values = latencies[key]
+        values.sort()
+        total = total + len(values)
+        print '%-8s %-5s %8d %8d %10.1f %9.3f %9.3f %9.3f' % (key[0], key[1],
+              len(values), errors.get(key, 0), len(values) / duration,
+              percentile(values, 0.50) * 1000, percentile(values, 0.95) * 1000,
+              percentile(values, 0.99) * 1000)
+    print 'Total: %.1f calls/s' % (total / duration)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
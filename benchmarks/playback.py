@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# benchmarks/playback.py - measures how fast moosicd gets through its queue
+#
+# This is free and unencumbered software released into the public domain.
+# 
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+# 
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# 
+# For more information, please refer to <http://unlicense.org/>
+
+
+"""Measures the queue consumer and the playback controls without real audio.
+
+This runs two tests, each against a fresh moosicd that is started the way
+load_test.py starts it, with a JSON server log (-J):
+  * The throughput test plays "-n" items with a player that exits right away.
+    The times at which the server logged "Started playing" and "Finished
+    playing" for each item are used to work out how many songs per second the
+    queue consumer plays, and how long the gap is between the end of one song
+    and the start of the next.  The server's own "song gap" timer (which
+    measures from the end of one player to the start of the next) is reported
+    too.
+  * The control test plays items with a player that lasts "-D" seconds, with
+    loop mode on so that the queue never runs out.  While "-r" reader and "-w"
+    writer clients (see load_test.py) keep the server busy, skip(), pause(),
+    unpause(), next(), and previous() are called in turn, with a pause of "-i"
+    seconds after each, for "-d" seconds.  The latency of every call is timed.
+
+The results are written as a JSON object, to standard output or to the file
+given with -o.  Latencies and gaps are in seconds.
+
+usage: playback.py [-n <songs>] [-D <seconds>] [-d <seconds>] [-i <seconds>]
+                   [-r <readers>] [-w <writers>] [-o <file>]
+                   [-- <extra moosicd options>]
+(The defaults are 500 songs, a 1 second player, a 10 second control test, a
+0.1 second interval, 4 readers, and no writers.)
+"""
+
+import sys, os, os.path, time, getopt, tempfile
+import json
+from xmlrpclib import Binary
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from moosic.client.factory import LocalMoosicProxy
+from load_test import free_port, start_server, stop_server, start_clients, \
+                      collect, percentile
+
+# The methods that are timed by the control test, in the order in which they
+# are called.
+CONTROLS = ('skip', 'pause', 'unpause', 'next', 'previous')
+
+
+def summarize(values):
+    """Returns the count, mean, and percentiles of a list of numbers."""
+    values = values[:]
+    values.sort()
+    if not values:
+        return {'count': 0}
+    return {'count': len(values),
+            'mean': sum(values) / len(values),
+            'p50': percentile(values, 0.50),
+            'p95': percentile(values, 0.95),
+            'p99': percentile(values, 0.99),
+            'max': values[-1]}
+
+
+def read_log(filename, offset):
+    """Returns the times at which songs started and finished playing, as
+    logged in the given (JSON) server log after the given byte offset.
+    """
+    started = []
+    finished = []
+    f = open(filename)
+    f.seek(offset)
+    for line in f:
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+        if message['message'].startswith('Started playing '):
+            started.append(message['time'])
+        elif message['message'].startswith('Finished playing '):
+            finished.append(message['time'])
+    f.close()
+    return started, finished
+
+
+def throughput_test(songs, extra_options):
+    confdir = tempfile.mkdtemp()
+    server = start_server(confdir, free_port(), ['-J'] + extra_options,
+                          player='exit 0')
+    try:
+        proxy = LocalMoosicProxy(os.path.join(confdir, 'socket'))
+        proxy.halt_queue()
+        proxy.append([Binary('/playback/test/%d.ogg' % i)
+                      for i in range(songs)])
+        logfile = os.path.join(confdir, 'server_log')
+        offset = os.path.getsize(logfile)
+        start = time.time()
+        proxy.run_queue()
+        while proxy.queue_length() or proxy.current().data:
+            time.sleep(0.01)
+        elapsed = time.time() - start
+        song_gap = proxy.stats()['timers'].get('song gap', {'count': 0})
+        started, finished = read_log(logfile, offset)
+    finally:
+        stop_server(server, confdir)
+
+    # Each song's "Finished playing" is followed by the next one's "Started
+    # playing".
+    gaps = [started[i + 1] - finished[i] for i in range(len(finished))
+            if i + 1 < len(started)]
+    if started and finished:
+        playing_time = finished[-1] - started[0]
+    else:
+        playing_time = elapsed
+    del song_gap['buckets']
+    return {'songs': songs,
+            'songs played': len(finished),
+            'seconds': playing_time,
+            'songs per second': len(finished) / max(playing_time, 1e-9),
+            'seconds until empty': elapsed,
+            'logged gap': summarize(gaps),
+            'song gap timer': song_gap}
+
+
+def control_test(player_seconds, duration, interval, readers, writers,
+                 extra_options):
+    confdir = tempfile.mkdtemp()
+    port = free_port()
+    server = start_server(confdir, port, ['-q'] + extra_options,
+                          player='exec sleep %g' % player_seconds)
+    try:
+        proxy = LocalMoosicProxy(os.path.join(confdir, 'socket'))
+        proxy.set_loop_mode(True)
+        proxy.append([Binary('/playback/test/%d.ogg' % i) for i in range(100)])
+        start = time.time() + 1.0
+        stop = start + duration
+        clients, results = start_clients(readers, writers, ['unix', 'tcp'],
+                                         confdir, port, start, stop)
+        latencies = {}
+        errors = {}
+        while time.time() < start:
+            time.sleep(0.001)
+        while time.time() < stop:
+            for method in CONTROLS:
+                began = time.time()
+                try:
+                    getattr(proxy, method)()
+                except Exception:
+                    errors[method] = errors.get(method, 0) + 1
+                else:
+                    latencies.setdefault(method, []).append(time.time() - began)
+                time.sleep(interval)
+        load, load_errors = collect(clients, results)
+    finally:
+        stop_server(server, confdir)
+
+    controls = {}
+    for method in CONTROLS:
+        controls[method] = summarize(latencies.get(method, []))
+        controls[method]['errors'] = errors.get(method, 0)
+    background = {}
+    for (method, transport), values in load.items():
+        background['%s/%s' % (method, transport)] = {
+            'calls per second': len(values) / duration,
+            'errors': load_errors.get((method, transport), 0)}
+    return {'player seconds': player_seconds,
+            'seconds': duration,
+            'readers': readers,
+            'writers': writers,
+            'controls': controls,
+            'load': background}
+
+
+def main(argv):
+    songs, player_seconds, duration, interval = 500, 1.0, 10.0, 0.1
+    readers, writers = 4, 0
+    output = None
+    try:
+        opts, extra_options = getopt.getopt(argv[1:], 'n:D:d:i:r:w:o:')
+    except getopt.GetoptError, e:
+        sys.exit(str(e) + '\n' + __doc__)
+    for opt, val in opts:
+        if opt == '-n':
+            songs = int(val)
+        elif opt == '-D':
+            player_seconds = float(val)
+        elif opt == '-d':
+            duration = float(val)
+        elif opt == '-i':
+            interval = float(val)
+        elif opt == '-r':
+            readers = int(val)
+        elif opt == '-w':
+            writers = int(val)
+        elif opt == '-o':
+            output = val
+
+    results = {'moosicd options': extra_options,
+               'throughput': throughput_test(songs, extra_options),
+               'control': control_test(player_seconds, duration, interval,
+                                       readers, writers, extra_options)}
+    if output:
+        out = open(output, 'w')
+    else:
+        out = sys.stdout
+    json.dump(results, out, indent=1, sort_keys=True)
+    out.write('\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
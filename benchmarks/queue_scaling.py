@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# benchmarks/queue_scaling.py - measures how the server methods scale with the queue
+#
+# This is free and unencumbered software released into the public domain.
+# 
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+# 
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# 
+# For more information, please refer to <http://unlicense.org/>
+
+
+"""Measures how long each server method takes as the song queue grows.
+
+The methods in moosic.server.methods are called directly (without going through
+XML-RPC) on a song queue that is filled with each of the given numbers of
+synthetic pathnames.  Before every call, the queue (and the history list) are
+put back the way they were, so every call sees the same queue; only the call
+itself is timed.  For each method and queue size, the median time per call is
+printed, along with how much the process's peak memory use grew while the
+method was being timed.  (A method that allocates less memory than some earlier
+method did shows no growth at all, so this is only a rough guide.)
+
+With -w, the results are written to a baseline file.  With -c, the results are
+compared to those in a baseline file, and every method that has become more than
+"ratio" times slower is flagged as a regression, in which case the exit status
+is 1.  Baselines are only meaningful on the machine that produced them, so
+none are shipped with Moosic.
+
+usage: queue_scaling.py [-m <method>[,<method>...]] [-t <seconds>]
+                        [-w <baseline file>] [-c <baseline file>] [-r <ratio>]
+                        [<queue size> ...]
+(The default sizes are 1000, 10000, 100000, and 1000000.  Each method is called
+repeatedly for about 0.2 seconds, or at least 3 times, unless -t says otherwise.
+The default ratio is 1.5.)  A full run takes a few minutes.
+"""
+
+import sys, os, os.path, time, getopt, gc, resource
+import json
+from xmlrpclib import Binary
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from moosic.server.support import data
+from moosic.server import methods
+
+# The number of items that are added or moved by the methods that take a list
+# of items or indices.
+BATCH = 100
+
+# Methods that aren't benchmarked, because they don't work outside of a running
+# server (the library_* methods need a music library that is being watched),
+# or because they change the state of the server in ways that would get in the
+# way of the other methods.
+SKIPPED = ('die', 'reconfigure', 'profile_start', 'profile_stop',
+           'library_list', 'library_expand', 'library_match')
+
+
+def make_queue(size):
+    """Returns a list of "size" pathnames that look like those of a large music
+    collection.
+    """
+    return ['/home/music/Artist %d/Album %d/%02d - Song number %d.ogg' %
+            (i / 200, i / 10, i % 10 + 1, i) for i in xrange(size)]
+
+
+def arguments(name, size):
+    """Returns the arguments with which the named method should be called,
+    when the queue holds "size" items.
+    """
+    items = [Binary('/home/music/New/%d.ogg' % i) for i in range(BATCH)]
+    spread = range(0, size, max(1, size / BATCH))[:BATCH]
+    quarter, half = size / 4, size / 2
+    return {
+        'append': (items,),
+        'prepend': (items,),
+        'insert': (items, half),
+        'replace': (items,),
+        'crop': ([quarter, size - quarter],),
+        'cut': ([quarter, size - quarter],),
+        'crop_list': (spread,),
+        'cut_list': (spread,),
+        'filter': (Binary('Artist 1'),),
+        'remove': (Binary('Artist 1'),),
+        'sub': (Binary('Song'), Binary('Tune')),
+        'sub_all': (Binary('o'), Binary('0')),
+        'move': ([quarter, quarter + BATCH], half),
+        'move_list': (spread, half),
+        'swap': ([0, BATCH], [half, half + BATCH]),
+        'set_history_limit': (data.max_hist_size,),
+        'set_loop_mode': (False,),
+    }.get(name, ())
+
+
+def benchmark_methods(only=None):
+    """Returns a sorted list of (name, function) pairs for the methods that are
+    benchmarked.  Each function is listed only once, under its shortest name.
+    """
+    registry = methods.moosicd_methods
+    by_function = {}
+    for name, function in registry._methods.items():
+        if name.startswith('system.') or name.startswith('__') or \
+           name in SKIPPED:
+            continue
+        if only is not None and name not in only:
+            continue
+        if by_function.has_key(function) and \
+           len(by_function[function]) <= len(name):
+            continue
+        by_function[function] = name
+    result = [(name, function) for function, name in by_function.items()]
+    result.sort()
+    return result
+
+
+def reset(queue, history):
+    data.song_queue = queue[:]
+    data.history = history[:]
+    data.current_song = '/home/music/Now Playing.ogg'
+    data.song_start_event = time.time()
+    data.qrunning = True
+    data.loop_mode = False
+    data.quitFlag = False
+
+
+def time_method(function, args, queue, history, min_time):
+    """Returns the median time taken by a call of the function, in seconds.
+
+    Calls are made until "min_time" seconds have passed (counting the time
+    taken to reset the queue before each call), or at least three times.
+    """
+    times = []
+    deadline = time.time() + min_time
+    while time.time() < deadline or len(times) < 3:
+        reset(queue, history)
+        gc.disable()
+        try:
+            start = time.time()
+            apply(function, args)
+            elapsed = time.time() - start
+        finally:
+            gc.enable()
+        times.append(elapsed)
+    times.sort()
+    return times[len(times) / 2]
+
+
+def peak_rss():
+    """Returns the peak memory use of this process, in kilobytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def main(argv):
+    only = None
+    min_time = 0.2
+    write_file = compare_file = None
+    ratio = 1.5
+    opts, args = getopt.getopt(argv[1:], 'm:t:w:c:r:')
+    for opt, val in opts:
+        if opt == '-m':
+            only = val.split(',')
+        elif opt == '-t':
+            min_time = float(val)
+        elif opt == '-w':
+            write_file = val
+        elif opt == '-c':
+            compare_file = val
+        elif opt == '-r':
+            ratio = float(val)
+    sizes = [int(size) for size in args] or [1000, 10000, 100000, 1000000]
+
+    baseline = {}
+    if compare_file:
+        baseline = json.load(open(compare_file))
+    results = {}
+    regressions = 0
+    # Keep the notifications that the methods send from filling up the pipes
+    # that nobody is reading.
+    data.queue_wakeup.notify = data.queue_changed.notify = lambda: None
+
+    print '%-18s %9s %12s %10s %12s' % ('method', 'size', 'per call',
+                                          'peak RSS +', 'vs baseline')
+    for size in sizes:
+        queue = make_queue(size)
+        history = [(song, 0.0, 0.0) for song in queue[:data.max_hist_size]]
+        for name, function in benchmark_methods(only):
+            args = arguments(name, size)
+            rss = peak_rss()
+            seconds = time_method(function, args, queue, history, min_time)
+            key = '%s/%d' % (name, size)
+            results[key] = seconds
+            comparison = ''
+            if baseline.has_key(key) and baseline[key] > 0:
+                change = seconds / baseline[key]
+                comparison = '%.2fx' % change
+                if change > ratio:
+                    comparison = comparison + ' REGRESSION'
+                    regressions = regressions + 1
+            print '%-18s %9d %10.4fms %8d kB %12s' % (name, size,
+                    seconds * 1000, peak_rss() - rss, comparison)
+            sys.stdout.flush()
+        queue = history = None
+        data.song_queue = data.history = []
+
+    if write_file:
+        json.dump(results, open(write_file, 'w'), indent=1, sort_keys=True)
+    if regressions:
+        print '%d regression(s) found.' % regressions
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
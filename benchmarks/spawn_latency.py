@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# benchmarks/spawn_latency.py - measures how long moosicd takes to start a player
+#
+# This is free and unencumbered software released into the public domain.
+# 
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+# 
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# 
+# For more information, please refer to <http://unlicense.org/>
+
+
+"""Measures how long it takes moosicd to start a song player.
+
+The cost of fork() grows with the size of the process that calls it, while the
+cost of posix_spawn() (which the GNU C library implements with vfork()
+semantics) doesn't.  This script inflates its own memory usage to each of the
+given sizes, and then times how long PlayerLauncher.launch() takes to return
+when it uses each method, using /bin/true as the player program.
+
+usage: spawn_latency.py [-n <launches>] [<megabytes> ...]
+(The default sizes are 10 and 1024 megabytes.)
+"""
+
+import sys, os, os.path, time, getopt, tempfile, shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from moosic.server.support import data
+from moosic.server.player import PlayerLauncher, collector
+from moosic.server import spawn
+
+
+def percentile(values, fraction):
+    values = values[:]
+    values.sort()
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(launcher, count):
+    """Returns a list of launch latencies, in seconds."""
+    latencies = []
+    for i in range(count):
+        start = time.time()
+        pid = launcher.launch(['/bin/true'], 'benchmark')
+        latencies.append(time.time() - start)
+        os.waitpid(pid, 0)
+    return latencies
+
+
+def main(argv):
+    count = 200
+    opts, args = getopt.getopt(argv[1:], 'n:')
+    for opt, val in opts:
+        if opt == '-n':
+            count = int(val)
+    sizes = [int(size) for size in args] or [10, 1024]
+
+    data.confdir = tempfile.mkdtemp()
+    try:
+        spawner = PlayerLauncher()
+        forker = PlayerLauncher()
+        forker.setup()
+        forker.posix_spawn = None
+        ballast = []
+        allocated = 0
+        print '%8s  %-12s %10s %10s' % ('RSS (MB)', 'method', 'median', '95th %')
+        for size in sizes:
+            # Touch every page, so that the memory is really in use.
+            while allocated < size:
+                ballast.append('x' * (1024 * 1024))
+                allocated = allocated + 1
+            methods = [('fork', forker)]
+            if spawn.available:
+                methods.append(('posix_spawn', spawner))
+            for name, launcher in methods:
+                latencies = measure(launcher, count)
+                print '%8d  %-12s %8.3fms %8.3fms' % (size, name,
+                        percentile(latencies, 0.5) * 1000,
+                        percentile(latencies, 0.95) * 1000)
+    finally:
+        collector.shutdown()
+        shutil.rmtree(data.confdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -28,25 +28,13 @@
 
 __all__ = ("dispatcher", "command_categories", "get_command_docs", "check_args")
 
-import base64, fileinput, sys, os, os.path, time, re
+import base64, sys, os, os.path, time, re, select
 import xmlrpclib, random, errno, string
 
 from moosic.utilities import *
 from moosic.client.factory import startServer
 from moosic import VERSION
 
-# Portability note: the Unix "find" program is required to be present on the
-# system. It is almost unthinkable that you could have a Unix system that
-# didn't have the "find" command, but you never know.
-try:
-    import subprocess
-    def call_find(dir):
-        return subprocess.Popen(['find',dir,'-follow','-type','f','-print'], \
-                stdout=subprocess.PIPE).stdout.readlines()
-except ImportError:
-    def call_find(dir):
-        return os.popen('find "%s" -follow -type f -print' % sh_escape(dir)).readlines()
-
 # Define the True and False constants if they don't already exist.
 try: True
 except NameError: True = 1
@@ -186,24 +174,143 @@ def unmangle(s):
 
 def read_playlists(playlists, opts):
     '''Inputs a list of playlist file-names and outputs a list of the
-    file names contained in the playlists.'''
+    file names contained in the playlists.  A playlist named "-" is read from
+    standard input.'''
     arglist = []
-    for line in fileinput.input(playlists):
-        # skip empty lines
-        if re.search(r'^\s*$', line):
+    for playlist in playlists:
+        if playlist == '-':
+            arglist.extend(playlist_items(sys.stdin, '', opts))
             continue
-        # skip lines that begin with a '#' character
-        if re.search(r'^#', line):
+        f = open(playlist)
+        try:
+            arglist.extend(playlist_items(f, os.path.dirname(playlist), opts))
+        finally:
+            f.close()
+    return arglist
+
+
+def read_lines(f):
+    '''Generates the lines of a file as soon as they are available.
+
+    Iterating over a file waits until its read-ahead buffer is full, which
+    holds up lines that arrive slowly through a pipe, and calling readline()
+    for each line is slow when there are lots of them.  Instead, this reads
+    whatever is available, in pieces of up to 64 kilobytes.  Whenever there is
+    nothing more to read for the moment, None is generated, so that the caller
+    can deal with what it has while it waits.'''
+    fd = f.fileno()
+    pending = ''
+    while True:
+        try:
+            chunk = os.read(fd, 65536)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if not chunk:
+            break
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+        if not select.select([fd], [], [], 0)[0]:
+            yield None
+    if pending:
+        yield pending
+
+
+def playlist_items(lines, dirname, opts):
+    '''Generates the file names contained in the lines of a playlist, given
+    the name of the directory that holds the playlist.  None is passed through
+    (see read_lines()).'''
+    for line in lines:
+        if line is None:
+            yield line
+            continue
+        # skip empty lines, and lines that begin with a '#' character
+        if not line.strip() or line.startswith('#'):
             continue
         # chomp off trailing newlines
         if line.endswith('\n'):
             line = line[:-1]
         # tack the dirname onto the front of relative paths
         if not os.path.isabs(line) and opts['file-munge']:
-            arglist.append(os.path.join(os.path.dirname(fileinput.filename()), line))
-        else:
-            arglist.append(line)
-    return arglist
+            line = os.path.join(dirname, line)
+        yield line
+
+
+def filelist_items(lines):
+    '''Generates the items of a filelist that is given one item per line.
+    None is passed through (see read_lines()).'''
+    for line in lines:
+        if line is None:
+            yield line
+            continue
+        if line.endswith('\n'):
+            line = line[:-1]
+        if line:
+            yield line
+
+
+# The library index that is used by find_files(), once it has been loaded.
+# (moosic.client.library is only imported when it's needed, since it pulls in
+# modules that most commands don't use.)
+library = None
+
+def find_files(dir, opts, sort=False):
+    '''Returns the pathnames of all the files within a directory and its
+    subdirectories, in sorted order if "sort" is true.
+
+    The library index that is kept in the config directory is used to avoid
+    listing directories that haven't changed since they were last listed.
+    Call save_library() afterwards to keep what was learned.'''
+    global library
+    if library is None:
+        from moosic.client.library import LibraryIndex
+        library = LibraryIndex(os.path.join(opts['config-dir'], 'library_index'))
+        library.threads = opts['jobs']
+    return library.files(dir, sort)
+
+
+# The trigram index that is used by find_fuzzy(), once it has been loaded.
+trigrams = None
+
+# Removes everything but letters, digits, and slashes from a string.
+del_non_wordchars = make_string_filter(string.letters+string.digits+'/')
+
+def simplify(s):
+    '''Returns the form of a string that is compared by --auto-find.'''
+    return del_non_wordchars(s).lower()
+
+
+def find_fuzzy(dir, patterns, opts):
+    '''Returns the pathnames of all the files within a directory and its
+    subdirectories whose simplified names contain a simplified pattern.
+
+    A file is included once for each pattern that it matches.  The trigram
+    index that is kept in the config directory is used to avoid looking at
+    every name.  Call save_library() afterwards to keep it.'''
+    global trigrams
+    files = find_files(dir, opts)
+    if trigrams is None:
+        from moosic.client.library import TrigramIndex
+        trigrams = TrigramIndex(os.path.join(opts['config-dir'],
+                                             'library_trigrams'), simplify)
+    trigrams.update(files)
+    output = []
+    for pattern in patterns:
+        if pattern:
+            output.extend(trigrams.search(pattern))
+    return output
+
+
+def save_library():
+    '''Writes out the library index and the trigram index, if they were
+    used.'''
+    if library is not None:
+        library.save()
+    if trigrams is not None:
+        trigrams.save()
 
 
 def process_filelist(moosic, arglist, opts):
@@ -212,38 +319,18 @@ def process_filelist(moosic, arglist, opts):
         if opts['ignore-case']:
             arglist = [i + '(?i)' for i in arglist]
         # Get a list of filenames which are eligible for auto-finding.
-        files = call_find(opts['music-dir'])
-        files.sort()
-        # Strip off the trailing EOL character.
-        files = [item[:-1] for item in files]
+        files = find_files(opts['music-dir'], opts, True)
         # Grep the list of filenames for each regex argument, and include each
         # grep result in the output list.
         output = []
-        [output.extend(grep(a, files)) for a in arglist]
+        [output.extend(matches) for matches in grep_each(arglist, files)]
         arglist = output
     if opts['auto-find']: # This feature was inspired by David McCabe.
-        del_non_wordchars = make_string_filter(string.letters+string.digits+'/')
-        def simplify(s):
-            return del_non_wordchars(s).lower()
-        # Simplify the strings to be sought after.
-        arglist = [simplify(a) for a in arglist]
-        # Get a list of filenames which are eligible for auto-finding.
-        files = call_find(opts['music-dir'])
-        # Strip off the trailing EOL character.
-        files = [item[:-1] for item in files]
-        # Simplify the filenames to be searched through, and map each simplified
-        # name to the original name.
-        names = {}
-        [names.setdefault(simplify(f), []).append(f) for f in files]
-        # If an argument is a substring of one of the simplified filenames,
-        # include the full filename in the output list.
-        output = []
-        # Using the "in" operator to find substrings doesn't work in Python 2.2 :(
-        #[output.extend(names[n]) for a in arglist for n in names if (a and a in n)]
-        [output.extend(names[n])
-            for a in arglist
-                for n in names
-                    if (a and n.find(a) != -1)]
+        # If an argument is a substring of one of the simplified filenames
+        # which are eligible for auto-finding, include the full filename in the
+        # output list.
+        output = find_fuzzy(opts['music-dir'], [simplify(a) for a in arglist],
+                            opts)
         output.sort()
         arglist = output
     # When dealing with local files, all filenames should be specified by
@@ -258,35 +345,120 @@ def process_filelist(moosic, arglist, opts):
     # If an item in the filelist is a directory, then recurse through the
     # directory, replacing the item with its children.
     if opts['dir-recurse']:
-        pos = 0
-        while pos < len(arglist):
-            if os.path.isdir(arglist[pos]):
-                contents = call_find(arglist.pop(pos))
-                # Strip off the trailing EOL character.
-                contents = [item[:-1] for item in contents]
+        # The contents of each directory are sorted, unless they're going to be
+        # shuffled or sorted along with everything else anyway.
+        sort = not (opts['shuffle-dir'] or opts['shuffle-global'] or
+                    opts['sort'])
+        if opts['jobs'] > 1:
+            from moosic.client.library import map_in_threads
+            is_dir = map_in_threads(os.path.isdir, arglist, opts['jobs'])
+        else:
+            is_dir = map(os.path.isdir, arglist)
+        output = []
+        for i in range(len(arglist)):
+            if is_dir[i]:
+                contents = find_files(arglist[i], opts, sort)
                 if opts['shuffle-dir']:
                     random.shuffle(contents)
-                else:
-                    contents.sort()
-                    contents.reverse()
-                for item in contents:
-                    arglist.insert(pos, item)
-            pos = pos + 1
+                output.extend(contents)
+            else:
+                output.append(arglist[i])
+        arglist = output
+    save_library()
     if opts['shuffle-global']:
         random.shuffle(arglist)
     if opts['sort']:
         arglist.sort()
     if opts['no-unplayables']:
-        playable_patterns = [entry[0].data for entry in moosic.getconfig()]
-        newlist = []
-        for i in arglist:
-            for pat in playable_patterns:
-                if re.search(pat, i):
-                    newlist.append(i)
-                    break
-        arglist = newlist
+        arglist = filter_playable(arglist, moosic.getconfig())
     return arglist
 
+
+def filter_playable(arglist, config):
+    '''Returns the items of a filelist that the server knows how to play,
+    given the server's configuration (as returned by getconfig()).'''
+    playable = [re.compile(entry[0].data).search for entry in config]
+    newlist = []
+    for i in arglist:
+        for search in playable:
+            if search(i):
+                newlist.append(i)
+                break
+    return newlist
+
+
+# The number of items that stream_append() sends to the server at a time.
+STREAM_BATCH = 1000
+
+# The number of batches that stream_append() lets pile up while it waits for
+# the server to accept the batches before them.
+STREAM_DEPTH = 2
+
+def stream_append(moosic, items, opts):
+    '''Adds the items of a filelist to the end of the song queue while they
+    are still being produced by an iterator (such as one that reads standard
+    input).
+
+    The items are processed and sent to the server in batches of
+    STREAM_BATCH, by a separate thread, so that the next batch is read while
+    the last one is being sent.  At most STREAM_DEPTH batches are kept waiting,
+    so memory use doesn't grow with the length of the filelist.  Since the
+    whole filelist is never in hand at once, it can't be shuffled or sorted:
+    the items are added in the order in which they're produced.  When the
+    iterator produces None, the items that it produced before are sent right
+    away, instead of waiting for a whole batch.'''
+    import Queue, threading
+    # Talk to the server before consuming any input, so that if the server has
+    # to be started, the command can be run again without losing anything.
+    config = moosic.getconfig()
+    batch_opts = opts.copy()
+    batch_opts.update({'shuffle-global':False, 'shuffle-args':False,
+                       'sort':False, 'no-unplayables':False})
+    batches = Queue.Queue(STREAM_DEPTH)
+    # Any exception raised while sending a batch.
+    error = []
+    def send():
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            if not error:
+                try:
+                    moosic.append(batch)
+                except:
+                    error.append(sys.exc_info())
+    sender = threading.Thread(target=send)
+    sender.setDaemon(True)
+    sender.start()
+    def flush(batch):
+        batch = process_filelist(moosic, batch, batch_opts)
+        if opts['no-unplayables']:
+            batch = filter_playable(batch, config)
+        for start in range(0, len(batch), STREAM_BATCH):
+            batches.put([xmlrpclib.Binary(i)
+                         for i in batch[start:start+STREAM_BATCH]])
+    try:
+        batch = []
+        for item in items:
+            if item is None:
+                if batch:
+                    flush(batch)
+                    batch = []
+                continue
+            batch.append(item)
+            if len(batch) >= STREAM_BATCH:
+                flush(batch)
+                batch = []
+                if error:
+                    break
+        if batch and not error:
+            flush(batch)
+    finally:
+        batches.put(None)
+        sender.join()
+    if error:
+        raise error[0][0], error[0][1], error[0][2]
+
 #---------------------------- Dispatcher functions ----------------------------#
 
 def start_server(moosic, arglist, opts):
@@ -310,6 +482,9 @@ dispatcher[unmangle(f.__name__)] = f
 
 def append(moosic, arglist, opts):
     'append <filelist> - Add files to the end of the song queue.'
+    if arglist == ['-']:
+        stream_append(moosic, filelist_items(read_lines(sys.stdin)), opts)
+        return
     arglist = process_filelist(moosic, arglist, opts)
     arglist = [xmlrpclib.Binary(i) for i in arglist]
     moosic.append(arglist)
@@ -334,6 +509,10 @@ dispatcher[unmangle(f.__name__)] = f
 
 def pl_append(moosic, arglist, opts):
     "pl-append <playlists> - Add the playlists' contents to the end of the queue."
+    if arglist == ['-']:
+        stream_append(moosic, playlist_items(read_lines(sys.stdin), '', opts),
+                      opts)
+        return
     arglist = read_playlists(arglist, opts)
     append(moosic, arglist, opts)
 
@@ -501,6 +680,28 @@ dispatcher[unmangle(f.__name__)] = f
 
 #----------------------------#
 
+def lib_add(moosic, arglist, opts):
+    '''lib-add <directories> - Add every file within the given directories of
+    the server's music library to the end of the song queue.'''
+    new_songs = []
+    for dir in arglist:
+        contents = [i.data for i in moosic.library_expand(xmlrpclib.Binary(dir))]
+        if opts['shuffle-dir']:
+            random.shuffle(contents)
+        new_songs.extend(contents)
+    if opts['shuffle-args'] or opts['shuffle-global']:
+        random.shuffle(new_songs)
+    if opts['sort']:
+        new_songs.sort()
+    moosic.append([xmlrpclib.Binary(i) for i in new_songs])
+
+f = lib_add
+f.category = 'add'
+f.num_args = 'many'
+dispatcher[unmangle(f.__name__)] = f
+
+#----------------------------#
+
 def cut(moosic, arglist, opts):
     'cut <range> - Remove all queued items that fall within the given range.'
     start, end = parse_range(arglist[0], 0, None)
@@ -1033,6 +1234,26 @@ dispatcher[unmangle(f.__name__)] = f
 
 #----------------------------#
 
+def browse(moosic, arglist, opts):
+    '''browse [directory] - List a directory in the server's music library (or
+    the top of the library, if no directory is given).'''
+    if arglist:
+        dir = arglist[0]
+    else:
+        dir = ''
+    subdirs, files = moosic.library_list(xmlrpclib.Binary(dir))
+    for name in subdirs:
+        print name.data + '/'
+    for name in files:
+        print name.data
+
+f = browse
+f.category = 'query'
+f.num_args = 'zero_or_one'
+dispatcher[unmangle(f.__name__)] = f
+
+#----------------------------#
+
 def status(moosic, arglist, opts):
     'status - An alias for "state".'
     state(moosic, arglist, opts)
@@ -1126,6 +1347,85 @@ dispatcher[unmangle(f.__name__)] = f
 
 #----------------------------#
 
+def stats(moosic, arglist, opts):
+    '''stats - Print statistics about the activity of the music daemon since it
+    started, including how many times each of its methods was called and how long
+    the calls took.'''
+    info = moosic.stats()
+    uptime = int(info['uptime'])
+    print 'Uptime: %d:%02d:%02d' % (uptime / 3600, uptime / 60 % 60, uptime % 60)
+    queue = info['queue']
+    print 'Queue: %d items (about %d kB), history: %d items' % \
+          (queue['length'], queue['memory'] / 1024, queue['history length'])
+    process = info['process']
+    print 'Threads: %d' % process['threads']
+    if 'max rss' in process:
+        print 'Peak memory use: %d kB' % process['max rss']
+    if 'song gap' in info:
+        print 'Last gap between songs: %.1f ms' % (info['song gap'] * 1000)
+    for title, timers in (('Method calls', info['methods']),
+                          ('Timings', info['timers'])):
+        if not timers:
+            continue
+        print
+        print '%-24s %8s %6s %9s %9s %9s %9s' % \
+              (title + ':', 'count', 'errors', 'mean ms', 'p90 ms', 'p99 ms',
+               'max ms')
+        names = timers.keys()
+        names.sort()
+        for name in names:
+            t = timers[name]
+            print '  %-22s %8d %6d %9.3f %9.3f %9.3f %9.3f' % (name, t['count'],
+                  t['errors'], t['mean'] * 1000, t['p90'] * 1000,
+                  t['p99'] * 1000, t['max'] * 1000)
+    if info['transports']:
+        print
+        print 'Traffic:'
+        for name, t in info['transports'].items():
+            print '  %s: %d requests, %d bytes in, %d bytes out' % \
+                  (name, t['requests'], t['bytes in'], t['bytes out'])
+    if info['counters']:
+        print
+        print 'Counters:'
+        names = info['counters'].keys()
+        names.sort()
+        for name in names:
+            print '  %s: %d' % (name, info['counters'][name])
+
+f = stats
+f.category = 'query'
+f.num_args = 'zero'
+dispatcher[unmangle(f.__name__)] = f
+
+#----------------------------#
+
+def profile(moosic, arglist, opts):
+    '''profile start [cprofile|sample] [methods] | profile stop - Profile the
+    music daemon. "profile start" starts profiling calls to the named server
+    methods (e.g. sub_all or move_list), or to all methods if none are named,
+    using either cProfile (the default) or periodic sampling of the call
+    stacks. "profile stop" stops profiling and prints the results.'''
+    action = arglist[0].lower()
+    if action == 'start':
+        methods = arglist[1:]
+        mode = 'cprofile'
+        if methods and methods[0] in ('cprofile', 'sample'):
+            mode = methods.pop(0)
+        moosic.profile_start(methods, mode)
+    elif action == 'stop':
+        sys.stdout.write(moosic.profile_stop().data)
+    else:
+        print >>sys.stderr, 'Error: "%s" is neither "start" nor "stop".' % \
+                arglist[0]
+        return 1
+
+f = profile
+f.category = 'manage'
+f.num_args = 'many'
+dispatcher[unmangle(f.__name__)] = f
+
+#----------------------------#
+
 def next(moosic, arglist, opts):
     'next [number] - Skip ahead in the song queue.'
     if arglist:
@@ -1425,6 +1725,29 @@ dispatcher[unmangle(f.__name__)] = f
 
 #----------------------------#
 
+def reindex(moosic, arglist, opts):
+    'reindex [directories] - Rebuild the library index of the music directory (or of the given directories) from scratch.'
+    from moosic.client.library import LibraryIndex
+    index = LibraryIndex(os.path.join(opts['config-dir'], 'library_index'))
+    index.threads = opts['jobs']
+    if not arglist:
+        index.clear()
+        arglist = [opts['music-dir']]
+    count = 0
+    for dir in arglist:
+        dir = os.path.abspath(os.path.expanduser(dir))
+        index.forget(dir)
+        count = count + len(index.files(dir))
+    index.save()
+    print 'Indexed %d files.' % count
+
+f = reindex
+f.category = 'manage'
+f.num_args = 'zero_or_many'
+dispatcher[unmangle(f.__name__)] = f
+
+#----------------------------#
+
 def help(moosic, arglist, opts):
     'help [commands] - Get documentation on the available moosic commands.'
     if not arglist:
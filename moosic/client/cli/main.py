@@ -25,7 +25,7 @@
 # 
 # For more information, please refer to <http://unlicense.org/>
 
-import sys, socket, os, os.path, getopt, xmlrpclib, errno, time, locale, re
+import sys, socket, os, os.path, getopt, xmlrpclib, errno, locale, re
 
 from moosic import VERSION
 from moosic.utilities import *
@@ -45,10 +45,11 @@ err = sys.stderr
 try: locale.setlocale(locale.LC_ALL, '')
 except: pass
 
+# The socket errors that mean that no server is listening at the address.
+NOT_RUNNING = (errno.ECONNREFUSED, errno.ENOENT)
+
 
 def main(argv):
-    COMMANDS = get_command_docs() \
-        + center_text('This Moosic has Super Cow Powers.', pad_char=' ')
     USAGE = "usage: " + os.path.basename(argv[0]) + \
         " [options] <command>" + '''
     Options:
@@ -84,6 +85,10 @@ def main(argv):
         -m, --music-dir <dir>   Specifies the directory to search when using the
                                 "auto-find" and "auto-grep" features.
                                 (Default: ~/music/)
+        -j, --jobs <num>        Use <num> threads to read directories when
+                                expanding directories or searching the music
+                                directory.  Helps on network filesystems.
+                                (Default: 1)
         -c, --config-dir <dir>  Specifies the directory where moosic should
                                 find the files kept by moosicd.
                                 (Default: ~/.moosic/)
@@ -117,6 +122,7 @@ def main(argv):
                          'f':'auto-find',
                          'F':'auto-grep',
                          'm:':'music-dir=',
+                         'j:':'jobs=',
                          'c:':'config-dir=',
                          't:':'tcp=',
                          'N':'no-startserver',
@@ -163,6 +169,11 @@ def main(argv):
                 opts['auto-find'] = False
             if option == '-m' or option == '--music-dir':
                 opts['music-dir'] = os.path.abspath(os.path.expanduser(val))
+            if option == '-j' or option == '--jobs':
+                try:
+                    opts['jobs'] = int(val)
+                except ValueError, e:
+                    sys.exit("Invalid number of jobs: %s" % val)
             if option == '-c' or option == '--config-dir':
                 opts['config-dir'] = os.path.abspath(os.path.expanduser(val))
             if option == '-t' or option == '--tcp':
@@ -183,7 +194,10 @@ def main(argv):
             if option == '-C' or option == '--current-in-list':
                 opts['current-in-list'] = True
             if option == '-S' or option == '--showcommands':
-                print COMMANDS
+                # The command list is only built when it's asked for, since
+                # building it takes longer than most commands do.
+                print get_command_docs() \
+                    + center_text('This Moosic has Super Cow Powers.', pad_char=' ')
                 sys.exit(0)
             if option == '-h' or option == '--help':
                 print USAGE
@@ -205,7 +219,7 @@ warranty; not even for MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE."""
             'music-dir':os.path.join(home, 'music', ''), 'auto-find':False,
             'auto-grep':False, 'start moosicd':True, 'ignore-case':False,
             'sort':False, 'rc-filename':os.path.join(home, '.moosicrc'),
-            'no-unplayables':True, 'current-in-list':False}
+            'no-unplayables':True, 'current-in-list':False, 'jobs':1}
     # Gather options specified before the command.
     arglist, opts = process_options(argv[1:], opts)
     # Pluck the command out of the argument list.
@@ -239,50 +253,57 @@ warranty; not even for MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE."""
         sys.exit(2)
 
     # Create a proxy object for speaking to the Moosic server.
+    # The transport notes whether any of the command's requests managed to
+    # connect to the server.
     if opts['tcp-address']:
         host, port = opts['tcp-address']
-        moosic = InetMoosicProxy(host, port)
+        transport = InetStreamTransport()
+        moosic = InetMoosicProxy(host, port, transport)
     else:
         server_address = os.path.join(opts['config-dir'], 'socket')
-        moosic = LocalMoosicProxy(server_address)
+        transport = UnixStreamTransport()
+        moosic = LocalMoosicProxy(server_address, transport)
 
-    # Make sure that our connection to the server is working properly.
-    try:
-        if command != 'startserver': # unless the user is starting it explicitly
-            moosic.no_op()
-    except socket.error, e:
-        if e[0] in (errno.ECONNREFUSED, errno.ENOENT):
-            # The server doesn't seem to be running, so let's try to start it
-            # for ourselves.
-            if opts['tcp-address']:
-                failure_reason = "The target Moosic server is on a remote computer."
-            elif opts['start moosicd']:
-                print >>err, "Notice: The Moosic server isn't running, so it " \
-                             "is being started automatically."
-                failure_reason = startServer('moosicd', '-c', opts['config-dir'])
-            else:
-                failure_reason = "Automatic launching of the server is disabled."
-            if failure_reason:
-                sys.exit(wrap("Error: The server (moosicd) doesn't seem to be "
-                         "running, and it could not be started automatically "
-                         "because:\n" + failure_reason, 79))
-            else:
-                # Wait bit to give moosicd time to start up.
-                time.sleep(0.25)
-                # Test the server connection again.
-                try:
-                    moosic.no_op()
-                except Exception, e:
-                    # We tried our best. Finally give up.
-                    sys.exit("An attempt was made to start the Moosic "
-                             "server, but it still can't be contacted.\n"
-                             "%s: %s" % (str(e.__class__).split('.')[-1], e))
+    def autostart():
+        """Starts the server for a command that found it not running, or exits
+        if it can't be started.
+        """
+        if opts['tcp-address']:
+            failure_reason = "The target Moosic server is on a remote computer."
+        elif opts['start moosicd']:
+            print >>err, "Notice: The Moosic server isn't running, so it " \
+                         "is being started automatically."
+            failure_reason = startServer('moosicd', '-c', opts['config-dir'])
         else:
-            sys.exit("Socket error: %s" % e)
+            failure_reason = "Automatic launching of the server is disabled."
+        if failure_reason:
+            sys.exit(wrap("Error: The server (moosicd) doesn't seem to be "
+                     "running, and it could not be started automatically "
+                     "because:\n" + failure_reason, 79))
 
     try:
-        # Dispatch the command.
-        exit_status = dispatcher[command](moosic, arglist, opts)
+        # Dispatch the command.  The connection to the server isn't tested
+        # beforehand, since that would cost an extra request.  Instead, if the
+        # command's first request finds that the server isn't running, the
+        # server is started and the command is run again.  (A command that
+        # fails after it has reached the server isn't retried, since it may
+        # have already changed something, even if xmlrpclib's own retry of a
+        # request then failed to connect.)
+        try:
+            exit_status = dispatcher[command](moosic, arglist, opts)
+        except socket.error, e:
+            if e[0] not in NOT_RUNNING or transport.connected:
+                raise
+            autostart()
+            try:
+                exit_status = dispatcher[command](moosic, arglist, opts)
+            except socket.error, e:
+                if e[0] not in NOT_RUNNING or transport.connected:
+                    raise
+                # We tried our best. Finally give up.
+                sys.exit("An attempt was made to start the Moosic "
+                         "server, but it still can't be contacted.\n"
+                         "%s: %s" % (str(e.__class__).split('.')[-1], e))
     except socket.error, e:
         exit_status = "Socket error: %s" % e[1]
     except xmlrpclib.Fault, e:
@@ -34,14 +34,14 @@ documentation for the xmlrpclib module for more detailed information about
 ServerProxy objects.  These factory functions are not necessary for creating
 proper Moosic server proxies, but they are a very convenient way of doing so.
 
-This module also contains a subclass of xmlrpclib.Transport that adapts the
-XML-RPC client implementation for use with Unix sockets.
+This module also contains subclasses of xmlrpclib.Transport that adapt the
+XML-RPC client implementation for use with Unix sockets, and that keep track of
+whether a connection to the server has ever been made.
 
 It is safe to "import *" from this module.
 """
 
-import xmlrpclib, urllib, httplib, socket, os, os.path, sys
-import moosic.server.main
+import xmlrpclib, urllib, httplib, socket, os, os.path, sys, time
 
 # Define the True and False constants if they don't already exist.
 try: True
@@ -50,8 +50,12 @@ try: False
 except NameError: False = 0
 
 
+# The number of seconds that startServer() waits for the server to report that
+# it is ready to handle requests.
+STARTUP_TIMEOUT = 10
+
 __all__ = ('startServer', 'LocalMoosicProxy', 'UnixMoosicProxy',
-           'InetMoosicProxy', 'UnixStreamTransport')
+           'InetMoosicProxy', 'UnixStreamTransport', 'InetStreamTransport')
 
 
 class UnixStreamTransport(xmlrpclib.Transport):
@@ -60,8 +64,15 @@ class UnixStreamTransport(xmlrpclib.Transport):
     This class mainly exists to serve as a helper for implementing the
     LocalMoosicProxy class, and will not be directly useful for most Moosic
     client developers.
+
+    The "connected" attribute becomes True once a connection to the server has
+    been made, which means that a request sent through this transport may have
+    reached the server, even if it later failed.
     '''
+    connected = False
+
     def make_connection(self, host):
+        transport = self
         class HTTPConnection(httplib.HTTPConnection):
             def connect(self):
                 host = urllib.unquote(self.host)
@@ -70,6 +81,7 @@ class UnixStreamTransport(xmlrpclib.Transport):
                     if self.debuglevel > 0:
                         print "connect: (%s)" % host
                     self.sock.connect(host)
+                    transport.connected = True
                 except socket.error, msg:
                     if self.debuglevel > 0:
                         print 'connect fail:', host
@@ -87,37 +99,67 @@ class UnixStreamTransport(xmlrpclib.Transport):
             return HTTPConnection(host)
 
 
-def LocalMoosicProxy(filename=None):
+class InetStreamTransport(xmlrpclib.Transport):
+    '''The standard transport for TCP/IP sockets, with the "connected" attribute
+    of UnixStreamTransport.
+    '''
+    connected = False
+
+    def make_connection(self, host):
+        connection = xmlrpclib.Transport.make_connection(self, host)
+        # Older versions of xmlrpclib.Transport return an httplib.HTTP object,
+        # which keeps the real connection in its _conn attribute.
+        watch_connect(self, getattr(connection, '_conn', connection))
+        return connection
+
+
+def watch_connect(transport, connection):
+    '''Makes an httplib.HTTPConnection set the "connected" attribute of a
+    transport once it has connected to the server.
+    '''
+    if getattr(connection, 'watched', False):
+        return  # (The transport is reusing a kept-alive connection.)
+    connect = connection.connect
+    def watched_connect():
+        connect()
+        transport.connected = True
+    connection.connect = watched_connect
+    connection.watched = True
+
+
+def LocalMoosicProxy(filename=None, transport=None):
     '''Creates a proxy to a Moosic server that is listening to a local (Unix
     address family) socket.
     
     The optional "filename" argument is the location of the socket file that the
-    Moosic server is using as its address.
+    Moosic server is using as its address.  The optional "transport" argument
+    is the UnixStreamTransport to use (a new one is made by default).
     '''
 
     if not filename:
         filename = os.path.join(os.getenv('HOME', '/tmp'), '.moosic', 'socket')
     server_address = 'http://%s/' % urllib.quote(filename, safe='')
     return xmlrpclib.ServerProxy(uri=server_address,
-                                 transport=UnixStreamTransport(),
+                                 transport=transport or UnixStreamTransport(),
                                  verbose=False)
 
 
-def UnixMoosicProxy(filename=None):
+def UnixMoosicProxy(filename=None, transport=None):
     '''An alias for the LocalMoosicProxy function.
     '''
-    return LocalMoosicProxy(filename)
+    return LocalMoosicProxy(filename, transport)
 
 
-def InetMoosicProxy(host, port):
+def InetMoosicProxy(host, port, transport=None):
     '''Creates a proxy to a Moosic server that is listening to a TCP/IP socket.
     
     The first argument, "host", is the hostname or IP address where the server
     is located. The second argument, "port", is the TCP port that the server is
-    listening to.
+    listening to.  The optional "transport" argument is the transport to use
+    (such as an InetStreamTransport); xmlrpclib's default is used otherwise.
     '''
     return xmlrpclib.ServerProxy(uri='http://%s:%d/' % (host, port),
-                                 verbose=False)
+                                 transport=transport, verbose=False)
 
 
 def startServer(*argv):
@@ -128,18 +170,58 @@ def startServer(*argv):
     moosicd(1) man page for a description of valid arguments.
     
     If the server can't be started, a string describing why is returned.
-    Otherwise, None is returned.
+    Otherwise, None is returned once the server is ready to handle requests.
     '''
+    # The server is imported only when it is needed, since it takes a lot
+    # longer to load than the client does.
+    import moosic.server.main
+    import tempfile, shutil, select
+    # The server reports that it's ready through the protocol of sd_notify(3),
+    # by sending a datagram to the socket named in the NOTIFY_SOCKET
+    # environment variable.
+    notify_dir = tempfile.mkdtemp()
+    notify_address = os.path.join(notify_dir, 'notify')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    listener.bind(notify_address)
+    # The daemon must not hold on to the listener for the rest of its life.
+    moosic.server.main.daemon_close_fds.append(listener.fileno())
+    old_notify_socket = os.environ.get('NOTIFY_SOCKET')
+    os.environ['NOTIFY_SOCKET'] = notify_address
     status = None
+    pid = os.getpid()
     try:
-        moosic.server.main.main(argv)
-    except SystemExit, e:
-        status = e[0]
-        if not status:
-            status = None
-        elif type(status) == int:
-            status = "The server exited with an exit status of %d." % status
-        else:
-            status = str(status)
+        try:
+            moosic.server.main.main(argv)
+        except SystemExit, e:
+            status = e[0]
+            if not status:
+                status = None
+            elif type(status) == int:
+                status = "The server exited with an exit status of %d." % status
+            else:
+                status = str(status)
+        if os.getpid() != pid:
+            # This is the daemon that main() forked, which has finished serving
+            # requests, so it has no business returning to our caller.
+            sys.exit(status)
+        # Wait until the server is ready.
+        deadline = time.time() + STARTUP_TIMEOUT
+        while status is None:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([listener], [], [],
+                                                   remaining)[0]:
+                status = "The server didn't report that it was ready " \
+                         "within %d seconds." % STARTUP_TIMEOUT
+                break
+            if 'READY=1' in listener.recv(4096).split('\n'):
+                break
+    finally:
+        # (The server removes the variable once it has used it.)
+        if os.environ.get('NOTIFY_SOCKET') == notify_address:
+            del os.environ['NOTIFY_SOCKET']
+        if old_notify_socket is not None:
+            os.environ['NOTIFY_SOCKET'] = old_notify_socket
+        moosic.server.main.daemon_close_fds.remove(listener.fileno())
+        listener.close()
+        shutil.rmtree(notify_dir, True)
     return status
-
@@ -0,0 +1,493 @@
+# moosic/client/library.py - a persistent index of the files in a music library
+#
+# This is free and unencumbered software released into the public domain.
+# 
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+# 
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# 
+# For more information, please refer to <http://unlicense.org/>
+
+
+"""Persistent indexes of the files in a music library.
+
+Listing every file in a large music collection takes a long time, but most of
+the collection doesn't change from one listing to the next.  The LibraryIndex
+defined here remembers the contents of every directory that it has listed, and
+keeps them in a file between uses.  A directory is only listed again if its
+modification time has changed (which happens whenever an entry is added to it,
+removed from it, or renamed within it), so bringing the index up to date costs
+a single stat() call for each directory that hasn't changed.
+
+The TrigramIndex defined here is kept in a file too.  It finds the files whose
+(simplified) names contain a given string, as --auto-find does, by looking only
+at the files whose names contain every three-character piece of that string.
+
+It is safe to "import *" from this module.
+"""
+
+import sys, os, os.path, stat, time, marshal, threading
+import cPickle as pickle
+from array import array
+from hashlib import md5
+
+# Define the True and False constants if they don't already exist.
+try: True
+except NameError: True = 1
+try: False
+except NameError: False = 0
+
+__all__ = ('LibraryIndex', 'TrigramIndex', 'map_in_threads')
+
+# This is changed whenever the format of the index file changes, so that an
+# index that was written in an older format is ignored instead of misread.
+INDEX_VERSION = 1
+
+# The same, for the format of the trigram index file.
+TRIGRAM_VERSION = 1
+
+# A directory that was modified less than this many seconds before it was listed
+# is listed again the next time, since it might have been modified again (in the
+# same clock tick) after it was listed.
+RACY_SECONDS = 2
+
+
+def map_in_threads(function, items, threads):
+    """Returns map(function, items), calling the function from the given number
+    of threads at once.  This only helps if the function spends most of its
+    time waiting (e.g. for the filesystem).
+    """
+    if threads <= 1 or len(items) < 2:
+        return map(function, items)
+    results = [None] * len(items)
+    # The position of the next item to be handled, and any exception that was
+    # raised by the function.
+    state = {'next': 0, 'error': None}
+    lock = threading.Lock()
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                i = state['next']
+                state['next'] = i + 1
+            finally:
+                lock.release()
+            if i >= len(items) or state['error'] is not None:
+                return
+            try:
+                results[i] = function(items[i])
+            except:
+                state['error'] = sys.exc_info()
+                return
+    workers = [threading.Thread(target=worker)
+               for i in range(min(threads, len(items)))]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    if state['error'] is not None:
+        raise state['error'][0], state['error'][1], state['error'][2]
+    return results
+
+
+def write_file(filename, contents):
+    """Replaces the contents of a file, returning False if that fails.
+
+    A new file is written and then renamed over the old one, so that another
+    process never sees a partly written file.
+    """
+    temp_filename = '%s.%d' % (filename, os.getpid())
+    try:
+        f = open(temp_filename, 'wb')
+        try:
+            f.write(contents)
+        finally:
+            f.close()
+        os.rename(temp_filename, filename)
+    except (IOError, OSError):
+        try: os.remove(temp_filename)
+        except OSError: pass
+        return False
+    return True
+
+
+class LibraryIndex:
+    """The remembered contents of a set of directories.
+
+    The index is read from the given file when it is created, and it is
+    written back by save().  The file is only a cache: if it is missing,
+    unreadable, or out of date, then the directories are simply listed again.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        # A mapping from the pathname of each directory that has been listed to
+        # a (mtime, subdirectories, files) tuple.  "mtime" is the modification
+        # time of the directory when it was listed (or None if it must be
+        # listed again), "subdirectories" is a sorted list of the names of the
+        # directories within it, and "files" is a sorted list of a (name,
+        # mtime, size) tuple for each regular file within it.  Symbolic links
+        # are followed.
+        self.dirs = {}
+        # Whether the index has changed since it was loaded or saved.
+        self.changed = False
+        # The number of threads that refresh() uses to examine directories.
+        self.threads = 1
+        self.load()
+
+    def load(self):
+        """Reads the index from its file, if possible."""
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                version, dirs = pickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError, AttributeError,
+                pickle.UnpicklingError):
+            return
+        if version == INDEX_VERSION:
+            self.dirs = dirs
+
+    def save(self):
+        """Writes the index to its file, if it has changed.
+
+        Failures are ignored, since the index can always be rebuilt.
+        """
+        if not self.changed:
+            return
+        if write_file(self.filename, pickle.dumps((INDEX_VERSION, self.dirs), 2)):
+            self.changed = False
+
+    def clear(self):
+        """Forgets everything in the index."""
+        self.dirs = {}
+        self.changed = True
+
+    def forget(self, dir):
+        """Forgets a directory and everything within it."""
+        dir = os.path.normpath(dir)
+        prefix = os.path.join(dir, '')
+        for path in self.dirs.keys():
+            if path == dir or path.startswith(prefix):
+                del self.dirs[path]
+                self.changed = True
+
+    def files(self, top, sort=False):
+        """Returns the pathnames of all the regular files within a directory and
+        its subdirectories (following symbolic links), much like the output of
+        "find top -follow -type f".
+
+        The index is brought up to date along the way (see refresh()), and
+        then the pathnames are produced by walk().  Directories that can't be
+        read are skipped.
+        """
+        top = os.path.normpath(top)
+        loops = self.refresh(top)
+        return list(self.walk(top, loops, sort))
+
+    def refresh(self, top):
+        """Brings the index up to date for a directory and all the directories
+        within it.
+
+        The directories are visited a level at a time, and if self.threads is
+        more than 1, the directories in each level are examined by that many
+        threads at once, which helps a lot on filesystems that are slow to
+        answer (like network filesystems).  Returns a dictionary whose keys are
+        the directories that must not be descended into, because they are
+        symbolic links that lead back to a directory that contains them.
+        """
+        loops = {}
+        level = [(top, ())]
+        while level:
+            scans = map_in_threads(self.scan, level, self.threads)
+            next_level = []
+            for i in range(len(level)):
+                dir, ancestors = level[i]
+                st, listing = scans[i]
+                if st is None:
+                    self.forget(dir)
+                    continue
+                inode = (st.st_dev, st.st_ino)
+                if inode in ancestors:
+                    loops[dir] = True
+                    continue
+                if listing is None:
+                    entry = self.dirs[dir]
+                else:
+                    entry = self.record(dir, st.st_mtime, listing)
+                ancestors = ancestors + (inode,)
+                prefix = os.path.join(dir, '')
+                next_level.extend([(prefix + name, ancestors)
+                                   for name in entry[1]])
+            level = next_level
+        return loops
+
+    def scan(self, item):
+        """Examines a directory for refresh(), possibly in another thread.
+
+        Returns the directory's stat() result (or None if it has gone away),
+        and if the directory has to be listed again, what read_dir() returns
+        for it (otherwise None).  The index isn't changed.
+        """
+        dir, ancestors = item
+        try:
+            st = os.stat(dir)
+        except OSError:
+            return None, None
+        if (st.st_dev, st.st_ino) in ancestors:
+            return st, None
+        entry = self.dirs.get(dir)
+        if entry is not None and entry[0] == st.st_mtime:
+            return st, None
+        return st, self.read_dir(dir)
+
+    def read_dir(self, dir):
+        """Lists the contents of a directory, without changing the index.
+        Returns a sorted list of the names of its subdirectories, and a sorted
+        list of a (name, mtime, size) tuple for each of its files.
+        """
+        subdirs = []
+        files = []
+        try:
+            names = os.listdir(dir)
+        except OSError:
+            names = []
+        for name in names:
+            try:
+                st = os.stat(os.path.join(dir, name))
+            except OSError:
+                continue  # e.g. a broken symbolic link
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append(name)
+            elif stat.S_ISREG(st.st_mode):
+                files.append((name, st.st_mtime, st.st_size))
+        subdirs.sort()
+        files.sort()
+        return subdirs, files
+
+    def record(self, dir, mtime, listing):
+        """Records the contents of a directory (as returned by read_dir()) in
+        the index, and returns its entry.
+        """
+        subdirs, files = listing
+        # Forget about subdirectories that have gone away.
+        old_entry = self.dirs.get(dir)
+        if old_entry is not None:
+            present = {}
+            for name in subdirs:
+                present[name] = True
+            for name in old_entry[1]:
+                if not present.has_key(name):
+                    self.forget(os.path.join(dir, name))
+        if time.time() - mtime < RACY_SECONDS:
+            mtime = None
+        entry = (mtime, subdirs, files)
+        self.dirs[dir] = entry
+        self.changed = True
+        return entry
+
+    def walk(self, top, loops={}, sort=False):
+        """Generates the pathnames of the files within a directory that has
+        been brought up to date by refresh(), from the index alone.
+
+        The directories in "loops" (as returned by refresh()) are skipped.  If
+        "sort" is false, the files in each directory come before the contents
+        of its subdirectories.  If it is true, the pathnames come out in sorted
+        order, as if they had all been collected and sorted, but in time
+        proportional to the number of files.
+        """
+        pending = [(top, True)]
+        while pending:
+            path, is_dir = pending.pop()
+            if not is_dir:
+                yield path
+                continue
+            entry = self.dirs.get(path)
+            if entry is None or loops.has_key(path):
+                continue
+            mtime, subdirs, files = entry
+            prefix = os.path.join(path, '')
+            if sort and subdirs:
+                # The contents of a subdirectory sort as if its name ended in
+                # a slash, so that's how the subdirectories are compared with
+                # each other and with the files.
+                items = [(name + '/', prefix + name, True) for name in subdirs]
+                items.extend([(file[0], prefix + file[0], False)
+                              for file in files])
+                items.sort()
+                for i in range(len(items) - 1, -1, -1):
+                    pending.append(items[i][1:])
+                continue
+            for file in files:
+                yield prefix + file[0]
+            # Visit the subdirectories in order.
+            for i in range(len(subdirs) - 1, -1, -1):
+                pending.append((prefix + subdirs[i], True))
+
+
+class TrigramIndex:
+    """An index of the trigrams (three-character substrings) of the simplified
+    names of a list of files.
+
+    The index is given a function that simplifies a filename, and search()
+    returns the files whose simplified names contain a given string.  Only the
+    files whose simplified names contain all of the string's trigrams need to
+    be looked at, and those are found by intersecting the lists of files in
+    which each trigram appears (starting with the shortest).  Like
+    LibraryIndex, the index is read from the given file when it is created,
+    and save() writes it back.
+    """
+    def __init__(self, filename, simplify):
+        self.filename = filename
+        self.simplify = simplify
+        # The MD5 digest of the list of files that was last given to update().
+        self.digest = None
+        # The indexed files.  Each file is identified by its position in this
+        # list, and a file that has gone away is replaced by None (until there
+        # are enough of those to make rebuilding the index worthwhile).
+        self.paths = []
+        # A mapping from each trigram to an array of the positions (in
+        # self.paths) of the files whose simplified names contain it.  The
+        # arrays are read from the file as strings, and are only turned back
+        # into arrays when they are needed.
+        self.postings = {}
+        # Whether the index has changed since it was loaded or saved.
+        self.changed = False
+        self.load()
+
+    def load(self):
+        """Reads the index from its file, if possible."""
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                version, digest, paths, postings = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return
+        if version == TRIGRAM_VERSION:
+            self.digest, self.paths, self.postings = digest, paths, postings
+
+    def save(self):
+        """Writes the index to its file, if it has changed.
+
+        Failures are ignored, since the index can always be rebuilt.
+        """
+        if not self.changed:
+            return
+        postings = {}
+        for trigram, posting in self.postings.items():
+            if not isinstance(posting, str):
+                posting = posting.tostring()
+            postings[trigram] = posting
+        contents = marshal.dumps((TRIGRAM_VERSION, self.digest, self.paths,
+                                  postings))
+        if write_file(self.filename, contents):
+            self.changed = False
+
+    def posting(self, trigram):
+        """Returns the array of the files whose simplified names contain a
+        trigram, or None if there are none.
+        """
+        posting = self.postings.get(trigram)
+        if isinstance(posting, str):
+            posting = array('i', posting)
+            self.postings[trigram] = posting
+        return posting
+
+    def update(self, files):
+        """Brings the index up to date with a list of pathnames.
+
+        Files that are new to the index are added to it, and files that have
+        gone away are forgotten.  The whole index is rebuilt if too much of it
+        would be taken up by forgotten files.
+        """
+        digest = md5('\0'.join(files)).digest()
+        if digest == self.digest:
+            return
+        self.digest = digest
+        self.changed = True
+        present = {}
+        for path in files:
+            present[path] = True
+        indexed = {}
+        holes = 0
+        paths = self.paths
+        for i in xrange(len(paths)):
+            path = paths[i]
+            if path is None:
+                holes = holes + 1
+            elif not present.has_key(path):
+                paths[i] = None
+                holes = holes + 1
+            else:
+                indexed[path] = True
+        if holes > len(files) // 4:
+            self.paths = []
+            self.postings = {}
+            added = files
+        else:
+            added = [path for path in files if not indexed.has_key(path)]
+        start = len(self.paths)
+        self.paths.extend(added)
+        simplify = self.simplify
+        posting = self.posting
+        for i in xrange(start, len(self.paths)):
+            name = simplify(self.paths[i])
+            trigrams = {}
+            for j in xrange(len(name) - 2):
+                trigrams[name[j:j+3]] = True
+            for trigram in trigrams:
+                p = posting(trigram)
+                if p is None:
+                    self.postings[trigram] = array('i', [i])
+                else:
+                    p.append(i)
+
+    def search(self, s):
+        """Returns the pathnames of the files whose simplified names contain a
+        string, which should already be simplified.
+        """
+        simplify = self.simplify
+        paths = self.paths
+        if len(s) < 3:
+            # There are no trigrams to look up, so every file is a candidate.
+            return [path for path in paths
+                    if path is not None and simplify(path).find(s) != -1]
+        postings = []
+        for j in xrange(len(s) - 2):
+            p = self.posting(s[j:j+3])
+            if p is None:
+                return []
+            postings.append((len(p), p))
+        postings.sort()
+        candidates = set(postings[0][1])
+        for length, p in postings[1:]:
+            # Checking a candidate's name is cheaper than intersecting with a
+            # much longer list.
+            if length > 8 * len(candidates):
+                break
+            candidates.intersection_update(p)
+        # The trigrams can appear in a name without the whole string appearing
+        # in it, so every candidate has to be checked.
+        candidates = list(candidates)
+        candidates.sort()
+        return [paths[i] for i in candidates
+                if paths[i] is not None and simplify(paths[i]).find(s) != -1]
@@ -0,0 +1,485 @@
+# moosic/server/eventloop.py - a single-threaded request handler for moosicd
+#
+# This is free and unencumbered software released into the public domain.
+# 
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+# 
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# 
+# For more information, please refer to <http://unlicense.org/>
+
+
+"""A single-threaded request handler for moosicd.
+
+The EventLoop class defined here is an alternative to running serve_forever()
+on each of moosicd's servers in its own thread.  It watches every listening
+socket and every client connection at the same time, using non-blocking I/O and
+a poll() (or select()) loop, and it parses HTTP requests incrementally as their
+bytes arrive.  Complete XML-RPC requests are dispatched through the same
+server objects (and therefore the same moosicd_methods registry) that the
+threaded request handler uses.
+
+Since a connection that is merely waiting costs nothing more than an entry in
+the poll set, a single EventLoop can hold open a very large number of idle
+(keep-alive) client connections.
+"""
+
+import os, socket, select, errno, time, string
+import xmlrpclib
+
+from moosic.server.support import data, Log, log_exception, \
+                                  METRICS_PATH, METRICS_CONTENT_TYPE
+from moosic.server.stats import stats
+
+# Define the True and False constants if they don't already exist.
+try: True
+except NameError: True = 1
+try: False
+except NameError: False = 0
+
+__all__ = ('EventLoop',)
+
+# The poll() event masks that we care about.  They are given names here so that
+# they can be reused by the select()-based emulation of poll() below.
+POLLIN = getattr(select, 'POLLIN', 1)
+POLLOUT = getattr(select, 'POLLOUT', 4)
+POLLERR = getattr(select, 'POLLERR', 8)
+POLLHUP = getattr(select, 'POLLHUP', 16)
+POLLNVAL = getattr(select, 'POLLNVAL', 32)
+
+# The errors that simply mean "try again later" on a non-blocking socket.
+_RETRY_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# The largest chunk of data that will be read from or written to a socket at
+# one time.
+CHUNK_SIZE = 256 * 1024
+
+# The largest header block that a client is allowed to send.
+MAX_HEADER_SIZE = 64 * 1024
+
+# The longest time (in seconds) that a loop that has been shut down will spend
+# writing out the responses that it has already queued up.
+FLUSH_TIMEOUT = 2.0
+
+
+class _SelectPoller:
+    """A minimal imitation of select.poll() objects, built upon select.select().
+
+    This is only used on platforms that don't provide poll().
+    """
+    def __init__(self):
+        self.fds = {}
+
+    def register(self, fd, eventmask):
+        self.fds[fd] = eventmask
+
+    modify = register
+
+    def unregister(self, fd):
+        del self.fds[fd]
+
+    def poll(self, timeout=None):
+        if timeout is not None:
+            timeout = timeout / 1000.0
+        readers = [fd for fd, mask in self.fds.items() if mask & POLLIN]
+        writers = [fd for fd, mask in self.fds.items() if mask & POLLOUT]
+        r, w, x = select.select(readers, writers, [], timeout)
+        events = {}
+        for fd in r:
+            events[fd] = events.get(fd, 0) | POLLIN
+        for fd in w:
+            events[fd] = events.get(fd, 0) | POLLOUT
+        return events.items()
+
+
+def _make_poller():
+    if hasattr(select, 'poll'):
+        return select.poll()
+    else:
+        return _SelectPoller()
+
+
+class HttpConnection:
+    """The state of a single client connection that is served by an EventLoop.
+
+    Bytes are accumulated as they arrive until a complete HTTP request (a header
+    block followed by a body whose length is given by the Content-Length header)
+    is available.  The request is then handled, and its response is queued up
+    to be written back to the client whenever the socket is ready to accept it.
+    A connection may carry any number of requests in succession if the client
+    asks for the connection to be kept alive.
+    """
+    def __init__(self, loop, server, sock, client_address):
+        self.loop = loop
+        self.server = server
+        self.sock = sock
+        self.client_address = client_address
+        self.fd = sock.fileno()
+        # The bytes of the header block that have been received so far.
+        self.header_buf = ''
+        # The parsed request line and headers of the current request, or None if
+        # the header block hasn't been completely received yet.
+        self.request = None
+        # The pieces of the current request's body received so far, and their
+        # total length.
+        self.body_chunks = []
+        self.body_len = 0
+        self.content_length = 0
+        # The response data that is waiting to be written, and the position of
+        # the first byte that hasn't been written yet.
+        self.outbuf = ''
+        self.outpos = 0
+        # Bytes that arrived while a response was still being written.
+        self.pending = []
+        self.keep_alive = False
+        self.closed = False
+
+    #----- Reading and parsing requests -----#
+
+    def handle_read(self):
+        try:
+            chunk = self.sock.recv(CHUNK_SIZE)
+        except socket.error, e:
+            if e[0] in _RETRY_ERRORS:
+                return
+            self.close()
+            return
+        if not chunk:
+            # The client has gone away.
+            self.close()
+            return
+        self.feed(chunk)
+
+    def feed(self, chunk):
+        """Accepts newly received bytes, and handles the request that they
+        complete, if any.
+        """
+        if self.outbuf or self.closed:
+            # Don't start on the next request until the response to the previous
+            # one has been written.  Keep the new bytes until then.
+            if chunk:
+                self.pending.append(chunk)
+            return
+        if self.request is None:
+            # Look for the end of the header block, taking care to notice an
+            # end-of-headers marker that straddles two chunks.
+            start = max(0, len(self.header_buf) - 3)
+            self.header_buf = self.header_buf + chunk
+            end = string.find(self.header_buf, '\r\n\r\n', start)
+            if end == -1:
+                if len(self.header_buf) > MAX_HEADER_SIZE:
+                    self.send_error(413, 'Request Entity Too Large')
+                return
+            head = self.header_buf[:end]
+            chunk = self.header_buf[end+4:]
+            self.header_buf = ''
+            if not self.parse_head(head):
+                return
+        needed = self.content_length - self.body_len
+        if chunk and needed > 0:
+            self.body_chunks.append(chunk[:needed])
+            self.body_len = self.body_len + len(self.body_chunks[-1])
+            chunk = chunk[needed:]
+        if self.body_len < self.content_length:
+            return
+        body = string.join(self.body_chunks, '')
+        self.body_chunks = []
+        self.body_len = 0
+        request, self.request = self.request, None
+        self.handle_request(request, body)
+        # Hold on to the start of a pipelined request, if there is one.
+        if chunk:
+            self.feed(chunk)
+
+    def parse_head(self, head):
+        """Parses the request line and headers of a request.
+
+        Returns True if parsing succeeded, otherwise an error response is queued
+        and False is returned.
+        """
+        lines = string.split(head, '\r\n')
+        words = string.split(lines[0])
+        if len(words) != 3 or words[2][:5] != 'HTTP/':
+            self.send_error(400, 'Bad Request')
+            return False
+        command, path, version = words
+        headers = {}
+        for line in lines[1:]:
+            if ':' not in line:
+                continue
+            name, value = string.split(line, ':', 1)
+            headers[string.lower(string.strip(name))] = string.strip(value)
+        connection = string.lower(headers.get('connection', ''))
+        if version >= 'HTTP/1.1':
+            self.keep_alive = (connection != 'close')
+        else:
+            self.keep_alive = (connection == 'keep-alive')
+        try:
+            self.content_length = int(headers.get('content-length', 0))
+        except ValueError:
+            self.send_error(400, 'Bad Request')
+            return False
+        if self.content_length < 0:
+            self.send_error(400, 'Bad Request')
+            return False
+        self.request = (command, path, version, headers)
+        return True
+
+    #----- Handling requests -----#
+
+    def handle_request(self, request, body):
+        command, path, version, headers = request
+        if command == 'GET':
+            if path != METRICS_PATH:
+                self.send_error(404, 'Not Found')
+                return
+            self.send_response(200, 'OK', stats.exposition(),
+                               METRICS_CONTENT_TYPE)
+            return
+        if command != 'POST':
+            self.send_error(501, 'Unsupported method (%r)' % command)
+            return
+        rpc_paths = getattr(self.server.RequestHandlerClass, 'rpc_paths', None)
+        if rpc_paths and path not in rpc_paths:
+            self.send_error(404, 'Not Found')
+            return
+        if string.lower(headers.get('content-encoding', 'identity')) == 'gzip':
+            try:
+                body = xmlrpclib.gzip_decode(body)
+            except (ValueError, NotImplementedError):
+                self.send_error(400, 'Bad Request')
+                return
+        try:
+            response = self.server._marshaled_dispatch(body)
+        except:
+            # This should only happen if the dispatcher itself is buggy.
+            log_exception(self.sock, self.client_address)
+            self.send_error(500, 'Internal Server Error')
+            return
+        self.send_response(200, 'OK', response, 'text/xml')
+
+    def send_response(self, code, message, body='', content_type='text/plain'):
+        """Queues up an HTTP response to be written to the client."""
+        if self.keep_alive:
+            version, connection = 'HTTP/1.1', 'keep-alive'
+        else:
+            version, connection = 'HTTP/1.0', 'close'
+        head = '%s %d %s\r\n' % (version, code, message) + \
+               'Server: moosicd\r\n' + \
+               'Content-Type: %s\r\n' % content_type + \
+               'Content-Length: %d\r\n' % len(body) + \
+               'Connection: %s\r\n\r\n' % connection
+        self.outbuf = head + body
+        self.outpos = 0
+        self.loop.want_write(self)
+
+    def send_error(self, code, message):
+        self.keep_alive = False
+        self.request = None
+        self.header_buf = ''
+        self.send_response(code, message, '%d %s\n' % (code, message))
+
+    #----- Writing responses -----#
+
+    def handle_write(self):
+        try:
+            sent = self.sock.send(self.outbuf[self.outpos:self.outpos+CHUNK_SIZE])
+        except socket.error, e:
+            if e[0] in _RETRY_ERRORS:
+                return
+            self.close()
+            return
+        self.outpos = self.outpos + sent
+        if self.outpos >= len(self.outbuf):
+            self.outbuf = ''
+            self.outpos = 0
+            if not self.keep_alive:
+                self.close()
+                return
+            self.loop.want_read(self)
+            # Handle any request that arrived while this response was waiting
+            # to be written.
+            if self.pending:
+                pending = string.join(self.pending, '')
+                self.pending = []
+                self.feed(pending)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_connection(self)
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class EventLoop:
+    """Serves requests for any number of moosicd servers from a single thread.
+
+    The "servers" argument is a sequence of server objects (such as instances
+    of UnixMoosicServer or TcpMoosicServer) whose sockets are already bound and
+    listening.  Requests received through each server's socket are dispatched
+    with that server's _marshaled_dispatch() method.
+    """
+    def __init__(self, servers):
+        self.poller = _make_poller()
+        self.listeners = {}
+        self.connections = {}
+        self.quit = False
+        # A pipe used for waking up the loop when it is told to shut down.
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.poller.register(self.wakeup_r, POLLIN)
+        for server in servers:
+            # A deeper backlog than SocketServer's default keeps bursts of new
+            # connections from being refused while the loop is busy.
+            server.socket.listen(socket.SOMAXCONN)
+            server.socket.setblocking(0)
+            self.listeners[server.socket.fileno()] = server
+            self.poller.register(server.socket.fileno(), POLLIN)
+        self.raise_fd_limit()
+
+    def raise_fd_limit(self):
+        """Raises the soft limit on open files as far as it can go, since every
+        connection being held open uses a file descriptor.
+        """
+        try:
+            import resource
+        except ImportError:
+            return
+        try:
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if hard == resource.RLIM_INFINITY:
+                hard = max(soft, 65536)
+            if hard > soft:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, resource.error):
+            pass
+
+    def serve_forever(self):
+        """Handles connections until shutdown() is called, and then writes out
+        the responses that are still waiting to be sent (such as the response
+        to die()) before returning.
+        """
+        while not self.quit:
+            try:
+                events = self.poller.poll()
+            except (select.error, IOError, OSError), e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self.wakeup_r:
+                    os.read(self.wakeup_r, 512)
+                elif fd in self.listeners:
+                    self.accept(self.listeners[fd])
+                elif fd in self.connections:
+                    conn = self.connections[fd]
+                    try:
+                        if event & (POLLIN | POLLHUP | POLLERR):
+                            conn.handle_read()
+                        if event & POLLOUT and not conn.closed:
+                            conn.handle_write()
+                        if event & POLLNVAL:
+                            conn.close()
+                    except:
+                        log_exception(conn.sock, conn.client_address)
+                        conn.close()
+        self.flush()
+
+    def flush(self):
+        """Finishes writing every queued response, giving up after
+        FLUSH_TIMEOUT seconds, and then closes all of the connections.
+        """
+        for fd in self.listeners.keys() + [self.wakeup_r]:
+            self.poller.unregister(fd)
+        deadline = time.time() + FLUSH_TIMEOUT
+        while True:
+            for conn in self.connections.values():
+                # Don't read any more requests.
+                conn.keep_alive = False
+                if not conn.outbuf:
+                    conn.close()
+            timeout = deadline - time.time()
+            if not self.connections or timeout <= 0:
+                break
+            try:
+                events = self.poller.poll(timeout * 1000)
+            except (select.error, IOError, OSError), e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                conn = self.connections.get(fd)
+                if conn is None:
+                    continue
+                if event & POLLOUT:
+                    conn.handle_write()
+                else:
+                    conn.close()
+        for conn in self.connections.values():
+            conn.close()
+
+    def shutdown(self):
+        """Tells the loop to stop serving requests."""
+        self.quit = True
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError:
+            pass
+
+    def accept(self, server):
+        # Accept as many pending connections as possible.
+        while True:
+            try:
+                sock, client_address = server.socket.accept()
+            except socket.error, e:
+                if e[0] in _RETRY_ERRORS or e[0] == errno.ECONNABORTED:
+                    return
+                elif e[0] in (errno.EMFILE, errno.ENFILE):
+                    data.log(Log.WARNING, 'Cannot accept connection: %s' % e[1])
+                    return
+                raise
+            sock.setblocking(0)
+            if sock.family == socket.AF_INET:
+                try:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                except socket.error:
+                    pass
+            conn = HttpConnection(self, server, sock, client_address)
+            self.connections[conn.fd] = conn
+            self.poller.register(conn.fd, POLLIN)
+
+    def want_read(self, conn):
+        if not conn.closed:
+            self.poller.modify(conn.fd, POLLIN)
+
+    def want_write(self, conn):
+        if not conn.closed:
+            self.poller.modify(conn.fd, POLLOUT)
+
+    def remove_connection(self, conn):
+        if self.connections.get(conn.fd) is conn:
+            del self.connections[conn.fd]
+            try:
+                self.poller.unregister(conn.fd)
+            except (KeyError, ValueError, select.error):
+                pass
@@ -0,0 +1,402 @@
+# moosic/server/library.py - a live, in-memory tree of the music library
+#
+# This is free and unencumbered software released into the public domain.
+# 
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+# 
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# 
+# For more information, please refer to <http://unlicense.org/>
+
+
+"""Keeps a live, in-memory tree of the files under the music root.
+
+When moosicd is given a music root (with --music-root), the LibraryTree in this
+module lists every directory under it, and then keeps the tree up to date by
+listening to Linux's inotify facility for files and directories that are
+created, removed, or renamed.  This lets the library methods (see
+moosic.server.methods) answer questions about the music library without
+touching the filesystem, and it gives clients that reach moosicd through TCP a
+way to see the library at all.
+
+Where inotify can't be used (or runs out of watches), the tree instead checks
+the modification time of each directory that a question touches, and lists the
+directory again if it has changed.
+"""
+
+import os, os.path, stat, struct, select, threading, errno
+
+from moosic.utilities import grep
+from moosic.server.support import data, Log
+
+# Define the True and False constants if they don't already exist.
+try: True
+except NameError: True = 1
+try: False
+except NameError: False = 0
+
+__all__ = ('LibraryTree', 'library')
+
+# Constants from <sys/inotify.h>.
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 02000000
+
+# The events that are watched for in each directory.
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+
+# The size of the fixed part of a struct inotify_event.
+EVENT_HEADER = struct.calcsize('iIII')
+
+# Use inotify from the C library if we can get at it through ctypes.
+try:
+    import ctypes, ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_init1.argtypes = [ctypes.c_int]
+    _inotify_init1.restype = ctypes.c_int
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                   ctypes.c_uint32]
+    _inotify_add_watch.restype = ctypes.c_int
+    _inotify_rm_watch = _libc.inotify_rm_watch
+    _inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    _inotify_rm_watch.restype = ctypes.c_int
+except (ImportError, OSError, AttributeError, TypeError):
+    _inotify_init1 = None
+
+
+class LibraryTree:
+    """The directories and files under the music root.
+
+    The tree is listed by a thread of its own (see start()), which then waits
+    for inotify events and applies them to the tree.  All of the other methods
+    may be called from any thread.  Symbolic links are followed, but a
+    directory that has already been seen (e.g. through a link that points back
+    up the tree) is left out.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.root = ''
+        # A mapping from the pathname of each directory in the tree to a
+        # [mtime, subdirectories, files, inode] list, where "subdirectories"
+        # and "files" are dictionaries whose keys are the names of the entries
+        # in the directory, and "inode" is the directory's (device, inode) pair.
+        self.dirs = {}
+        # The (device, inode) pairs of the directories in the tree.
+        self.inodes = {}
+        # Whether the tree has been listed for the first time.
+        self.ready = False
+        # The inotify file descriptor, and mappings from each watch descriptor
+        # to the directory that it watches, and back.
+        self.inotify = None
+        self.watches = {}
+        self.watched = {}
+        # Whether the modification times of directories have to be checked,
+        # because some of them aren't being watched.
+        self.polling = True
+
+    def start(self, root):
+        """Starts listing and watching the given directory in a new thread."""
+        self.root = os.path.normpath(root)
+        if _inotify_init1 is not None:
+            fd = _inotify_init1(IN_CLOEXEC)
+            if fd >= 0:
+                self.inotify = fd
+                self.polling = False
+        if self.inotify is None:
+            data.log(Log.WARNING, 'Cannot use inotify; changes to the music '
+                     'library will be noticed by checking directory times.')
+        t = threading.Thread(target=self.run)
+        t.setDaemon(True)
+        t.start()
+
+    def run(self):
+        self.lock.acquire()
+        try:
+            self.add_tree(self.root)
+        finally:
+            self.lock.release()
+        self.ready = True
+        data.log(Log.NOTICE, 'Listed the music library in "%s": %d '
+                 'directories.' % (self.root, len(self.dirs)))
+        if self.inotify is None:
+            return
+        buffer = ''
+        while True:
+            try:
+                select.select([self.inotify], [], [])
+                buffer = buffer + os.read(self.inotify, 65536)
+            except (OSError, select.error), e:
+                if e[0] == errno.EINTR:
+                    continue
+                data.log(Log.ERROR, 'Cannot read inotify events: %s' % e)
+                self.polling = True
+                return
+            while len(buffer) >= EVENT_HEADER:
+                wd, mask, cookie, length = struct.unpack('iIII',
+                                                         buffer[:EVENT_HEADER])
+                if len(buffer) < EVENT_HEADER + length:
+                    break
+                name = buffer[EVENT_HEADER:EVENT_HEADER+length].rstrip('\0')
+                buffer = buffer[EVENT_HEADER+length:]
+                self.lock.acquire()
+                try:
+                    self.handle_event(wd, mask, name)
+                finally:
+                    self.lock.release()
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # Some events were lost, so start over.
+            data.log(Log.WARNING, 'Too many changes to the music library at '
+                     'once; listing it again.')
+            self.remove_tree(self.root)
+            self.add_tree(self.root)
+            return
+        dir = self.watches.get(wd)
+        if dir is None:
+            return
+        if mask & IN_IGNORED:
+            # The directory has gone away, or its watch has been removed.
+            del self.watches[wd]
+            if self.watched.get(dir) == wd:
+                del self.watched[dir]
+            return
+        if not self.dirs.has_key(dir):
+            return
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            self.add_entry(dir, name)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.remove_entry(dir, name)
+
+    #---------- changing the tree (with the lock held) ----------#
+
+    def add_tree(self, top):
+        """Lists a directory and all of the directories under it.  Returns False
+        if the directory can't be added to the tree.
+        """
+        try:
+            st = os.stat(top)
+        except OSError:
+            return False
+        if not stat.S_ISDIR(st.st_mode) or \
+           self.inodes.has_key((st.st_dev, st.st_ino)):
+            return False
+        pending = [(top, st)]
+        while pending:
+            dir, st = pending.pop()
+            inode = (st.st_dev, st.st_ino)
+            self.inodes[inode] = dir
+            self.watch(dir)
+            subdirs = {}
+            files = {}
+            self.dirs[dir] = [st.st_mtime, subdirs, files, inode]
+            try:
+                names = os.listdir(dir)
+            except OSError:
+                names = []
+            for name in names:
+                path = os.path.join(dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue  # e.g. a broken symbolic link
+                if stat.S_ISDIR(st.st_mode):
+                    if not self.inodes.has_key((st.st_dev, st.st_ino)):
+                        subdirs[name] = True
+                        # Claim the inode now, so that another link to the same
+                        # directory within this one isn't listed too.
+                        self.inodes[(st.st_dev, st.st_ino)] = path
+                        pending.append((path, st))
+                elif stat.S_ISREG(st.st_mode):
+                    files[name] = True
+        return True
+
+    def remove_tree(self, top):
+        """Removes a directory and everything under it from the tree."""
+        pending = [top]
+        while pending:
+            dir = pending.pop()
+            node = self.dirs.get(dir)
+            if node is None:
+                continue
+            del self.dirs[dir]
+            if self.inodes.get(node[3]) == dir:
+                del self.inodes[node[3]]
+            self.unwatch(dir)
+            for name in node[1].keys():
+                pending.append(os.path.join(dir, name))
+
+    def add_entry(self, dir, name):
+        """Adds (or replaces) the named entry of a directory in the tree."""
+        self.remove_entry(dir, name)
+        path = os.path.join(dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if stat.S_ISDIR(st.st_mode):
+            if self.add_tree(path):
+                self.dirs[dir][1][name] = True
+        elif stat.S_ISREG(st.st_mode):
+            self.dirs[dir][2][name] = True
+
+    def remove_entry(self, dir, name):
+        """Removes the named entry of a directory from the tree."""
+        subdirs, files = self.dirs[dir][1:3]
+        if files.has_key(name):
+            del files[name]
+        if subdirs.has_key(name):
+            del subdirs[name]
+            self.remove_tree(os.path.join(dir, name))
+
+    def refresh(self, dir):
+        """Lists a directory again if it has changed since it was last listed.
+        This is only needed for directories that aren't being watched.
+        """
+        node = self.dirs[dir]
+        try:
+            mtime = os.stat(dir).st_mtime
+        except OSError:
+            return
+        if mtime == node[0]:
+            return
+        node[0] = mtime
+        try:
+            names = os.listdir(dir)
+        except OSError:
+            names = []
+        present = {}
+        for name in names:
+            present[name] = True
+            if not node[1].has_key(name) and not node[2].has_key(name):
+                self.add_entry(dir, name)
+        for name in node[1].keys() + node[2].keys():
+            if not present.has_key(name):
+                self.remove_entry(dir, name)
+
+    def watch(self, dir):
+        if self.inotify is None:
+            return
+        wd = _inotify_add_watch(self.inotify, dir, WATCH_MASK)
+        if wd < 0:
+            if not self.polling:
+                data.log(Log.WARNING, 'Cannot watch "%s" for changes (%s); '
+                         'directory times will be checked instead.' %
+                         (dir, os.strerror(ctypes.get_errno())))
+                self.polling = True
+            return
+        self.watches[wd] = dir
+        self.watched[dir] = wd
+
+    def unwatch(self, dir):
+        wd = self.watched.get(dir)
+        if wd is None:
+            return
+        del self.watched[dir]
+        if self.watches.get(wd) == dir:
+            del self.watches[wd]
+            _inotify_rm_watch(self.inotify, wd)
+
+    #---------- answering questions ----------#
+
+    def resolve(self, path):
+        """Returns the pathname of a directory in the tree, given its pathname
+        (or its pathname relative to the music root).
+
+        Raises ValueError if there is no such directory in the tree.
+        """
+        path = os.path.normpath(os.path.join(self.root, path))
+        if not self.dirs.has_key(path):
+            raise ValueError('No such directory in the music library: %s' %
+                             path)
+        return path
+
+    def check_ready(self):
+        if not self.root:
+            raise ValueError('The music library is not available, because '
+                             'moosicd was started without --music-root.')
+        if not self.ready:
+            raise ValueError('The music library is still being listed; try '
+                           'again later.')
+
+    def list(self, dir=''):
+        """Returns the sorted names of the subdirectories and the files in a
+        directory.
+        """
+        self.check_ready()
+        self.lock.acquire()
+        try:
+            dir = self.resolve(dir)
+            if self.polling:
+                self.refresh(dir)
+            subdirs = self.dirs[dir][1].keys()
+            files = self.dirs[dir][2].keys()
+        finally:
+            self.lock.release()
+        subdirs.sort()
+        files.sort()
+        return subdirs, files
+
+    def expand(self, top=''):
+        """Returns the pathnames of all the files in a directory and in the
+        directories under it.  Within each directory, the files come first (in
+        sorted order), followed by the contents of each subdirectory (in sorted
+        order).
+        """
+        self.check_ready()
+        self.lock.acquire()
+        try:
+            result = []
+            pending = [self.resolve(top)]
+            while pending:
+                dir = pending.pop()
+                if self.polling:
+                    self.refresh(dir)
+                    if not self.dirs.has_key(dir):
+                        continue
+                mtime, subdirs, files = self.dirs[dir][:3]
+                names = files.keys()
+                names.sort()
+                prefix = os.path.join(dir, '')
+                result.extend([prefix + name for name in names])
+                names = subdirs.keys()
+                names.sort()
+                names.reverse()
+                pending.extend([prefix + name for name in names])
+            return result
+        finally:
+            self.lock.release()
+
+    def match(self, regex):
+        """Returns the pathnames of all the files in the library that match a
+        regular expression, in the same order as expand().
+        """
+        return grep(regex, self.expand())
+
+
+# This is the tree of the music library that is used by the server methods.
+library = LibraryTree()
@@ -25,7 +25,7 @@
 # 
 # For more information, please refer to <http://unlicense.org/>
 
-import sys, os, os.path, string, time, threading, re
+import sys, os, os.path, time, threading
 import socket, signal, atexit
 import cPickle as pickle
 from moosic import VERSION
@@ -53,8 +53,12 @@ except NameError: False = 0
 #
 # The song player also represents a separate subprocess, since it forks off to
 # spawn a player program, but this runs in series with the queue consumer and
-# blocks until its child returns, so it is considered part of the queue
-# consumer's thread.
+# sleeps until its child exits, so it is considered part of the queue
+# consumer's thread.  Rather than blocking in waitpid(), the queue consumer is
+# woken up by SIGCHLD and reaps the player without blocking (see the
+# SpawnBackend class in the moosic.server.player module).  Alternatively, a
+# song may be played by a long-lived player program that is controlled through
+# a pipe (see the RemoteControlBackend class).
 #
 # Finally, each time the request handler receives a request, it creates a new
 # thread to execute the request so that multiple requests can be processed
@@ -67,20 +71,38 @@ except NameError: False = 0
 # properly return a response to the client even if the other threads have
 # terminated.
 
+# File descriptors of the process that calls main() which the daemon should
+# close as soon as it has been forked, such as the socket through which
+# moosic.client.factory.startServer() waits for the daemon to become ready.
+daemon_close_fds = []
+
 #---------- the request handler ----------#
 # The logic for actually handling specific requests is implemented by the
 # moosicd_methods object, which is initialized in the moosic.server.methods
 # module.  The rest of the request handler is implemented by classes in the
 # moosic.server.support module, UnixMoosicServer and TcpMoosicServer, which are
 # minor adaptations of classes from the Python standard library.
+#
+# Alternatively, when the --event-loop option is used, a single request handler
+# thread serves every listening socket at once.  This is implemented by the
+# EventLoop class in the moosic.server.eventloop module.
 from moosic.server.methods import moosicd_methods
 from moosic.server.support import *
+from moosic.server.eventloop import EventLoop, FLUSH_TIMEOUT
+from moosic.server.player import find_command, backend_for, \
+                                 shutdown_backends, gap_timer, spawner
+from moosic.server.prefetch import prefetcher
+from moosic.server.library import library
+from moosic.server.stats import stats
 
 def request_handler(server):
     try:
         server.serve_forever()
     except socket.error, e:
+        if data.quitFlag:
+            sys.exit() # The servers were closed because moosicd is quitting.
         data.quitFlag = True  # Tell the queue consumer to quit.
+        data.queue_wakeup.notify()
         import errno
         if e[0] == errno.EINTR:
             sys.exit() # Ignore "Interrupted system call" exceptions.
@@ -92,69 +114,22 @@ def request_handler(server):
 def play(config, songname):
     """Plays a single music file, and returns when it's over.
     """
-    # Match the songname against the regexps in our filetype association table.
-    command = None
-    for regex, cmd in config:
-        match = regex.search(songname)
-        if match:
-            command = cmd[:]
-            break
-    if not command:
-        data.log(Log.NOTICE, 'No player could be found for "%s".' % songname)
-        data.ignore_song_finish = True
-        return
-    did_replacement = False
-    for i in range(len(command)):
-        # Replace occurrences of "$item" in the command list.
-        replaced = re.sub(r'\$item', songname, command[i])
-        if command[i] != replaced:
-            command[i] = replaced
-            did_replacement = True
-        # Replace references to match groups in the command list.
-        replaced = match.expand(command[i])
-        if command[i] != replaced:
-            command[i] = replaced
-            did_replacement = True
-    if not did_replacement:
-        command.append(songname)
-    # I forget why I'm flushing stdout here, but it can't hurt. Can it?
-    sys.stdout.flush()
-    # Classic fork & exec to spawn the external player.
-    # Portability note: os.fork() is only available on Unix systems.
-    data.player_pid = os.fork()
-    if data.player_pid == 0:
-        # We don't want the program to grab input.
-        fd = os.open('/dev/null', os.O_RDONLY)
-        os.dup2(fd, sys.__stdin__.fileno())
-        os.close(fd)
-        # Open up a file for logging the command's output.
-        try:
-            logfilename = os.path.join(data.confdir, 'player_log')
-            if os.path.exists(logfilename):
-                buffering = 1  # Use line-buffered output.
-                logfile = open(logfilename, 'a', buffering)
-            else:
-                buffering = 1  # Use line-buffered output.
-                logfile = open(logfilename, 'w', buffering)
-            # Delimit each entry in the log file with a time-stamped message.
-            now = time.strftime('%I:%M:%S%p', time.localtime(time.time()))
-            logfile.write('%s Executing "%s"\n' % (now, string.join(command)))
-            logfile.flush()
-            # Capture the program's standard error stream.
-            os.dup2(logfile.fileno(), sys.__stderr__.fileno())
-            # Capture the program's standard output stream.
-            os.dup2(logfile.fileno(), sys.__stdout__.fileno())
-        except IOError, e:
-            data.log(Log.ERROR,
-              'Cannot open player log file "%s": %s' % (e.songname, e.strerror))
-        # Execute the command.
-        try:
-            os.execvp(command[0], command)
-        except StandardError, e:
-            print 'Could not execute "%s": %s' % (' '.join(command), e)
+    # Use the player that was prepared ahead of time (in pre-roll mode) if
+    # possible, and find the right backend for the song otherwise.
+    if spawner.release(config, songname):
+        backend = spawner
     else:
-        os.waitpid(data.player_pid, 0)
-        data.player_pid = None
+        command = find_command(config, songname)
+        if not command:
+            data.log(Log.NOTICE, 'No player could be found for "%s".' % songname)
+            data.ignore_song_finish = True
+            return
+        backend = backend_for(command)
+        if not backend:
+            data.ignore_song_finish = True
+            return
+        backend.play(songname, command)
+    backend.wait(idle=spawner.prepare)
 
 
 #---------- the queue consumer ----------#
@@ -171,12 +146,14 @@ def queue_consumer():
             try:
                 # Pop a song off of the playlist.
                 data.current_song = data.song_queue.pop(0)
+                prefetcher.song_started(data.current_song)
                 # Update internal state variables.
                 data.last_queue_update = time.time()
                 data.song_start_event = time.time()
                 data.current_paused_time = 0
             finally:
                 data.lock.release()
+            data.queue_changed.notify()
 
             # Play the song.
             data.log(Log.NOTICE, 'Started playing ' + data.current_song)
@@ -200,6 +177,7 @@ def queue_consumer():
                     if data.loop_mode:
                         data.song_queue.append(data.current_song)
                         data.last_queue_update = time.time()
+                        data.queue_changed.notify()
                     # Update the history to reflect the fact that the song was
                     # played.
                     data.history.append((data.current_song,
@@ -212,7 +190,12 @@ def queue_consumer():
             finally:
                 data.lock.release()
         else:
-            time.sleep(0.05)
+            # Sleep until something happens that might let us start playing a
+            # song (or tell us to quit).  This doesn't use any CPU time, and it
+            # lets a newly added song start playing immediately.
+            spawner.discard()
+            gap_timer.reset()  # Idle time isn't a gap between songs.
+            data.queue_wakeup.wait()
 
 
 def handleOptions(argv, defaultOpts):
@@ -220,9 +203,11 @@ def handleOptions(argv, defaultOpts):
     import getopt
     opts = defaultOpts.copy()
     try:
-        options, arglist = getopt.getopt(argv, 'hvqds:c:St:T:fl', ['help',
+        options, arglist = getopt.getopt(argv, 'hvqds:c:St:T:flepP:b:AJR:m:', ['help',
                 'version', 'quiet', 'debug', 'history-size=', 'config=',
-                'stdout', 'tcp=', 'tcp-also=', 'foreground', 'local-only'])
+                'stdout', 'tcp=', 'tcp-also=', 'foreground', 'local-only',
+                'event-loop', 'preroll', 'prefetch=', 'prefetch-budget=',
+                'async-log', 'json-log', 'log-size=', 'music-root='])
     except getopt.GetoptError, e:
         sys.exit('Option processing error: %s' % e)
     for opt, val in options:
@@ -247,6 +232,31 @@ def handleOptions(argv, defaultOpts):
         -l, --local-only    Only listen for TCP connections that originate from
                             the local computer.  This only has an effect when
                             --tcp or --tcp-also is used.
+        -e, --event-loop    Serve all client connections from a single thread
+                            using non-blocking I/O, instead of using a thread
+                            for each listening socket.
+        -p, --preroll       Prepare the player for the next song while the
+                            current song is playing, to shorten the gap
+                            between songs.
+        -P, --prefetch <num> Read ahead the next <num> local files in the queue
+                            so that they start playing without delay.
+                            (Default: 0, which turns prefetching off)
+        -b, --prefetch-budget <megabytes> The maximum amount of data to read
+                            ahead for all of the prefetched files together.
+                            (Default: 64)
+        -A, --async-log     Write log messages from a separate thread, so that
+                            the rest of the server never waits for the log
+                            file.  Messages may be dropped if they arrive
+                            faster than they can be written.
+        -J, --json-log      Write each log message as a JSON object on a line
+                            of its own, instead of as plain text.
+        -R, --log-size <megabytes> Start a new server log file when the current
+                            one reaches the given size, keeping 3 old ones.
+                            (Default: 0, which never starts a new file)
+        -m, --music-root <dir> Keep a list of the files in the given directory
+                            in memory, up to date with any changes made to it,
+                            and let clients look through it with the library
+                            methods.
         -f, --foreground    Stay in the foreground instead of detaching from the
                             current terminal and going into the background.
         -q, --quiet         Don't print any informational messages.
@@ -297,6 +307,35 @@ warranty; not even for MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE."""
                 print 'Warning: %s. This option has been ignored.' % e
         if opt == '-l' or opt == '--local-only':
             opts['local-only'] = True
+        if opt == '-e' or opt == '--event-loop':
+            opts['event-loop'] = True
+        if opt == '-p' or opt == '--preroll':
+            opts['preroll'] = True
+        if opt == '-P' or opt == '--prefetch':
+            try:
+                opts['prefetch items'] = int(val)
+            except ValueError, e:
+                print 'Warning: %s. This option has been ignored.' % e
+        if opt == '-b' or opt == '--prefetch-budget':
+            try:
+                opts['prefetch budget'] = int(float(val) * 1024 * 1024)
+            except ValueError, e:
+                print 'Warning: %s. This option has been ignored.' % e
+        if opt == '-A' or opt == '--async-log':
+            opts['async log'] = True
+        if opt == '-J' or opt == '--json-log':
+            opts['json log'] = True
+        if opt == '-R' or opt == '--log-size':
+            try:
+                opts['log size'] = int(float(val) * 1024 * 1024)
+            except ValueError, e:
+                print 'Warning: %s. This option has been ignored.' % e
+        if opt == '-m' or opt == '--music-root':
+            if os.path.isdir(val):
+                opts['music root'] = os.path.realpath(val)
+            else:
+                print 'Warning: %s is not a directory. This option has been ' \
+                      'ignored.' % val
     if arglist:
         print 'Warning: non-option command line arguments are ignored.'
     return opts
@@ -311,6 +350,14 @@ def main(argv):
                'ip-socket':False,
                'tcp-port':None,
                'local-only':False,
+               'event-loop':False,
+               'preroll':False,
+               'prefetch items':prefetcher.items,
+               'prefetch budget':prefetcher.budget,
+               'async log':False,
+               'json log':False,
+               'log size':0,
+               'music root':data.music_root,
                'verbosity':Log.NOTICE,
                'max hist size':data.max_hist_size,
                'confdir':data.confdir }
@@ -332,15 +379,17 @@ def main(argv):
     try:
         if options['log to stdout']:
             logfile = sys.stdout
-        elif os.path.exists(logfilename):
-            buffering = 1  # Use line-buffered output.
-            logfile = open(logfilename, 'a', buffering)
         else:
-            buffering = 1  # Use line-buffered output.
-            logfile = open(logfilename, 'w', buffering)
+            # The file is flushed after every write, and is replaced by a
+            # new one whenever it grows past the requested size.
+            logfile = RotatingFile(logfilename, options['log size'], 3)
+            logfile.open()
     except IOError, e:
         sys.exit('Cannot open server log file "%s": %s' % (logfilename, e.strerror))
-    data.log = Log(logfile, options['verbosity'])
+    if options['async log']:
+        data.log = AsyncLog(logfile, options['verbosity'], options['json log'])
+    else:
+        data.log = Log(logfile, options['verbosity'], options['json log'])
     data.log(Log.NOTICE, "Starting up.")
 
     # Load previously saved state data, if any.
@@ -436,12 +485,18 @@ def main(argv):
 
     # Daemonize (go into the background, detach from the terminal, etc.).
     if options['daemonize']:
+        # Don't leave any queued log messages behind in the parent process.
+        data.log.flush()
         daemonize(stderr=logfilename)
+        for fd in daemon_close_fds:
+            try: os.close(fd)
+            except OSError: pass
         data.log(Log.NOTICE, "Transformed into a daemon with PID: %d" % (os.getpid()))
 
     # Set up a timer to automatically save state at regular intervals.
     def savestate():
         "Save the Moosic server's current state to disk."
+        start = time.time()
         try:
             savefilename = os.path.join(data.confdir, 'saved_state')
             pickle.dump(data.getstate(), open(savefilename, 'w'))
@@ -452,6 +507,8 @@ def main(argv):
         except PicklingError, e:
             data.log(Log.WARNING,
               'Pickling error: %s\nCannot save state.' % (e))
+        else:
+            stats.record('save state', time.time() - start)
 
     def save_timer(prev_update):
         if data.last_queue_update != prev_update: # Don't bother waking up the
@@ -460,6 +517,8 @@ def main(argv):
         t = threading.Timer(300, save_timer, args=(data.last_queue_update,))
         t.setDaemon(True)
         t.start()
+        save_timers[:] = [t]
+    save_timers = []
     save_timer(0)
 
     # Set up the signal handlers and exit handler.
@@ -480,42 +539,89 @@ def main(argv):
     signal.signal(signal.SIGTERM, quit)
     signal.signal(signal.SIGUSR1, quit)
     signal.signal(signal.SIGUSR2, quit)
+    # Wake up the queue consumer whenever a song player exits.
+    spawner.install()
+    spawner.preroll = options['preroll']
 
     def cleanup():
         '''This function is called to perform any cleanup which needs to be done
         when moosicd shuts down.
         '''
         data.log(Log.NOTICE, "Shutting down (PID: %d)." % (os.getpid()))
-        # Don't accept any more requests.
+        data.quitFlag = True
+        # Don't accept any more requests, but let the event loop finish sending
+        # the responses that it has queued up (such as the response to die())
+        # before its sockets are closed.
+        if event_loop:
+            event_loop.shutdown()
+            for t in request_threads:
+                t.join(FLUSH_TIMEOUT + 1.0)
         try:
             data.moosic_server.server_close()
             data.extra_moosic_server.server_close()
         except: pass
+        # Give the request handler threads a moment to notice that their
+        # servers are closed, so that they don't wake up in the middle of the
+        # interpreter's own shutdown.
+        for t in request_threads:
+            t.join(1.0)
         # Don't leave unused socket files around.
         if isinstance(data.moosic_server, UnixMoosicServer):
             try: os.remove(data.moosic_server.server_address)
             except: pass
-        # Save our current state to disk.
+        # Save our current state to disk, and stop the timer that does this
+        # periodically so that it doesn't wake up while the interpreter is
+        # being torn down.
+        for t in save_timers:
+            t.cancel()
+            t.join(1.0)
         savestate()
-        # Kill the song player.
-        if data.current_song:
-            try: os.kill(data.player_pid, signal.SIGTERM)
-            except: pass
+        # Kill the song players.
+        shutdown_backends()
+        # Write out any log messages that are still waiting in the queue.
+        data.log.close()
     atexit.register(cleanup)
 
-    # Run the request handler in a separate thread.
-    t = threading.Thread(target=request_handler, args=(data.moosic_server,))
-    t.setDaemon(True)
-    t.start()
+    request_threads = []
+    event_loop = None
+    if options['event-loop']:
+        # Run a single request handler for all servers in a separate thread.
+        servers = [data.moosic_server]
+        if data.extra_moosic_server is not data.moosic_server:
+            servers.append(data.extra_moosic_server)
+        event_loop = EventLoop(servers)
+        request_threads.append(threading.Thread(target=request_handler,
+                                                args=(event_loop,)))
+    else:
+        # Run the request handler in a separate thread.
+        request_threads.append(threading.Thread(target=request_handler,
+                                                args=(data.moosic_server,)))
+        # Start a second request handler if we are serving requests from two
+        # different transport methods.
+        if data.extra_moosic_server is not data.moosic_server:
+            request_threads.append(threading.Thread(target=request_handler,
+                                            args=(data.extra_moosic_server,)))
+    for t in request_threads:
+        t.setDaemon(True)
+        t.start()
 
-    # Start a second request handler if we are serving requests from two
-    # different transport methods.
-    if data.extra_moosic_server is not data.moosic_server:
-        t = threading.Thread(target=request_handler,
-                             args=(data.extra_moosic_server,))
+    # Start the prefetcher, if it's wanted.
+    prefetcher.items = options['prefetch items']
+    prefetcher.budget = options['prefetch budget']
+    if prefetcher.items > 0:
+        t = threading.Thread(target=prefetcher.run)
         t.setDaemon(True)
         t.start()
 
+    # Start keeping track of the music library, if there is one.
+    data.music_root = options['music root']
+    if data.music_root:
+        library.start(data.music_root)
+
+    # Let whoever started us (e.g. a client that started us automatically, or
+    # systemd) know that requests are being handled now.
+    notify_service_manager('READY=1\nMAINPID=%d' % os.getpid())
+
     # Run the queue consumer.
     queue_consumer()
 
@@ -26,10 +26,11 @@
 # For more information, please refer to <http://unlicense.org/>
 
 API_MAJOR_VERSION = 1
-API_MINOR_VERSION = 8
+API_MINOR_VERSION = 9
 
 # Import from the standard library.
-import xmlrpclib, time, os, signal, random, re, errno, operator
+import xmlrpclib, time, sys, random, re, operator
+import threading
 from xmlrpclib import Boolean, Binary, True, False
 
 # Define the True and False constants if they don't already exist.
@@ -45,9 +46,55 @@ import moosic.utilities
 from moosic.utilities import grep, antigrep, splitpath, is_overlapping
 import moosic.server.support
 from moosic.server.support import data, Log, split_range
+from moosic.server.stats import stats
+from moosic.server.prefetch import prefetcher
+from moosic.server.library import library
+from moosic.server.profiler import method_profiler
 from moosic import VERSION
 
 moosicd_methods = xmlrpc_registry.Registry()
+moosicd_methods.set_observer(stats.method_called)
+moosicd_methods.set_profiler(method_profiler)
+
+
+def notify_queue_change():
+    '''Wakes up the parts of moosicd that keep an eye on the song queue.
+
+    This should be called (after releasing data.lock) by every method that
+    modifies the song queue.
+    '''
+    data.queue_wakeup.notify()
+    data.queue_changed.notify()
+
+
+def server_stats(result):
+    '''Adds the statistics that describe the server's current state to a
+    snapshot of the moosic.server.stats object.
+    '''
+    data.lock.acquire()
+    try:
+        queue = data.song_queue[:]
+        result['queue'] = {'history length': len(data.history)}
+        if data.song_gap is not None:
+            result['song gap'] = data.song_gap
+    finally:
+        data.lock.release()
+    # Measure the queue after releasing the lock, since this takes time in
+    # proportion to the length of the queue.
+    memory = sys.getsizeof(queue) + reduce(operator.add,
+                                           map(sys.getsizeof, queue), 0)
+    result['queue']['length'] = len(queue)
+    result['queue']['memory'] = float(memory)
+    result['counters']['prefetch hits'] = prefetcher.hits
+    result['counters']['prefetch misses'] = prefetcher.misses
+    result['process'] = {'threads': threading.activeCount()}
+    try:
+        import resource
+        result['process']['max rss'] = \
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        pass
+stats.add_source(server_stats)
 
 
 def insert(items, position):
@@ -73,6 +120,7 @@ def insert(items, position):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(insert, [[BOOLEAN, ARRAY, INT]])
 
@@ -100,6 +148,7 @@ def replace(items):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(replace, [[BOOLEAN, ARRAY]])
 
@@ -136,6 +185,7 @@ def replace_range(range, items):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(replace, [[BOOLEAN, ARRAY]])
 
@@ -181,6 +231,7 @@ def clear():
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(clear, [[BOOLEAN]])
 
@@ -216,6 +267,7 @@ def sub_all(pattern, replace, range=()):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(sub_all, 
         [[BOOLEAN, BASE64, BASE64], [BOOLEAN, BASE64, BASE64, ARRAY]])
@@ -252,6 +304,7 @@ def sub(pattern, replace, range=()):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(sub, 
         [[BOOLEAN, BASE64, BASE64], [BOOLEAN, BASE64, BASE64, ARRAY]])
@@ -280,6 +333,7 @@ def shuffle(range=()):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(shuffle, [[BOOLEAN], [BOOLEAN, ARRAY]])
 
@@ -307,6 +361,7 @@ def sort(range=()):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(sort, [[BOOLEAN], [BOOLEAN, ARRAY]])
 
@@ -334,6 +389,7 @@ def reverse(range=()):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(reverse, [[BOOLEAN], [BOOLEAN, ARRAY]])
 
@@ -351,6 +407,7 @@ def putback():
         finally:
             data.last_queue_update = time.time()
             data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(putback, [[BOOLEAN]])
 
@@ -477,6 +534,7 @@ def run_queue():
         data.qrunning = True
     finally:
         data.lock.release()
+    data.queue_wakeup.notify()
     return True
 moosicd_methods.register(run_queue, [[BOOLEAN]])
 runqueue = run_queue
@@ -491,11 +549,9 @@ def pause():
     '''
     data.lock.acquire()
     try:
-        if data.current_song and data.player_pid:
+        if data.current_song and data.player:
             try:
-                os.kill(data.player_pid, signal.SIGTSTP)
-                time.sleep(0.10)
-                os.kill(data.player_pid, signal.SIGSTOP)
+                data.player.pause()
             except OSError, e:
                 e.strerror += ' (in method "pause")'
                 raise e
@@ -517,15 +573,12 @@ def unpause():
     '''
     data.lock.acquire()
     try:
-        if data.current_song and data.player_pid:
+        if data.current_song and data.player:
             try:
-                os.kill(data.player_pid, signal.SIGCONT)
+                data.player.unpause()
             except OSError, e:
-                if e.errno == errno.ESRCH:
-                    data.player_pid = None
-                else:
-                    e.strerror += ' (in method "unpause")'
-                    raise e
+                e.strerror += ' (in method "unpause")'
+                raise e
             if data.paused == True:
                 data.current_paused_time += (time.time() - data.last_pause_event)
                 #data.start_stop_times.append( -time.time() )  # old algorithm
@@ -544,7 +597,7 @@ def toggle_pause():
     '''
     data.lock.acquire()
     try:
-        if data.current_song and data.player_pid:
+        if data.current_song and data.player:
             if data.paused:
                 unpause()
             else:
@@ -621,29 +674,22 @@ def skip():
     Arguments: None.
     Return value: Nothing meaningful.
     '''
-    if data.current_song and data.player_pid:
-        # ogg123 behaves very stupidly when it gets a TERM signal, so it needs
-        # to be handled specially. This logic for determining when to apply this
-        # special case is complicated, and interferes with readability, and is
-        # yucky and evil and sloppy, and makes assumptions which are not
-        # necessarily true. I hate you, ogg123.
-        command = None
-        for regex, cmd in data.config:
-            if regex.search(data.current_song):
-                command = cmd[:]
-                break
-        try:
-            if command and command[0] == 'ogg123':
-                os.kill(data.player_pid, signal.SIGINT)
-            else:
-                os.kill(data.player_pid, signal.SIGTERM)
-        except OSError, e:
-            e.strerror += ' (in method "skip")'
-            raise e
-        # Unpause the song player, so that termination takes place right away
-        # (instead of having to wait until the song player somehow happens to
-        # receive a CONT signal).
-        unpause()
+    # Hold the lock so that the player can't finish (and be reaped, letting its
+    # process ID be reused) while we are telling it to stop.
+    data.lock.acquire()
+    try:
+        if data.current_song and data.player:
+            try:
+                data.player.stop()
+            except OSError, e:
+                e.strerror += ' (in method "skip")'
+                raise e
+            # Unpause the song player, so that termination takes place right
+            # away (instead of having to wait until the song player somehow
+            # happens to receive a CONT signal).
+            unpause()
+    finally:
+        data.lock.release()
     return True
 moosicd_methods.register(skip, [[BOOLEAN]])
 
@@ -679,6 +725,7 @@ def next(howmany=1):
         if queue_was_running:
             run_queue()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(next, [[BOOLEAN], [BOOLEAN, INT]])
 
@@ -710,6 +757,7 @@ def previous(howmany=1):
         if queue_was_running:
             run_queue()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(previous, [[BOOLEAN], [BOOLEAN, INT]])
 
@@ -756,6 +804,7 @@ def remove(regexp, range=()):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(remove, [[BOOLEAN, BASE64], [BOOLEAN, BASE64, ARRAY]])
 
@@ -785,6 +834,7 @@ def filter_(regexp, range=()):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(filter_, [[BOOLEAN, BASE64], [BOOLEAN, BASE64, ARRAY]], 'filter')
 
@@ -825,6 +875,7 @@ def move(range, dest):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(move, [[BOOLEAN, ARRAY, INT]])
 
@@ -859,6 +910,7 @@ def move_list(indices, dest):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(move_list, [[BOOLEAN, ARRAY, INT]])
 
@@ -896,6 +948,7 @@ def swap(range_A, range_B):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(swap, [[BOOLEAN, ARRAY, ARRAY]])
 
@@ -920,6 +973,7 @@ def cut(range):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(cut, [[BOOLEAN, ARRAY]])
 
@@ -944,6 +998,7 @@ def cut_list(indices):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(cut_list, [[BOOLEAN, ARRAY]])
 
@@ -968,6 +1023,7 @@ def crop(range):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(crop, [[BOOLEAN, ARRAY]])
 
@@ -985,6 +1041,7 @@ def crop_list(indices):
     finally:
         data.last_queue_update = time.time()
         data.lock.release()
+    notify_queue_change()
     return True
 moosicd_methods.register(crop_list, [[BOOLEAN, ARRAY]])
 
@@ -1054,6 +1111,7 @@ def die():
     Return value: Nothing meaningful.
     '''
     data.quitFlag = True  # Tell the queue consumer to quit.
+    data.queue_wakeup.notify()
     if data.current_song:
         data.ignore_song_finish = True
     skip()  # Stop the current song.
@@ -1210,6 +1268,156 @@ def last_queue_update():
 moosicd_methods.register(last_queue_update, [[DOUBLE]])
 
 
+def stats_():
+    '''Returns statistics about the server's activity since it started.
+ 
+    This method is intended for keeping an eye on the performance of the
+    server.  The statistics are always being gathered, so calling this method
+    has no effect on the server other than the cost of the call itself.
+    
+    Arguments: None.
+    Return value: A struct with the following members:
+      * "uptime": the number of seconds since the server started.
+      * "methods": a struct that maps the name of each method that has been
+        called to a histogram of the durations of the calls.
+      * "timers": a struct of histograms of other durations, including "data
+        lock wait" and "data lock hold" (the time spent waiting for and holding
+        the server's main lock), "player spawn" (the time taken to start a song
+        player), "song gap" (the silence between consecutive songs), and "save
+        state" (the time taken to save the server's state to disk).
+      * "counters": a struct of event counts, such as "prefetch hits" and
+        "prefetch misses", and "log messages dropped".
+      * "transports": a struct that maps each kind of socket ("unix" or "tcp")
+        to a struct with the number of "requests" received through it, and the
+        number of "bytes in" and "bytes out" of the requests and responses.
+      * "queue": a struct with the "length" of the song queue, a rough
+        estimate of the "memory" (in bytes, as a double) taken up by it, and
+        the length of the history list ("history length").
+      * "process": a struct with the peak resident memory of the server in
+        kilobytes ("max rss"), and its number of "threads".
+      * "song gap": the most recently measured gap between songs, in seconds,
+        if there has been one.
+    Each histogram is a struct with the members "count" (the number of
+    durations), "errors" (the number of failed method calls), "total", "mean",
+    "max", "p50", "p90", and "p99" (all in seconds), and "buckets", which is an
+    array of [upper bound in seconds, count] pairs.
+    '''
+    return stats.snapshot()
+moosicd_methods.register(stats_, [[STRUCT]], 'stats')
+
+
+def profile_start(methods=(), mode='cprofile'):
+    '''Starts profiling calls to some of the server's methods.
+ 
+    This is intended for finding out why certain calls are slow on a running
+    server.  Profiling continues until profile_stop() is called.  If profiling
+    was already in progress, whatever it collected is thrown away.
+    
+    Arguments: Either none, or an array of method names (strings), optionally
+        followed by a string that selects the kind of profiling.
+      * If no method names are given (or the array is empty), every method is
+        profiled.
+      * The kind of profiling is either "cprofile" (the default), which
+        accounts for every function call made by the profiled methods, but
+        slows them down considerably, or "sample", which periodically looks at
+        what the profiled methods are doing, and slows them down very little.
+    Return value: Nothing meaningful.
+    '''
+    names = []
+    for name in methods:
+        if hasattr(name, 'data'):
+            name = str(name.data)
+        names.append(name)
+    if hasattr(mode, 'data'):
+        mode = str(mode.data)
+    known = moosicd_methods.system_listMethods()
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        raise ValueError('No such method: %s' % ', '.join(unknown))
+    method_profiler.start(names, mode)
+    data.log(Log.NOTICE, 'Started %s profiling of %s.' %
+             (mode, ', '.join(names) or 'all methods'))
+    return True
+moosicd_methods.register(profile_start, [[BOOLEAN], [BOOLEAN, ARRAY],
+                                         [BOOLEAN, ARRAY, STRING]])
+
+
+def profile_stop():
+    '''Stops profiling, and returns a report of what was collected.
+ 
+    Arguments: None.
+    Return value: A (base64-encoded) string that contains the report.
+      * For "cprofile" profiling, the report is a table of the functions that
+        took up the most time, as printed by the pstats module.
+      * For "sample" profiling, each line of the report is a call stack, with
+        the frames separated by semicolons, followed by a space and the number
+        of times that the stack was seen (the "folded" format read by flame
+        graph tools).  The number of calls and samples is logged instead.
+      * If no profiling was in progress, an error occurs.
+    '''
+    report = method_profiler.stop()
+    if report is None:
+        raise ValueError('No profiling is in progress.')
+    data.log(Log.NOTICE, 'Stopped profiling: %s.' % method_profiler.summary)
+    return Binary(report)
+moosicd_methods.register(profile_stop, [[BASE64]])
+
+
+def library_list(dir=''):
+    '''Lists a directory in the music library.
+ 
+    The music library is the directory given to moosicd with the --music-root
+    option, which moosicd keeps a list of in memory.  These library methods
+    fail if no music root was given, or if moosicd is still making the list
+    (which happens once, when it starts).
+    
+    Arguments: The name of a directory in the music library, relative to the
+        music root (absolute names within the music root are accepted too).
+      * If no directory is given, the music root itself is listed.
+    Return value: An array of two arrays: the (sorted) names of the
+        subdirectories in the given directory, and the (sorted) names of the
+        files in it.
+    '''
+    if hasattr(dir, 'data'):
+        dir = dir.data
+    subdirs, files = library.list(dir)
+    return [[Binary(name) for name in subdirs],
+            [Binary(name) for name in files]]
+moosicd_methods.register(library_list, [[ARRAY], [ARRAY, BASE64]])
+
+
+def library_expand(dir=''):
+    '''Lists all the files in a directory of the music library, and in all of
+    its subdirectories.
+ 
+    Arguments: The name of a directory in the music library (see
+        library_list).
+      * If no directory is given, all the files in the music library are
+        listed.
+    Return value: An array of the full pathnames of the files.  The files in
+        each directory are listed in sorted order, followed by the contents of
+        each of its subdirectories, in sorted order.
+    '''
+    if hasattr(dir, 'data'):
+        dir = dir.data
+    return [Binary(path) for path in library.expand(dir)]
+moosicd_methods.register(library_expand, [[ARRAY], [ARRAY, BASE64]])
+
+
+def library_match(regexp):
+    '''Lists the files in the music library that match a regular expression.
+ 
+    Arguments: A regular expression that is matched against the full pathname
+        of every file in the music library.
+    Return value: An array of the full pathnames of the matching files, in the
+        same order as library_expand().
+    '''
+    if hasattr(regexp, 'data'):
+        regexp = regexp.data
+    return [Binary(path) for path in library.match(regexp)]
+moosicd_methods.register(library_match, [[ARRAY, BASE64]])
+
+
 # The following additions make the proxy objects for the server act like normal
 # Python objects when subjected to certain common operations.
 
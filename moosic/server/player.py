@@ -0,0 +1,1006 @@
+# moosic/server/player.py - spawning and supervising the song players of moosicd
+#
+# This is free and unencumbered software released into the public domain.
+# 
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+# 
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# 
+# For more information, please refer to <http://unlicense.org/>
+
+
+"""Spawning and supervising the song players of moosicd.
+
+The song player is the external program that moosicd uses to play each item in
+the song queue.  This module finds the right command for an item, runs it, and
+keeps track of it until the item is over.
+
+Songs are played by player backends.  Normally, the SpawnBackend runs a new
+player program for each song.  If the command in the configuration file starts
+with "@remote", then a RemoteControlBackend keeps the rest of the command
+running as a long-lived player program (such as "mpg123 -R"), and tells it to
+play each song by writing a command to its standard input.  If the command
+is "@playlist", then the PlaylistBackend reads the item as an M3U or PLS
+playlist, and puts the items that it lists into the song queue in its place.
+"""
+
+import sys, os, re, string, time, signal, errno, fcntl, select, threading
+import subprocess
+
+from moosic.server.support import data, Log, WakeupPipe, RotatingFile
+from moosic.server import spawn
+from moosic.server.playlist import read_playlist
+from moosic.server.stats import stats
+
+# Define the True and False constants if they don't already exist.
+try: True
+except NameError: True = 1
+try: False
+except NameError: False = 0
+
+__all__ = ('find_command', 'OutputCollector', 'PlayerLauncher', 'spawn_player',
+           'describe_exit', 'describe_returncode',
+           'GapTimer',
+           'PlayerBackend', 'SpawnBackend', 'RemoteControlBackend',
+           'PlaylistBackend',
+           'backend_for', 'shutdown_backends', 'gap_timer', 'spawner')
+
+
+def find_command(config, songname):
+    """Determines the command that should be used to play a song.
+
+    The "config" argument is a list of filetype-player associations, such as
+    the one produced by moosic.server.support.readConfig().  The "songname"
+    argument is the item to be played.  The return value is a list of strings
+    that can be used as the argument vector for the player program, or None if
+    no entry in the configuration matches the song.
+
+    If the command starts with a word beginning with "@", then it names one of
+    moosicd's built-in handlers (such as "@remote" or "@playlist"), and the song is not
+    appended to it.
+    """
+    # Match the songname against the regexps in our filetype association table.
+    command = None
+    for regex, cmd in config:
+        match = regex.search(songname)
+        if match:
+            command = cmd[:]
+            break
+    if not command:
+        return None
+    did_replacement = False
+    for i in range(len(command)):
+        # Replace occurrences of "$item" in the command list.
+        replaced = re.sub(r'\$item', songname, command[i])
+        if command[i] != replaced:
+            command[i] = replaced
+            did_replacement = True
+        # Replace references to match groups in the command list.
+        replaced = match.expand(command[i])
+        if command[i] != replaced:
+            command[i] = replaced
+            did_replacement = True
+    if not did_replacement and not command[0].startswith('@'):
+        command.append(songname)
+    return command
+
+
+# The player log is rotated when it grows to this size, and this many old copies
+# of it are kept.
+PLAYER_LOG_MAX_BYTES = 1024 * 1024
+PLAYER_LOG_BACKUPS = 3
+
+
+def reset_child_signals():
+    """Restores the default handling of the signals that moosicd catches.
+
+    This is meant to be called in a child process after fork(), so that a
+    signal that arrives before exec() can't run moosicd's own signal handlers
+    in the child.
+    """
+    for signum in CHILD_DEFAULT_SIGNALS:
+        signal.signal(signum, signal.SIG_DFL)
+    if hasattr(signal, 'set_wakeup_fd'):
+        signal.set_wakeup_fd(-1)
+
+# The signals whose handling is reset to the default in song players.  SIGPIPE
+# is included because Python ignores it, and exec() would leave it ignored.
+CHILD_DEFAULT_SIGNALS = (signal.SIGHUP, signal.SIGINT, signal.SIGTERM,
+                         signal.SIGUSR1, signal.SIGUSR2, signal.SIGCHLD,
+                         signal.SIGPIPE)
+
+
+def set_cloexec(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+class OutputCollector:
+    """Collects the output of the song players, and writes it to the player log.
+
+    Every player writes its standard output and standard error to a pipe of its
+    own, and a single thread reads from all of these pipes.  Each line that a
+    player prints is written to the "player_log" file in the configuration
+    directory, along with the time and the name of the song that the player was
+    playing.  The player log is rotated when it grows too big (see the
+    RotatingFile class in the moosic.server.support module).
+
+    No more than MAX_LINE bytes of a line are held in memory: longer lines are
+    split.  Carriage returns (which players use to redraw progress meters) are
+    treated like newlines.
+    """
+    MAX_LINE = 4096
+
+    def __init__(self):
+        self.logfile = None
+        # A mapping from the read end of each pipe to a [tag, partial line]
+        # list.
+        self.pipes = {}
+        self.lock = threading.Lock()
+        self.wakeup = None
+        self.thread = None
+        self.quitting = False
+
+    def setup(self):
+        if self.logfile is None:
+            self.logfile = RotatingFile(os.path.join(data.confdir, 'player_log'),
+                                        PLAYER_LOG_MAX_BYTES, PLAYER_LOG_BACKUPS)
+
+    def log(self, message, tag=None):
+        """Writes a time-stamped message to the player log."""
+        self.setup()
+        now = time.strftime('%I:%M:%S%p', time.localtime(time.time()))
+        if tag is None:
+            text = '%s %s\n' % (now, message)
+        else:
+            text = '%s [%s] %s\n' % (now, tag, message)
+        try:
+            self.logfile.write(text)
+        except (IOError, OSError), e:
+            pass
+
+    def new_pipe(self, tag):
+        """Creates a pipe whose contents will be logged with the given tag.
+
+        Returns the write end of the pipe, which is marked close-on-exec and
+        should be closed by the caller once it has been handed to a player.
+        """
+        rfd, wfd = os.pipe()
+        set_cloexec(rfd)
+        set_cloexec(wfd)
+        self.lock.acquire()
+        try:
+            self.pipes[rfd] = [tag, '']
+            if self.thread is None:
+                # The thread is started when it's first needed, which is after
+                # moosicd has turned itself into a daemon, since fork() doesn't
+                # carry threads over into the child process.
+                self.wakeup = WakeupPipe()
+                self.thread = threading.Thread(target=self.run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+        self.wakeup.notify()
+        return wfd
+
+    def run(self):
+        while not self.quitting:
+            self.lock.acquire()
+            try:
+                fds = self.pipes.keys()
+            finally:
+                self.lock.release()
+            try:
+                readable = select.select(fds + [self.wakeup.rfd], [], [])[0]
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in readable:
+                if fd == self.wakeup.rfd:
+                    self.wakeup.wait(0)
+                else:
+                    self.collect(fd)
+
+    def collect(self, fd):
+        """Reads whatever is available from one of the pipes, and logs each
+        complete line.
+        """
+        try:
+            chunk = os.read(fd, 65536)
+        except OSError, e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return
+            chunk = ''
+        entry = self.pipes[fd]
+        tag = entry[0]
+        text = string.replace(entry[1] + chunk, '\r', '\n')
+        lines = string.split(text, '\n')
+        partial = lines.pop()
+        while len(partial) > self.MAX_LINE:
+            lines.append(partial[:self.MAX_LINE])
+            partial = partial[self.MAX_LINE:]
+        if not chunk:
+            # The player has exited (or closed its output).
+            if partial:
+                lines.append(partial)
+            os.close(fd)
+            self.lock.acquire()
+            try:
+                del self.pipes[fd]
+            finally:
+                self.lock.release()
+        else:
+            entry[1] = partial
+        for line in lines:
+            if line:
+                self.log(line, tag)
+
+    def shutdown(self):
+        """Stops the collector thread."""
+        if self.thread is None:
+            return
+        self.quitting = True
+        self.wakeup.notify()
+        self.thread.join(1.0)
+
+collector = OutputCollector()
+
+
+class PlayerLauncher:
+    """Starts song player programs with as little work as possible.
+
+    Each player gets /dev/null for its standard input, and a pipe from the
+    OutputCollector for its standard output and standard error.  The child
+    process only has to duplicate these onto descriptors 0, 1, and 2 before
+    exec(), and never does any logging of its own.
+
+    Where posix_spawn() can be used (see the moosic.server.spawn module),
+    players are started with it, using file actions that are prepared only
+    once.  Since the file actions can't change from one player to the next, the
+    write end of each player's pipe is first duplicated onto a descriptor that
+    is reserved for this purpose ("slot_fd").  Otherwise, and for players that
+    must stop themselves before exec() (see the "stopped" argument of
+    launch()), moosicd forks.
+    """
+    def __init__(self):
+        self.ready = False
+        self.null_fd = None
+        self.slot_fd = None
+        # A moosic.server.spawn.PosixSpawn object, or None if posix_spawn()
+        # can't be used.
+        self.posix_spawn = None
+        self.lock = threading.Lock()
+
+    def setup(self):
+        """Opens the shared descriptors and prepares posix_spawn(), if this
+        hasn't been done yet.
+        """
+        if self.ready:
+            return
+        self.ready = True
+        self.null_fd = os.open('/dev/null', os.O_RDWR)
+        set_cloexec(self.null_fd)
+        self.slot_fd = os.dup(self.null_fd)
+        set_cloexec(self.slot_fd)
+        if spawn.available:
+            try:
+                self.posix_spawn = spawn.PosixSpawn([(self.null_fd, 0),
+                                                     (self.slot_fd, 1),
+                                                     (self.slot_fd, 2)],
+                                                    CHILD_DEFAULT_SIGNALS)
+            except OSError, e:
+                data.log(Log.DEBUG, 'Not using posix_spawn(): %s' % e)
+
+    def launch(self, command, tag, stopped=False):
+        """Starts a song player, and returns its PID.
+
+        The "command" argument is the argument vector of the player program.
+        The player's output is logged with the given tag (normally the name of
+        the song).
+
+        If "stopped" is true, the child stops itself with SIGSTOP once everything
+        but the exec() is done, and only runs the player program when it
+        receives SIGCONT.
+
+        Raises OSError if the player can't be started.
+        """
+        start = time.time()
+        pid = self.start(command, tag, stopped)
+        stats.record('player spawn', time.time() - start)
+        return pid
+
+    def start(self, command, tag, stopped):
+        self.setup()
+        out_fd = collector.new_pipe(tag)
+        try:
+            if self.posix_spawn and not stopped:
+                # Delimit each entry in the log file with a time-stamped
+                # message.
+                collector.log('Executing "%s"' % string.join(command), tag)
+                self.lock.acquire()
+                try:
+                    os.dup2(out_fd, self.slot_fd)
+                    try:
+                        return self.posix_spawn.spawn(command)
+                    finally:
+                        # Don't keep the pipe open in moosicd, or its reader
+                        # would never see the end of it.
+                        os.dup2(self.null_fd, self.slot_fd)
+                        set_cloexec(self.slot_fd)
+                finally:
+                    self.lock.release()
+            return self.fork(command, out_fd, stopped)
+        finally:
+            os.close(out_fd)
+
+    def fork(self, command, out_fd, stopped):
+        # I forget why I'm flushing stdout here, but it can't hurt. Can it?
+        sys.stdout.flush()
+        # Classic fork & exec to spawn the external player.
+        # Portability note: os.fork() is only available on Unix systems.
+        pid = os.fork()
+        if pid != 0:
+            return pid
+        # Everything from here on happens in the child process, which must
+        # never return into the rest of moosicd, even if something goes wrong.
+        try:
+            reset_child_signals()
+            # We don't want the program to grab input.
+            os.dup2(self.null_fd, 0)
+            # Capture the program's standard output and error streams.
+            os.dup2(out_fd, 1)
+            os.dup2(out_fd, 2)
+            # Wait here until it's time to play.
+            if stopped:
+                os.kill(os.getpid(), signal.SIGSTOP)
+            # Delimit each entry in the log file with a time-stamped message.
+            os.write(1, 'Executing "%s"\n' % string.join(command))
+            # Execute the command.
+            try:
+                os.execvp(command[0], command)
+            except OSError, e:
+                os.write(2, 'Could not execute "%s": %s\n' %
+                            (string.join(command), e))
+        finally:
+            os._exit(127)
+
+launcher = PlayerLauncher()
+
+
+def spawn_player(command, songname, stopped=False):
+    """Starts a song player in a child process, and returns the child's PID.
+
+    The "command" argument is the argument vector of the player program, and
+    "songname" is the song that it will play.  The player's standard input is
+    redirected from /dev/null, and its standard output and standard error are
+    collected into the "player_log" file in the configuration directory.  See
+    PlayerLauncher.launch() for the meaning of "stopped".
+    """
+    return launcher.launch(command, songname, stopped)
+
+
+def describe_exit(status, rusage=None):
+    """Returns a phrase that describes how a child process terminated.
+
+    "status" is an exit status as returned by os.waitpid(), and "rusage" is the
+    (optional) resource usage information returned by os.wait4().
+    """
+    if os.WIFSIGNALED(status):
+        text = 'was killed by signal %d' % os.WTERMSIG(status)
+    else:
+        text = 'exited with status %d' % os.WEXITSTATUS(status)
+    if rusage is not None:
+        text = text + ' (user time: %.2fs, system time: %.2fs, max RSS: %d kB)' \
+                      % (rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss)
+    return text
+
+
+def describe_returncode(returncode):
+    """Returns a phrase like that of describe_exit(), for the "returncode"
+    attribute of a subprocess.Popen object, which is negative if the process
+    was killed by a signal.
+    """
+    if returncode < 0:
+        return 'was killed by signal %d' % -returncode
+    else:
+        return 'exited with status %d' % returncode
+
+
+class GapTimer:
+    """Measures the silent gap between the end of one song and the start of the
+    next one.
+
+    The length of the most recent gap is logged and kept in data.song_gap.
+    """
+    def __init__(self):
+        # The time at which the last song ended, or None if there is no gap to
+        # measure (e.g. because the queue consumer went idle).
+        self.song_end = None
+
+    def song_ended(self):
+        self.song_end = time.time()
+
+    def song_started(self):
+        if self.song_end is None:
+            return
+        data.song_gap = time.time() - self.song_end
+        self.song_end = None
+        stats.record('song gap', data.song_gap)
+        data.log(Log.DEBUG, 'Gap between songs: %.1f ms.' % (data.song_gap*1000))
+
+    def reset(self):
+        self.song_end = None
+
+
+class PlayerBackend:
+    """The interface that is shared by all of the ways of playing a song.
+
+    The queue consumer calls play() to start playing a song, and then wait() to
+    wait until the song is over.  While a song is playing, the backend that is
+    playing it is stored in data.player, so that the server methods can call
+    its pause(), unpause(), and stop() methods.  These methods are only called
+    while data.lock is held.  When the song is over, the backend sets
+    data.player back to None.
+    """
+    def play(self, songname, command):
+        """Starts playing a song with the given command, and returns right away.
+        """
+        raise NotImplementedError
+
+    def finished(self):
+        """Returns True if the song that was last played is over."""
+        raise NotImplementedError
+
+    def wait(self, idle=None):
+        """Returns once the song that was last played is over.
+
+        If "idle" is given, it is called every time the queue consumer wakes up
+        while the song is still playing.
+        """
+        while not self.finished():
+            if idle:
+                idle()
+            data.queue_wakeup.wait(self.wait_timeout())
+
+    def wait_timeout(self):
+        """Returns the longest time that wait() should sleep between checks on
+        whether the song is over, or None if it doesn't need to check at all.
+        """
+        return None
+
+    def pause(self):
+        """Pauses the song that is playing."""
+        raise NotImplementedError
+
+    def unpause(self):
+        """Continues playing the song after it has been paused."""
+        raise NotImplementedError
+
+    def stop(self):
+        """Stops playing the song."""
+        raise NotImplementedError
+
+    def shutdown(self):
+        """Stops playing and releases all resources held by the backend."""
+        pass
+
+
+class SpawnBackend(PlayerBackend):
+    """Plays each song by spawning a new player program, which exits when the
+    song is over.
+
+    Instead of blocking in os.waitpid() until a player exits, the queue consumer
+    sleeps on data.queue_wakeup, which is notified whenever a SIGCHLD signal
+    arrives, and then reaps the player without blocking.  This lets the queue
+    consumer notice other events while a song is playing.
+
+    Players are only ever reaped while data.lock is held, and signals are only
+    sent to data.player_pid while data.lock is held.  Since the process ID of a
+    child that has exited can't be reused until the child has been reaped, this
+    guarantees that moosicd never sends a signal to a stale process ID that
+    might now belong to some unrelated process.
+
+    If the "preroll" attribute is set, then while a song is playing, the backend
+    also prepares a player for the item at the head of the song queue: the
+    player is forked, given its argument vector and log file, and then stopped
+    just before it would exec() the player program.  When the current song
+    ends, the prepared player is released with SIGCONT, which shortens the
+    silent gap between songs.  A prepared player is thrown away if the head of
+    the queue or the configuration changes before it is used.
+    """
+    def __init__(self):
+        self.installed = False
+        self.preroll = False
+        # The argument vector of the current player.
+        self.command = None
+        # A (songname, config, command, pid) tuple that describes the prepared
+        # player, or None.
+        self.prepared = None
+
+    def install(self):
+        """Arranges for SIGCHLD to wake up the queue consumer.
+
+        This must be called from the main thread.
+        """
+        if self.installed:
+            return
+        signal.signal(signal.SIGCHLD, self.handle_sigchld)
+        # Let system calls that are in progress in other threads continue when
+        # a SIGCHLD arrives, rather than failing with EINTR.
+        if hasattr(signal, 'siginterrupt'):
+            signal.siginterrupt(signal.SIGCHLD, False)
+        # The Python-level signal handler only runs in the main thread, and only
+        # once it gets a chance to run, but the wakeup fd is written to as soon
+        # as the signal arrives, no matter which thread receives it.
+        if hasattr(signal, 'set_wakeup_fd'):
+            signal.set_wakeup_fd(data.queue_wakeup.wfd)
+        self.installed = True
+
+    def handle_sigchld(self, signum, stackframe):
+        data.queue_wakeup.notify()
+
+    def play(self, songname, command):
+        """Spawns a player with the given argument vector and records its PID
+        in data.player_pid.
+        """
+        try:
+            pid = spawn_player(command, songname)
+        except OSError, e:
+            data.log(Log.ERROR, 'Could not execute "%s": %s' %
+                                (string.join(command), e.strerror))
+            return
+        data.lock.acquire()
+        try:
+            data.player_pid = pid
+            data.player = self
+            data.last_player_exit = None
+            self.command = command
+        finally:
+            data.lock.release()
+        gap_timer.song_started()
+
+    def prepare(self):
+        """Makes sure that the prepared player, if any, is ready to play the
+        item at the head of the song queue.
+        """
+        if not self.preroll:
+            return
+        data.lock.acquire()
+        try:
+            if data.song_queue and data.qrunning:
+                songname = data.song_queue[0]
+            else:
+                songname = None
+            config = data.config
+        finally:
+            data.lock.release()
+        if self.prepared:
+            if self.prepared[0] == songname and self.prepared[1] is config:
+                return
+            self.discard()
+        if songname is None:
+            return
+        command = find_command(config, songname)
+        # Songs that are handled by something other than a newly spawned
+        # player don't need to be prepared.
+        if command and not command[0].startswith('@'):
+            try:
+                pid = spawn_player(command, songname, stopped=True)
+            except OSError, e:
+                data.log(Log.DEBUG, 'Could not prepare a player for %s: %s' %
+                                    (songname, e))
+                return
+            self.prepared = (songname, config, command, pid)
+
+    def release(self, config, songname):
+        """Lets the prepared player start playing, if it was prepared for the
+        given song and configuration.
+
+        Returns True if the prepared player was used, otherwise False.
+        """
+        if not self.prepared:
+            return False
+        if self.prepared[0] != songname or self.prepared[1] is not config:
+            self.discard()
+            return False
+        command, pid = self.prepared[2], self.prepared[3]
+        self.prepared = None
+        # Make sure that the child has actually stopped itself (which normally
+        # happens almost immediately after it's forked), since a SIGCONT sent
+        # before then would be lost.
+        try:
+            pid, status = waitpid_retry(pid, os.WUNTRACED)
+        except OSError:
+            return False
+        if not os.WIFSTOPPED(status):
+            data.log(Log.DEBUG, 'The prepared player for %s %s.' %
+                     (songname, describe_exit(status)))
+            return False
+        data.lock.acquire()
+        try:
+            data.player_pid = pid
+            data.player = self
+            data.last_player_exit = None
+            self.command = command
+            os.kill(pid, signal.SIGCONT)
+        finally:
+            data.lock.release()
+        gap_timer.song_started()
+        return True
+
+    def discard(self):
+        """Gets rid of the prepared player, if there is one."""
+        if not self.prepared:
+            return
+        pid = self.prepared[3]
+        self.prepared = None
+        try:
+            os.kill(pid, signal.SIGKILL)
+            waitpid_retry(pid, 0)
+        except OSError:
+            pass
+
+    def finished(self):
+        """Reaps the current player if it has exited.
+
+        Returns True if there is no longer a current player, otherwise False.
+        """
+        data.lock.acquire()
+        try:
+            if data.player_pid is None:
+                return True
+            try:
+                pid, status, rusage = os.wait4(data.player_pid, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    return False
+                elif e.errno == errno.ECHILD:
+                    # Somebody else already reaped the player.
+                    self.reaped()
+                    return True
+                raise
+            if pid == 0:
+                return False
+            self.reaped()
+            data.last_player_exit = (data.current_song, status, rusage)
+            data.log(Log.DEBUG, 'The player for %s %s.' %
+                     (data.current_song, describe_exit(status, rusage)))
+            return True
+        finally:
+            data.lock.release()
+
+    def reaped(self):
+        data.player_pid = None
+        if data.player is self:
+            data.player = None
+        gap_timer.song_ended()
+
+    def wait_timeout(self):
+        # If install() hasn't been called, there's no SIGCHLD to wake us up,
+        # so fall back to checking on the player every now and then.
+        if self.installed:
+            return None
+        else:
+            return 0.05
+
+    def pause(self):
+        if data.player_pid is None:
+            return
+        os.kill(data.player_pid, signal.SIGTSTP)
+        time.sleep(0.10)
+        os.kill(data.player_pid, signal.SIGSTOP)
+
+    def unpause(self):
+        if data.player_pid is None:
+            return
+        try:
+            os.kill(data.player_pid, signal.SIGCONT)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def stop(self):
+        if data.player_pid is None:
+            return
+        # ogg123 behaves very stupidly when it gets a TERM signal, so it
+        # needs to be handled specially. I hate you, ogg123.
+        if self.command and os.path.basename(self.command[0]) == 'ogg123':
+            os.kill(data.player_pid, signal.SIGINT)
+        else:
+            os.kill(data.player_pid, signal.SIGTERM)
+
+    def shutdown(self):
+        data.lock.acquire()
+        try:
+            if data.player_pid is not None:
+                try: os.kill(data.player_pid, signal.SIGTERM)
+                except OSError: pass
+        finally:
+            data.lock.release()
+        self.discard()
+
+
+class RemoteControlBackend(PlayerBackend):
+    """Plays songs with a long-lived player program that is controlled through
+    its standard input and output.
+
+    The player program must understand the "generic remote control" protocol
+    that is used by "mpg123 -R" (and by mpg321 and ogg123's equivalent
+    options): a song is played with a "LOAD <filename>" command, "PAUSE"
+    toggles between pausing and playing, and "STOP" stops playing.  The player
+    reports that a song is over by writing a line that starts with "@P 0".
+
+    The player program is started the first time it is needed, and is started
+    again if it ever quits.  Its standard error is appended to the player log.
+    Its standard output is read by a separate thread, which wakes up the queue
+    consumer when a song is over.
+    """
+    def __init__(self, command):
+        self.command = command
+        self.process = None
+        # The thread that reads the player program's output.
+        self.reader = None
+        # Whether a song has been loaded and hasn't finished yet.
+        self.playing = False
+        # Whether the current song has been paused with a PAUSE command.
+        self.paused = False
+
+    def launch(self):
+        """Starts the player program."""
+        collector.log('Executing "%s"' % string.join(self.command))
+        err_fd = collector.new_pipe(os.path.basename(self.command[0]))
+        try:
+            self.process = subprocess.Popen(self.command,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=err_fd, close_fds=True,
+                    preexec_fn=reset_child_signals)
+        finally:
+            os.close(err_fd)
+        self.reader = threading.Thread(target=self.read_status,
+                                       args=(self.process,))
+        self.reader.setDaemon(True)
+        self.reader.start()
+        # Don't report the progress of each song, since we don't need it.
+        self.send('SILENCE')
+
+    def read_status(self, process):
+        """Reads status messages from the player program until it quits."""
+        name = os.path.basename(self.command[0])
+        while True:
+            try:
+                line = process.stdout.readline()
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            if not line:
+                break
+            if line.startswith('@P 0'):
+                self.song_over()
+            elif line.startswith('@E'):
+                data.log(Log.NOTICE, '%s: %s' % (name, line[2:].strip()))
+        process.wait()
+        data.log(Log.DEBUG, 'The remote-controlled player "%s" %s.' %
+                 (string.join(self.command), describe_returncode(process.returncode)))
+        data.lock.acquire()
+        try:
+            if self.process is process:
+                self.process = None
+            self.song_over()
+        finally:
+            data.lock.release()
+
+    def send(self, message):
+        """Writes a command to the player program."""
+        try:
+            self.process.stdin.write(message + '\n')
+            self.process.stdin.flush()
+        except (IOError, ValueError), e:
+            data.log(Log.ERROR, 'Cannot control the player "%s": %s' %
+                                (string.join(self.command), e))
+            self.song_over()
+
+    def song_over(self):
+        data.lock.acquire()
+        try:
+            if not self.playing:
+                return
+            self.playing = False
+            self.paused = False
+            if data.player is self:
+                data.player = None
+        finally:
+            data.lock.release()
+        gap_timer.song_ended()
+        data.queue_wakeup.notify()
+
+    def play(self, songname, command):
+        if '\n' in songname:
+            data.log(Log.ERROR, 'Cannot play "%s" with a remote-controlled '
+                                'player, since it has a newline in its name.'
+                                % songname)
+            return
+        data.lock.acquire()
+        try:
+            if self.process is None:
+                try:
+                    self.launch()
+                except OSError, e:
+                    data.log(Log.ERROR, 'Could not execute "%s": %s' %
+                                        (string.join(self.command), e.strerror))
+                    return
+            self.playing = True
+            self.paused = False
+            data.player = self
+            self.send('LOAD ' + songname)
+        finally:
+            data.lock.release()
+        gap_timer.song_started()
+
+    def finished(self):
+        return not self.playing
+
+    def pause(self):
+        if self.playing and not self.paused:
+            self.send('PAUSE')
+            self.paused = True
+
+    def unpause(self):
+        if self.playing and self.paused:
+            self.send('PAUSE')
+            self.paused = False
+
+    def stop(self):
+        if self.playing:
+            self.send('STOP')
+            self.paused = False
+
+    def shutdown(self):
+        process = self.process
+        if process is None:
+            return
+        try:
+            process.stdin.write('QUIT\n')
+            process.stdin.close()
+        except (IOError, ValueError):
+            pass
+        try: os.kill(process.pid, signal.SIGTERM)
+        except OSError: pass
+        # Don't let the reader thread wake up in the middle of the interpreter's
+        # own shutdown.
+        self.reader.join(1.0)
+
+
+class PlaylistBackend(PlayerBackend):
+    """Plays a playlist by putting the items that it lists at the head of the
+    song queue, so that they are played in its place.
+
+    This is done inside the server, without running a client program to add
+    the items through the Moosic API.  Playlists that are listed in a playlist
+    are expanded too, except for those that would list themselves again, and
+    items that no command in the configuration can play are left out.  The
+    playlist itself isn't added to the history or returned to the queue in
+    loop mode, since its items will be.
+    """
+    def expand(self, filename, ancestors, skipped):
+        """Returns the items listed in a playlist, with nested playlists
+        replaced by their own items.  Items that can't be played are appended
+        to the "skipped" list instead.
+        """
+        try:
+            entries = read_playlist(filename)
+        except IOError, e:
+            data.log(Log.ERROR, 'Cannot read the playlist "%s": %s' %
+                                (filename, e.strerror))
+            return []
+        ancestors[filename] = True
+        items = []
+        for entry in entries:
+            command = find_command(data.config, entry)
+            if not command:
+                skipped.append(entry)
+            elif command[0] == '@playlist':
+                if ancestors.has_key(entry):
+                    data.log(Log.WARNING, 'Skipping "%s", which lists '
+                             'itself from within "%s".' % (entry, filename))
+                else:
+                    items.extend(self.expand(entry, ancestors, skipped))
+            else:
+                items.append(entry)
+        del ancestors[filename]
+        return items
+
+    def play(self, songname, command):
+        skipped = []
+        items = self.expand(songname, {}, skipped)
+        data.lock.acquire()
+        try:
+            data.song_queue[0:0] = items
+            data.last_queue_update = time.time()
+            data.ignore_song_finish = True
+        finally:
+            data.lock.release()
+        data.queue_changed.notify()
+        data.log(Log.NOTICE, 'Queued %d items from the playlist "%s".' %
+                           (len(items), songname))
+        for entry in skipped:
+            data.log(Log.NOTICE, 'No player could be found for "%s" (listed '
+                                 'in "%s").' % (entry, songname))
+
+    def finished(self):
+        return True
+
+    def pause(self):
+        pass
+
+    def unpause(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def waitpid_retry(pid, options):
+    """Calls os.waitpid(), retrying if it is interrupted by a signal."""
+    while True:
+        try:
+            return os.waitpid(pid, options)
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+
+
+# The long-lived players that are being used by RemoteControlBackends, indexed
+# by their argument vectors.
+remote_backends = {}
+
+def backend_for(command):
+    """Returns the backend that should be used to play a song with the given
+    command (as returned by find_command()), or None if the command is invalid.
+    """
+    if command[0] == '@remote':
+        if len(command) < 2:
+            data.log(Log.ERROR, 'No player program was given after "@remote".')
+            return None
+        key = tuple(command[1:])
+        if not remote_backends.has_key(key):
+            remote_backends[key] = RemoteControlBackend(command[1:])
+        return remote_backends[key]
+    elif command[0] == '@playlist':
+        return playlist_backend
+    elif command[0].startswith('@'):
+        data.log(Log.ERROR, 'Unknown built-in handler: "%s".' % command[0])
+        return None
+    return spawner
+
+
+def shutdown_backends():
+    """Stops all of the players that moosicd is running."""
+    spawner.shutdown()
+    for backend in remote_backends.values():
+        backend.shutdown()
+    collector.shutdown()
+
+
+gap_timer = GapTimer()
+spawner = SpawnBackend()
+playlist_backend = PlaylistBackend()
@@ -0,0 +1,105 @@
+# moosic/server/playlist.py - reading M3U and PLS playlist files
+#
+# This is free and unencumbered software released into the public domain.
+# 
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+# 
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# 
+# For more information, please refer to <http://unlicense.org/>
+
+
+
+"""Reading M3U and PLS playlist files.
+
+These functions turn a playlist file into the list of items that it names, so
+that moosicd can put them into its song queue by itself, instead of running
+"moosic pl-add" to do it.  Relative filenames in a playlist are taken to be
+relative to the directory that holds the playlist, and URLs (anything with a
+"://" in it) are left alone, except that "file://" URLs for the local host are
+turned back into plain filenames.
+"""
+
+import os.path, re, urllib, urlparse
+
+__all__ = ('read_playlist', 'parse_m3u', 'parse_pls', 'resolve_entry')
+
+# Matches an entry in a PLS playlist, such as "File1=song.ogg".
+pls_entry = re.compile(r'(?i)^\s*file(\d+)\s*=(.*)$')
+
+
+def parse_m3u(lines):
+    """Returns the entries in the lines of an M3U (or M3U8) playlist.
+
+    Blank lines and lines starting with "#" (including the "#EXTM3U" header
+    and "#EXTINF" lines of extended M3U files) are skipped.
+    """
+    entries = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.strip() and not line.startswith('#'):
+            entries.append(line)
+    return entries
+
+
+def parse_pls(lines):
+    """Returns the entries in the lines of a PLS playlist, in the order of
+    their numbers.
+    """
+    entries = []
+    for line in lines:
+        match = pls_entry.match(line.rstrip('\r\n'))
+        if match:
+            entries.append((int(match.group(1)), match.group(2).strip()))
+    entries.sort()
+    return [entry for number, entry in entries if entry]
+
+
+def resolve_entry(entry, dirname):
+    """Returns the item that should be queued for a playlist entry, given the
+    directory that holds the playlist.
+    """
+    if '://' in entry:
+        url = urlparse.urlsplit(entry)
+        if url[0] != 'file' or url[1] not in ('', 'localhost'):
+            return entry
+        entry = urllib.unquote(url[2])
+    return os.path.normpath(os.path.join(dirname, entry))
+
+
+def read_playlist(filename):
+    """Returns the items that are listed in a playlist file.
+
+    A file is read as a PLS playlist if its name ends with ".pls" or its first
+    line is "[playlist]", and as an M3U playlist otherwise.  Raises IOError if
+    the file can't be read.
+    """
+    f = open(filename)
+    try:
+        lines = f.readlines()
+    finally:
+        f.close()
+    if filename.lower().endswith('.pls') or \
+       (lines and lines[0].strip().lower() == '[playlist]'):
+        entries = parse_pls(lines)
+    else:
+        entries = parse_m3u(lines)
+    dirname = os.path.dirname(os.path.abspath(filename))
+    return [resolve_entry(entry, dirname) for entry in entries]
@@ -0,0 +1,192 @@
+# moosic/server/prefetch.py - warms the page cache for upcoming songs
+#
+# This is free and unencumbered software released into the public domain.
+# 
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+# 
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# 
+# For more information, please refer to <http://unlicense.org/>
+
+
+"""Warms the page cache for the items that are about to be played.
+
+When music files live on slow disks or network filesystems, a song player can
+stall for a while at the start of each song while the beginning of the file is
+read in.  The Prefetcher in this module watches the head of the song queue and
+asks the kernel to start reading the next few local files ahead of time.
+"""
+
+import os, os.path
+
+from moosic.server.support import data, Log
+
+# Define the True and False constants if they don't already exist.
+try: True
+except NameError: True = 1
+try: False
+except NameError: False = 0
+
+__all__ = ('Prefetcher', 'prefetcher')
+
+# This is the value of POSIX_FADV_WILLNEED on Linux and on most other systems.
+POSIX_FADV_WILLNEED = 3
+
+# The size of each read() when falling back to reading files ourselves.
+CHUNK_SIZE = 256 * 1024
+
+# Use posix_fadvise() from the C library if we can get at it through ctypes.
+try:
+    import ctypes, ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'))
+    if hasattr(_libc, 'posix_fadvise64'):
+        _posix_fadvise = _libc.posix_fadvise64
+        _posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong,
+                                   ctypes.c_longlong, ctypes.c_int]
+    else:
+        _posix_fadvise = _libc.posix_fadvise
+        _posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_long,
+                                   ctypes.c_long, ctypes.c_int]
+    _posix_fadvise.restype = ctypes.c_int
+except (ImportError, OSError, AttributeError, TypeError):
+    _posix_fadvise = None
+
+
+class Cancelled(Exception):
+    """Raised when the song queue changes while a file is being prefetched."""
+    pass
+
+
+class Prefetcher:
+    """Reads ahead the local files that are next in line to be played.
+
+    The prefetcher runs in its own thread, and sleeps on data.queue_changed
+    until the song queue changes.  It then looks at the first "items" entries in
+    the queue, and for each of them that is a local file, it asks the kernel
+    (using posix_fadvise(POSIX_FADV_WILLNEED)) to read the start of the file
+    into the page cache.  If posix_fadvise() can't be used, the prefetcher reads
+    the files itself.  No more than "budget" bytes are prefetched for all of the
+    upcoming items combined.
+
+    If the queue changes while a file is being read, the prefetcher abandons the
+    file and starts over by looking at the new head of the queue, so items that
+    have been cut or moved away are not prefetched needlessly.
+
+    The "hits" attribute counts the songs that had been prefetched by the time
+    they started playing, and "misses" counts the local files that hadn't.
+    """
+    def __init__(self, items=0, budget=64*1024*1024):
+        self.items = items
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        # A mapping from each file that has been prefetched to the number of
+        # bytes that were prefetched.
+        self.done = {}
+
+    def upcoming(self):
+        """Returns (filename, size) pairs for the local files that are next in
+        the song queue.
+        """
+        data.lock.acquire()
+        try:
+            candidates = data.song_queue[:self.items]
+        finally:
+            data.lock.release()
+        files = []
+        for name in candidates:
+            if not name.startswith('/'):
+                continue
+            try:
+                st = os.stat(name)
+            except OSError:
+                continue
+            if st.st_size > 0 and os.path.isfile(name):
+                files.append((name, st.st_size))
+        return files
+
+    def run(self):
+        """Prefetches upcoming songs until moosicd quits."""
+        while not data.quitFlag:
+            try:
+                self.prefetch(self.upcoming())
+            except Cancelled:
+                continue
+            data.queue_changed.wait()
+
+    def prefetch(self, files):
+        remaining = self.budget
+        done = {}
+        for name, size in files:
+            if remaining <= 0:
+                break
+            length = min(size, remaining)
+            if self.done.get(name, 0) < length:
+                try:
+                    self.warm(name, length)
+                except (IOError, OSError), e:
+                    data.log(Log.DEBUG, 'Could not prefetch %s: %s' % (name, e))
+                    continue
+            done[name] = length
+            # Keep track of progress as we go, in case we get cancelled.
+            self.done[name] = length
+            remaining = remaining - length
+        self.done = done
+
+    def warm(self, name, length):
+        """Brings the first "length" bytes of the named file into the page
+        cache.
+        """
+        fd = os.open(name, os.O_RDONLY)
+        try:
+            if _posix_fadvise is not None:
+                err = _posix_fadvise(fd, 0, length, POSIX_FADV_WILLNEED)
+                if err == 0:
+                    return
+            # Read the file ourselves, stopping as soon as the queue changes.
+            while length > 0:
+                if data.queue_changed.wait(0):
+                    raise Cancelled
+                chunk = os.read(fd, min(CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                length = length - len(chunk)
+        finally:
+            os.close(fd)
+
+    def song_started(self, songname):
+        """Records whether the song that is about to start playing was
+        prefetched.
+
+        This must be called while data.lock is held, at the moment the song is
+        taken off of the queue, so that the prefetcher can't forget about the
+        song before it is counted.  (It also means that this method must not do
+        any I/O, so every absolute pathname counts as a local file here.)
+        """
+        if not self.items:
+            return
+        if self.done.has_key(songname):
+            self.hits = self.hits + 1
+            data.log(Log.DEBUG, 'Prefetch hit for %s.' % songname)
+        elif songname.startswith('/'):
+            self.misses = self.misses + 1
+            data.log(Log.DEBUG, 'Prefetch miss for %s.' % songname)
+
+prefetcher = Prefetcher()
@@ -0,0 +1,255 @@
+# moosic/server/profiler.py - on-demand profiling of the server's methods
+#
+# This is free and unencumbered software released into the public domain.
+# 
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+# 
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# 
+# For more information, please refer to <http://unlicense.org/>
+
+
+"""Profiles calls to the server's methods while moosicd is running.
+
+The MethodProfiler defined here is installed in the method registry (see
+Registry.set_profiler() in moosic.server.xmlrpc_registry).  It does nothing
+until a profiling session is started, and then it profiles the calls to the
+chosen methods until the session is stopped, at which point a report of
+everything that was collected is returned.
+"""
+
+import sys, os.path, time, string, threading
+import cStringIO
+
+# Define the True and False constants if they don't already exist.
+try: True
+except NameError: True = 1
+try: False
+except NameError: False = 0
+
+__all__ = ('MethodProfiler', 'method_profiler', 'MODES')
+
+# The kinds of profiling that are supported.
+MODES = ('cprofile', 'sample')
+
+# The number of functions listed in a cProfile report.
+REPORT_LINES = 40
+
+
+class MethodProfiler:
+    """Collects profiling data for calls to selected server methods.
+
+    There are two modes of profiling:
+      * "cprofile" runs each call under its own cProfile.Profile, and adds the
+        results together.  This accounts for every function call, but it slows
+        the profiled calls down considerably.
+      * "sample" starts a thread that looks at the stacks of the threads that
+        are running the profiled calls every "interval" seconds, and counts how
+        often each stack is seen.  This costs very little, so it is suitable for
+        watching a busy server, but calls that are shorter than the interval
+        may be missed.
+
+    Only one session can run at a time.  Starting a new session throws away
+    whatever the previous one collected.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lock = threading.Lock()
+        # The names of the methods being profiled (None while no session is
+        # running, or an empty dictionary for all methods), the kind of
+        # profiling, and the time at which the session started.
+        self.methods = None
+        self.mode = None
+        self.started = 0
+        # A number that identifies the current session, so that calls that
+        # finish after their session has ended don't add to the next one.
+        self.session = 0
+        # The number of profiled calls made during this session.
+        self.calls = 0
+        # The combined pstats.Stats of every call, in "cprofile" mode.
+        self.pstats = None
+        # A mapping from the ID of each thread that is in a profiled call to
+        # the name of the method.
+        self.active = {}
+        # In "sample" mode: a mapping from each stack that has been seen to the
+        # number of times that it was seen, the total number of samples, and
+        # the sampling thread.
+        self.stacks = {}
+        self.samples = 0
+        self.sampler = None
+        # A one-line description of the last session that was stopped.
+        self.summary = ''
+
+    def start(self, methods, mode='cprofile'):
+        """Starts a profiling session for the named methods (or for all methods,
+        if the list is empty).
+
+        Raises ValueError if the mode is unknown.
+        """
+        if mode not in MODES:
+            raise ValueError('Unknown profiling mode "%s" (use one of: %s).' %
+                             (mode, string.join(MODES, ', ')))
+        self.stop()
+        self.lock.acquire()
+        try:
+            self.methods = {}
+            for name in methods:
+                self.methods[name] = True
+            self.mode = mode
+            self.started = time.time()
+            self.session = self.session + 1
+            self.calls = 0
+            self.pstats = None
+            self.stacks = {}
+            self.samples = 0
+            if mode == 'sample':
+                self.sampler = threading.Thread(target=self.sample,
+                                                args=(self.session,))
+                self.sampler.setDaemon(True)
+                self.sampler.start()
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        """Ends the current profiling session, and returns a textual report of
+        what it collected, or None if no session was running.  A summary of the
+        session is left in the "summary" attribute.
+        """
+        self.lock.acquire()
+        try:
+            if self.methods is None:
+                return None
+            self.methods = None
+            self.session = self.session + 1
+            sampler, self.sampler = self.sampler, None
+        finally:
+            self.lock.release()
+        if sampler is not None:
+            sampler.join()
+        self.summary = '%d calls profiled in %.1f seconds' % \
+                       (self.calls, time.time() - self.started)
+        if self.mode == 'sample':
+            self.summary = self.summary + '; %d samples taken every %g ms' % \
+                           (self.samples, self.interval * 1000)
+            report = self.sample_report()
+        else:
+            report = self.cprofile_report()
+        self.pstats = None
+        self.stacks = {}
+        return report
+
+    def wants(self, name):
+        """Returns True if calls to the named method should be profiled."""
+        methods = self.methods
+        return methods is not None and (not methods or methods.has_key(name))
+
+    def call(self, name, method, params):
+        """Calls a method with the given parameters, profiling the call."""
+        thread_id = threading.currentThread().ident
+        if self.active.has_key(thread_id):
+            # This call was made from within another profiled call (e.g. by
+            # system.multicall), so it is already being profiled.
+            return self.run(method, params)
+        session = self.session
+        self.active[thread_id] = name
+        try:
+            if self.mode == 'sample':
+                return self.run(method, params)
+            import cProfile, pstats
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(self.run, method, params)
+            finally:
+                self.lock.acquire()
+                try:
+                    if session == self.session:
+                        if self.pstats is None:
+                            self.pstats = pstats.Stats(profile)
+                        else:
+                            self.pstats.add(profile)
+                finally:
+                    self.lock.release()
+        finally:
+            del self.active[thread_id]
+            self.count_call(session)
+
+    def run(self, method, params):
+        # The frame of this method marks the bottom of a sampled stack.
+        return apply(method, params)
+
+    def count_call(self, session):
+        self.lock.acquire()
+        try:
+            if session == self.session:
+                self.calls = self.calls + 1
+        finally:
+            self.lock.release()
+
+    def sample(self, session):
+        """Samples the stacks of the threads that are in profiled calls, until
+        the given session ends.
+        """
+        bottom = self.run.im_func.func_code
+        while session == self.session:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for thread_id, name in self.active.items():
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None and frame.f_code is not bottom:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name,
+                                 os.path.basename(code.co_filename),
+                                 code.co_firstlineno))
+                    frame = frame.f_back
+                if frame is None:
+                    # The call finished before its stack could be examined.
+                    continue
+                stack.append(name)
+                stack.reverse()
+                key = string.join(stack, ';')
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples = self.samples + 1
+
+    def sample_report(self):
+        """Returns the stacks that were seen in the "folded" format that is read
+        by flame graph tools: one stack per line, outermost call first, with its
+        frames separated by semicolons and followed by the number of samples.
+        """
+        stacks = [(count, stack) for stack, count in self.stacks.items()]
+        stacks.sort()
+        stacks.reverse()
+        lines = ['%s %d\n' % (stack, count) for count, stack in stacks]
+        return string.join(lines, '')
+
+    def cprofile_report(self):
+        header = '%d calls profiled in %.1f seconds.\n' % \
+                 (self.calls, time.time() - self.started)
+        if self.pstats is None:
+            return header
+        out = cStringIO.StringIO()
+        self.pstats.stream = out
+        self.pstats.strip_dirs().sort_stats('cumulative').print_stats(
+                REPORT_LINES)
+        return header + out.getvalue()
+
+
+# This is the profiler that is installed in the registry of server methods.
+method_profiler = MethodProfiler()
@@ -0,0 +1,134 @@
+# moosic/server/spawn.py - starts child processes with posix_spawn()
+#
+# This is free and unencumbered software released into the public domain.
+# 
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+# 
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# 
+# For more information, please refer to <http://unlicense.org/>
+
+
+"""Starts child processes with posix_spawn().
+
+Forking a large, multi-threaded program like moosicd is expensive (because the
+kernel has to copy the page tables of the whole process) and dangerous (because
+the child only gets a copy of the thread that called fork(), while locks held by
+the other threads stay locked forever in the child).  posix_spawn() avoids both
+problems: the GNU C library implements it with vfork() semantics, so the child
+shares the parent's memory until it calls exec(), and it only runs a fixed list
+of file actions that were prepared in advance.
+
+Python 2 has no binding for posix_spawn(), so this module calls it through
+ctypes.  The data types involved are opaque, so this is only attempted with the
+GNU C library, whose flag values are known.  Use the "available" variable to
+find out whether posix_spawn() can be used.
+"""
+
+import os, sys, errno, platform
+
+__all__ = ('available', 'PosixSpawn')
+
+# Flag values from the GNU C library's <spawn.h>.
+POSIX_SPAWN_SETSIGDEF = 0x04
+POSIX_SPAWN_SETSIGMASK = 0x08
+POSIX_SPAWN_USEVFORK = 0x40
+
+# The opaque types are allocated generously, since we can't ask the C compiler
+# how big they are.  (On x86-64, posix_spawn_file_actions_t takes 80 bytes,
+# posix_spawnattr_t takes 336 bytes, and sigset_t takes 128 bytes.)
+OPAQUE_SIZE = 1024
+
+available = False
+try:
+    import ctypes, ctypes.util
+    if sys.platform.startswith('linux') and platform.libc_ver()[0] == 'glibc':
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _posix_spawnp = _libc.posix_spawnp
+        _environ = ctypes.POINTER(ctypes.c_char_p).in_dll(_libc, 'environ')
+        available = True
+except (ImportError, OSError, AttributeError, ValueError):
+    pass
+
+
+def _check(result, what):
+    if result != 0:
+        raise OSError(result, '%s: %s' % (what, os.strerror(result)))
+
+
+class PosixSpawn:
+    """A reusable recipe for starting child processes with posix_spawnp().
+
+    The "dup2s" argument is a list of (fd, newfd) pairs: each "fd" is duplicated
+    onto "newfd" in the child.  The "default_signals" argument is a list of
+    signal numbers whose handling is reset to the default in the child (this is
+    needed for signals that are ignored in the parent, since exec() leaves them
+    ignored).  The child also starts with an empty signal mask.
+
+    The file actions and attributes are built once, when the object is created,
+    and are reused by every call to spawn().
+    """
+    def __init__(self, dup2s, default_signals=()):
+        if not available:
+            raise OSError(errno.ENOSYS, 'posix_spawn() is not available')
+        self.file_actions = ctypes.create_string_buffer(OPAQUE_SIZE)
+        self.attr = ctypes.create_string_buffer(OPAQUE_SIZE)
+        _check(_libc.posix_spawn_file_actions_init(self.file_actions),
+               'posix_spawn_file_actions_init')
+        _check(_libc.posix_spawnattr_init(self.attr), 'posix_spawnattr_init')
+        for fd, newfd in dup2s:
+            _check(_libc.posix_spawn_file_actions_adddup2(self.file_actions,
+                                                          fd, newfd),
+                   'posix_spawn_file_actions_adddup2')
+        sigdefault = ctypes.create_string_buffer(OPAQUE_SIZE)
+        _libc.sigemptyset(sigdefault)
+        for signum in default_signals:
+            _libc.sigaddset(sigdefault, signum)
+        _check(_libc.posix_spawnattr_setsigdefault(self.attr, sigdefault),
+               'posix_spawnattr_setsigdefault')
+        sigmask = ctypes.create_string_buffer(OPAQUE_SIZE)
+        _libc.sigemptyset(sigmask)
+        _check(_libc.posix_spawnattr_setsigmask(self.attr, sigmask),
+               'posix_spawnattr_setsigmask')
+        flags = POSIX_SPAWN_SETSIGDEF | POSIX_SPAWN_SETSIGMASK | \
+                POSIX_SPAWN_USEVFORK
+        _check(_libc.posix_spawnattr_setflags(self.attr, ctypes.c_short(flags)),
+               'posix_spawnattr_setflags')
+
+    def spawn(self, argv):
+        """Starts a program with the given argument vector (searching the PATH
+        for it) in the current environment, and returns the child's PID.
+
+        Raises OSError if the program can't be started.
+        """
+        c_argv = (ctypes.c_char_p * (len(argv) + 1))()
+        c_argv[:len(argv)] = argv
+        c_argv[len(argv)] = None
+        pid = ctypes.c_int()
+        result = _posix_spawnp(ctypes.byref(pid), argv[0], self.file_actions,
+                               self.attr, c_argv, _environ)
+        if result != 0:
+            raise OSError(result, os.strerror(result), argv[0])
+        return pid.value
+
+    def __del__(self):
+        if available:
+            _libc.posix_spawn_file_actions_destroy(self.file_actions)
+            _libc.posix_spawnattr_destroy(self.attr)
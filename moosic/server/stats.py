@@ -0,0 +1,399 @@
+# moosic/server/stats.py - runtime statistics for moosicd
+#
+# This is free and unencumbered software released into the public domain.
+# 
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+# 
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# 
+# For more information, please refer to <http://unlicense.org/>
+
+
+"""Keeps count of what moosicd is doing, and of how long it takes.
+
+Everything is gathered into the "stats" object defined here, which is always
+turned on.  Recording an event costs no more than a lock, a dictionary lookup,
+and some arithmetic, and the memory used doesn't grow with the number of events,
+since durations are only kept as histograms with a fixed number of buckets.
+
+This module doesn't import any other part of moosicd, so that any part of
+moosicd can import it.
+"""
+
+import time, math, re, string, threading
+
+# Define the True and False constants if they don't already exist.
+try: True
+except NameError: True = 1
+try: False
+except NameError: False = 0
+
+__all__ = ('Histogram', 'Stats', 'TimedLock', 'stats')
+
+# The number of buckets in each Histogram.  Bucket number i counts the durations
+# that are shorter than 2**i microseconds, but not shorter than 2**(i-1)
+# microseconds, so the last bucket covers durations of half an hour and more.
+BUCKETS = 32
+
+# The largest number that can be sent through XML-RPC as an int.
+MAXINT = 2**31 - 1
+
+
+def _number(n):
+    '''Returns a number in a form that can be sent through XML-RPC.'''
+    if n > MAXINT:
+        return float(n)
+    return n
+
+
+def _metric_name(name):
+    '''Turns a name like "data lock wait" into "data_lock_wait".'''
+    return re.sub('[^a-zA-Z0-9_]', '_', name)
+
+
+def _escape(value):
+    '''Escapes a string for use as the value of a label in a metric.'''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sorted_items(dict):
+    items = dict.items()
+    items.sort()
+    return items
+
+
+def _format(value):
+    '''Formats the value of a metric.'''
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Histogram:
+    """A summary of a set of durations, measured in seconds.
+
+    Only the number of durations, their total, their maximum, and the number of
+    durations in each of a fixed set of power-of-two buckets are kept, so
+    record() always takes the same small amount of time and memory.
+    """
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def record(self, seconds, failed=False):
+        self.count = self.count + 1
+        if failed:
+            self.errors = self.errors + 1
+        self.total = self.total + seconds
+        if seconds > self.max:
+            self.max = seconds
+        i = math.frexp(seconds * 1000000)[1]
+        if i < 0:
+            i = 0
+        elif i >= BUCKETS:
+            i = BUCKETS - 1
+        self.buckets[i] = self.buckets[i] + 1
+
+    def percentile(self, fraction):
+        """Returns an upper bound for the given fraction (between 0 and 1) of
+        the recorded durations.
+        """
+        wanted = self.count * fraction
+        seen = 0
+        for i in range(BUCKETS):
+            seen = seen + self.buckets[i]
+            if seen >= wanted and seen > 0:
+                return min(2.0**i / 1000000, self.max)
+        return self.max
+
+    def snapshot(self):
+        """Returns the contents of the histogram as a dictionary that can be
+        sent through XML-RPC.
+
+        Bucket upper bounds are given in seconds, and empty buckets are left out.
+        """
+        if self.count:
+            mean = self.total / self.count
+        else:
+            mean = 0.0
+        buckets = []
+        for i in range(BUCKETS):
+            if self.buckets[i]:
+                buckets.append([2.0**i / 1000000, _number(self.buckets[i])])
+        return {'count': _number(self.count),
+                'errors': _number(self.errors),
+                'total': self.total,
+                'mean': mean,
+                'max': self.max,
+                'p50': self.percentile(0.50),
+                'p90': self.percentile(0.90),
+                'p99': self.percentile(0.99),
+                'buckets': buckets}
+
+
+class Stats:
+    """A collection of counters and histograms.
+
+    Each counter and histogram is named by a string, and is created the first
+    time something is recorded under its name.  The durations of calls to the
+    server's methods are kept apart from the other histograms, and so is the
+    traffic through each kind of socket (the "transport").
+
+    All of the methods are safe to call from any thread.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.timers = {}
+        self.methods = {}
+        self.transports = {}
+        # Functions that add more information to each snapshot.
+        self.sources = []
+
+    def add_source(self, source):
+        """Adds a function that is called with each snapshot (a dictionary) as
+        its argument, so that it can add information that isn't recorded here,
+        such as the length of the song queue.
+        """
+        self.sources.append(source)
+
+    def count(self, name, n=1):
+        """Adds n to the named counter."""
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + n
+        finally:
+            self.lock.release()
+
+    def record(self, name, seconds):
+        """Adds a duration to the named histogram."""
+        self.lock.acquire()
+        try:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = Histogram()
+            timer.record(seconds)
+        finally:
+            self.lock.release()
+
+    def method_called(self, name, seconds, failed):
+        """Records a call to one of the server's methods.
+
+        This is meant to be used as the observer of an xmlrpc_registry.Registry.
+        Calls to methods that don't exist are all counted under the name
+        "(unknown)", so that clients can't make this object grow without limit.
+        """
+        if name is None:
+            name = '(unknown)'
+        self.lock.acquire()
+        try:
+            timer = self.methods.get(name)
+            if timer is None:
+                timer = self.methods[name] = Histogram()
+            timer.record(seconds, failed)
+        finally:
+            self.lock.release()
+
+    def transferred(self, transport, bytes_in, bytes_out):
+        """Records a request of bytes_in bytes, answered with bytes_out bytes,
+        that arrived through the given transport (e.g. 'unix' or 'tcp').
+        """
+        self.lock.acquire()
+        try:
+            counts = self.transports.get(transport)
+            if counts is None:
+                counts = self.transports[transport] = [0, 0, 0]
+            counts[0] = counts[0] + 1
+            counts[1] = counts[1] + bytes_in
+            counts[2] = counts[2] + bytes_out
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """Returns everything that has been recorded so far, as a dictionary
+        that can be sent through XML-RPC.
+        """
+        self.lock.acquire()
+        try:
+            counters = {}
+            for name, value in self.counters.items():
+                counters[name] = _number(value)
+            timers = {}
+            for name, timer in self.timers.items():
+                timers[name] = timer.snapshot()
+            methods = {}
+            for name, timer in self.methods.items():
+                methods[name] = timer.snapshot()
+            transports = {}
+            for name, (requests, bytes_in, bytes_out) in self.transports.items():
+                transports[name] = {'requests': _number(requests),
+                                    'bytes in': _number(bytes_in),
+                                    'bytes out': _number(bytes_out)}
+        finally:
+            self.lock.release()
+        result = {'uptime': time.time() - self.started,
+                  'counters': counters,
+                  'timers': timers,
+                  'methods': methods,
+                  'transports': transports}
+        for source in self.sources:
+            source(result)
+        return result
+
+    def exposition(self):
+        """Returns a snapshot in the text format that is read by Prometheus
+        and similar monitoring systems.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        def metric(name, kind, help, samples, lines=lines):
+            name = 'moosicd_' + name
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                lines.append('%s%s%s %s' % (name, suffix, labels,
+                                               _format(value)))
+        def histograms(name, help, timers, label=None):
+            samples = []
+            names = timers.keys()
+            names.sort()
+            for key in names:
+                timer = timers[key]
+                if label:
+                    labels = '%s="%s",' % (label, _escape(key))
+                else:
+                    labels = ''
+                counts = {}
+                for bound, n in timer['buckets']:
+                    counts[bound] = n
+                seen = 0
+                for i in range(BUCKETS - 1):
+                    bound = 2.0**i / 1000000
+                    seen = seen + counts.get(bound, 0)
+                    samples.append(('_bucket', '{%sle="%s"}' % (labels,
+                                    repr(bound)), seen))
+                samples.append(('_bucket', '{%sle="+Inf"}' % labels,
+                                timer['count']))
+                labels = labels and '{' + labels[:-1] + '}'
+                samples.append(('_sum', labels, timer['total']))
+                samples.append(('_count', labels, timer['count']))
+            metric(name, 'histogram', help, samples)
+
+        metric('uptime_seconds', 'gauge',
+               'Seconds since moosicd started.',
+               [('', '', snapshot['uptime'])])
+        histograms('method_duration_seconds',
+                   'Time taken by calls to each server method.',
+                   snapshot['methods'], 'method')
+        samples = []
+        for key, timer in _sorted_items(snapshot['methods']):
+            samples.append(('', '{method="%s"}' % _escape(key),
+                            timer['errors']))
+        metric('method_errors_total', 'counter',
+               'Calls to each server method that failed.', samples)
+        for key, timer in _sorted_items(snapshot['timers']):
+            histograms(_metric_name(key) + '_seconds',
+                       'Durations of "%s".' % key, {key: timer})
+        for key, value in _sorted_items(snapshot['counters']):
+            metric(_metric_name(key) + '_total', 'counter',
+                   'Count of "%s".' % key, [('', '', value)])
+        for key, help in (('requests', 'Requests received'),
+                          ('bytes in', 'Bytes of requests received'),
+                          ('bytes out', 'Bytes of responses sent')):
+            samples = []
+            for transport, counts in _sorted_items(snapshot['transports']):
+                samples.append(('', '{transport="%s"}' % transport,
+                                counts[key]))
+            metric(_metric_name(key) + '_total', 'counter',
+                   help + ' through each kind of socket.', samples)
+        if snapshot.has_key('queue'):
+            queue = snapshot['queue']
+            metric('queue_length', 'gauge', 'Items in the song queue.',
+                   [('', '', queue['length'])])
+            metric('queue_memory_bytes', 'gauge',
+                   'Rough estimate of the memory used by the song queue.',
+                   [('', '', queue['memory'])])
+            metric('history_length', 'gauge', 'Items in the history list.',
+                   [('', '', queue['history length'])])
+        if snapshot.has_key('song gap'):
+            metric('last_song_gap_seconds', 'gauge',
+                   'The most recent gap between two songs.',
+                   [('', '', snapshot['song gap'])])
+        if snapshot.has_key('process'):
+            process = snapshot['process']
+            metric('threads', 'gauge', 'Threads in moosicd.',
+                   [('', '', process['threads'])])
+            if process.has_key('max rss'):
+                metric('max_rss_bytes', 'gauge',
+                       'Peak resident memory of moosicd.',
+                       [('', '', process['max rss'] * 1024)])
+        return string.join(lines, '\n') + '\n'
+
+
+class TimedLock:
+    """A reentrant lock that records how long threads wait for it, and how
+    long they hold it.
+
+    It can be used in place of a threading.RLock.  The waits and holds are
+    recorded in the histograms named name + " wait" and name + " hold".  Only
+    the outermost acquire() and release() of a thread are timed, so nested
+    acquisitions don't count as separate holds.
+    """
+    def __init__(self, name):
+        self.lock = threading.RLock()
+        self.wait_name = name + ' wait'
+        self.hold_name = name + ' hold'
+        # The nesting depth of the thread that holds the lock, and the time at
+        # which it acquired the lock.  These are only touched by the thread
+        # that holds the lock.
+        self.depth = 0
+        self.acquired = 0.0
+
+    def acquire(self, blocking=1):
+        start = time.time()
+        if not self.lock.acquire(blocking):
+            return False
+        if self.depth == 0:
+            self.acquired = time.time()
+            stats.record(self.wait_name, self.acquired - start)
+        self.depth = self.depth + 1
+        return True
+
+    def release(self):
+        self.depth = self.depth - 1
+        if self.depth == 0:
+            held = time.time() - self.acquired
+            self.lock.release()
+            stats.record(self.hold_name, held)
+        else:
+            self.lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+# This is the object that all of moosicd records its statistics in.
+stats = Stats()
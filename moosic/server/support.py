@@ -26,7 +26,9 @@
 # For more information, please refer to <http://unlicense.org/>
 
 import sys, os, os.path, string, threading, time, socket, traceback, errno
+import select, fcntl, Queue
 import SocketServer, SimpleXMLRPCServer
+from moosic.server.stats import stats, TimedLock
 
 # Define the True and False constants if they don't already exist.
 try: True
@@ -36,7 +38,65 @@ except NameError: False = 0
 
 __all__ = ('data', 'readConfig', 'strConfig', 'getConfigFile', 'split_range',
            'Log', 'UnixMoosicRequestHandler', 'TcpMoosicRequestHandler',
-           'UnixMoosicServer', 'TcpMoosicServer')
+           'UnixMoosicServer', 'TcpMoosicServer', 'WakeupPipe', 'RotatingFile',
+           'AsyncLog', 'ExceptionReport', 'notify_service_manager')
+
+class WakeupPipe:
+    """A means for one thread to sleep until another thread has news for it.
+
+    Any thread may call notify(), which causes the next call to wait() to return
+    immediately (or causes a call to wait() that is already in progress to
+    return).  Notifications don't accumulate: many calls to notify() before a
+    single call to wait() only wake up the waiting thread once.
+
+    This is used instead of threading.Condition because the thread that waits on
+    it is the program's main thread, which is where signal handlers are run.
+    Waiting on a pipe can be interrupted by a signal, while waiting on a
+    threading.Condition without a timeout cannot, and waiting on a
+    threading.Condition with a timeout is implemented by polling.
+    """
+    def __init__(self):
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            # Don't let the pipe leak into child processes, and never let
+            # notify() or the draining done by wait() block.
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def notify(self):
+        """Wakes up the thread that is waiting on this object."""
+        try:
+            os.write(self.wfd, 'x')
+        except OSError, e:
+            # If the pipe is full, then a wakeup is already pending.
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def wait(self, timeout=None):
+        """Blocks until notify() is called or until "timeout" seconds elapse.
+
+        If "timeout" is None, then there is no time limit.  A signal that
+        arrives while waiting also ends the wait (after its handler runs).
+        Returns True if a notification was received, otherwise False.
+        """
+        try:
+            readable = select.select([self.rfd], [], [], timeout)[0]
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                return False
+            raise
+        if not readable:
+            return False
+        try:
+            while os.read(self.rfd, 512):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return True
+
 
 class DataStore:
     """A convenient place to store the data maintained by the Moosic server.
@@ -76,22 +136,55 @@ class DataStore:
         self.current_song = ''
 
         # 'player_pid' is the process ID of the process that is playing the
-        # current song.
+        # current song.  It is only cleared (by the SpawnBackend in the
+        # moosic.server.player module) once that process has been reaped, and
+        # it should only be sent signals while 'lock' is held.
         self.player_pid = None
 
+        # 'player' is the backend (from the moosic.server.player module) that is
+        # playing the current song, or None if nothing is playing.  Its pause(),
+        # unpause(), and stop() methods should only be called while 'lock' is
+        # held.
+        self.player = None
+
+        # 'last_player_exit' describes how the most recent song player exited.
+        # It is a (song, exit status, resource usage) triple, or None if the
+        # current player hasn't exited yet.
+        self.last_player_exit = None
+
+        # 'song_gap' is the number of seconds that passed between the end of the
+        # most recent song and the start of the song after it, or None if this
+        # hasn't been measured yet.
+        self.song_gap = None
+
         # 'paused' is a flag that keeps track of whether the song player has
         # been paused.
         self.paused = False
 
         # 'lock' is used to synchronize write-access to the other global
-        # variables.
-        self.lock = threading.RLock()
+        # variables.  It is a reentrant lock that keeps track of how long it is
+        # waited for and held (see the moosic.server.stats module).
+        self.lock = TimedLock('data lock')
 
         # 'quitFlag' is used to let the different parts of moosicd tell each
         # other that it is time to shut down.  When the queue consumer sees that
         # this flag is true, it will terminate itself.
         self.quitFlag = False
 
+        # 'queue_wakeup' is used to wake up the queue consumer when it is idle.
+        # Anything that might allow the queue consumer to start playing a song
+        # (e.g. adding items to the song queue, or setting 'qrunning' or
+        # 'quitFlag') should be followed by a call to queue_wakeup.notify().
+        # (Methods that modify the song queue do this by calling
+        # notify_queue_change() in the moosic.server.methods module.)
+        # It is also notified whenever a song player exits.
+        self.queue_wakeup = WakeupPipe()
+
+        # 'queue_changed' is used to wake up the prefetcher (see the
+        # moosic.server.prefetch module) whenever the contents of the song
+        # queue change.
+        self.queue_changed = WakeupPipe()
+
         # 'config' is a list of associations between filename patterns and
         # player programs.
         self.config = []
@@ -148,11 +241,11 @@ class DataStore:
         # socket.
         self.extra_moosic_server = None
 
-        # 'music_root' is the name of the directory in which the file listing
-        # API functions are permitted.  If this is the empty string, then file
-        # listing will not be permitted at all.
-        self.music_root = os.path.realpath('/data/music') # DEBUG
-        #self.music_root = None
+        # 'music_root' is the name of the directory that is kept in memory by
+        # the music library (see the moosic.server.library module), within
+        # which the library methods are permitted.  If this is the empty
+        # string, then the library methods will not be permitted at all.
+        self.music_root = ''
 
         del self.doing_init
 
@@ -297,8 +390,8 @@ sox $item -t ossdsp /dev/dsp
 (?i)\.ogg$
 ogg123 -q
  
-(?i)\.m3u$
-moosic -o pl-add
+(?i)\.(m3u8?|pls)$
+@playlist
  
 (?i)^cda://(\S+)
 takcd \1''' % conffile)
@@ -325,6 +418,72 @@ def split_range(range):
     return start, end
 
 
+class RotatingFile:
+    """A file for logging that doesn't grow without limit.
+
+    Text is appended to the file named "filename" by calling write().  When the
+    file grows to "max_bytes" bytes or larger, it is renamed by adding ".1" to
+    its name, older copies are renamed from ".1" to ".2" and so on, the copy
+    that would be numbered higher than "backups" is removed, and a new file is
+    started.  If "max_bytes" is 0, then the file is never rotated.
+
+    It is safe to call write() from several threads at once.
+    """
+    def __init__(self, filename, max_bytes=1024*1024, backups=3):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = None
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def open(self):
+        self.file = open(self.filename, 'a')
+        fd = self.file.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFD,
+                    fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.file.seek(0, 2)
+        self.size = self.file.tell()
+
+    def write(self, text):
+        """Appends text to the file, and flushes it."""
+        self.lock.acquire()
+        try:
+            if self.file is None:
+                self.open()
+            self.file.write(text)
+            self.file.flush()
+            self.size = self.size + len(text)
+            if self.max_bytes and self.size >= self.max_bytes:
+                self.rotate()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        pass
+
+    def rotate(self):
+        self.file.close()
+        self.file = None
+        for i in range(self.backups - 1, 0, -1):
+            older = '%s.%d' % (self.filename, i)
+            if os.path.exists(older):
+                os.rename(older, '%s.%d' % (self.filename, i + 1))
+        if self.backups > 0:
+            os.rename(self.filename, self.filename + '.1')
+        else:
+            os.remove(self.filename)
+        self.open()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        finally:
+            self.lock.release()
+
 
 class Log:
     """A very simple logging facility.
@@ -346,7 +505,7 @@ class Log:
         DEBUG:"DEBUG", NOTICE:"NOTICE", WARNING:"WARNING", ERROR:"ERROR"
     }
 
-    def __init__(self, file, loglevel=WARNING):
+    def __init__(self, file, loglevel=WARNING, json=False):
         """Creates a Log object.
         
         "file" is the file-like object to which log messages will be written.
@@ -355,11 +514,16 @@ class Log:
         logged. Messages with a priority lower than this will be ignored.  One
         of the constants defined in this class (i.e. DEBUG, NOTICE, WARNING, or
         ERROR) should be used as the value of this parameter.
+
+        If "json" is true, then each message is written as a JSON object on a
+        line of its own (with "time", "level", and "message" members), which is
+        easier for other programs to read.
         """
         if not hasattr(file, 'write') or not callable(file.write):
             raise TypeError("argument 1: expected a file object")
         self.logfile = file
         self.loglevel = loglevel
+        self.json = json
 
     def __call__(self, priority, message):
         """Sends a message to be logged by the Log object.
@@ -370,21 +534,202 @@ class Log:
         lower than the threshold associated with the Log object, then the
         message will not be logged.
         
-        "message" is a string that contains the text of the message.
+        "message" is a string that contains the text of the message.  (It may
+        also be any object that can be converted into a string, in which case
+        the conversion is put off until the message is actually written.)
         
         The return value is the object passed as the "message" parameter.
         """
-        orig_message = message
         if priority <= self.loglevel:
-            # Portability note: Unix-style newlines are assumed.
-            message = string.replace(message, "\n", "\n\t")
-            now = time.strftime('%I:%M:%S%p', time.localtime(time.time()))
-            message = "%s [%s] %s\n" % (now, self.priorityNames[priority], message)
-            self.logfile.write(message)
-        return orig_message
+            self.logfile.write(self.format(time.time(), priority, message))
+        return message
+
+    def format(self, when, priority, message):
+        """Returns the line of text that records a message in the log."""
+        message = str(message)
+        if self.json:
+            import json
+            return json.dumps({'time': when,
+                               'level': self.priorityNames[priority],
+                               'message': message}) + "\n"
+        # Portability note: Unix-style newlines are assumed.
+        message = string.replace(message, "\n", "\n\t")
+        now = time.strftime('%I:%M:%S%p', time.localtime(when))
+        return "%s [%s] %s\n" % (now, self.priorityNames[priority], message)
+
+    def flush(self):
+        """Makes sure that every message logged so far has been written."""
+        self.logfile.flush()
+
+    def close(self):
+        """Writes out any pending messages.  Messages that are logged after
+        this are still written, but perhaps less efficiently.
+        """
+        self.flush()
+
+
+class AsyncLog(Log):
+    """A logging facility that does its writing in a separate thread.
+
+    Calling an AsyncLog only puts the message in a queue, without formatting
+    it or doing any I/O, so that the threads that log messages never wait for
+    the log file.  A writer thread takes messages from the queue, and writes
+    them in batches, flushing the log file once per batch.
 
+    The queue holds at most "max_queue" messages.  If it is full, new messages
+    are dropped instead of making the caller wait.  The number of dropped
+    messages of each priority is counted, and a summary is written to the log
+    once the writer thread catches up.
 
-class UnixMoosicRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    The writer thread is started when the first message is logged.  If the
+    process forks (e.g. to become a daemon), a new queue and writer thread are
+    started in the child, since fork() doesn't carry threads along.  Call
+    flush() before forking, so that no messages are left behind in the parent's
+    queue.
+    """
+    def __init__(self, file, loglevel=Log.WARNING, json=False, max_queue=10000,
+                 max_batch=500):
+        Log.__init__(self, file, loglevel, json)
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.pid = None
+        self.queue = None
+        self.thread = None
+        self.closed = False
+        self.dropped = {}
+        self.dropped_lock = threading.Lock()
+
+    def start(self):
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(self.max_queue)
+        self.dropped = {}
+        self.dropped_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def __call__(self, priority, message):
+        if priority > self.loglevel:
+            return message
+        if self.closed:
+            return Log.__call__(self, priority, message)
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait((time.time(), priority, message))
+        except Queue.Full:
+            stats.count('log messages dropped')
+            self.dropped_lock.acquire()
+            try:
+                self.dropped[priority] = self.dropped.get(priority, 0) + 1
+            finally:
+                self.dropped_lock.release()
+        return message
+
+    def run(self):
+        queue = self.queue
+        while True:
+            batch = [queue.get()]
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+            self.write_batch(batch)
+            for record in batch:
+                queue.task_done()
+            if None in batch:
+                return
+
+    def write_batch(self, batch):
+        lines = []
+        for record in batch:
+            if record is not None:
+                try:
+                    lines.append(self.format(*record))
+                except Exception, e:
+                    lines.append(self.format(record[0], Log.ERROR,
+                                 'Cannot log a message: %s' % e))
+        self.dropped_lock.acquire()
+        try:
+            dropped, self.dropped = self.dropped, {}
+        finally:
+            self.dropped_lock.release()
+        if dropped:
+            counts = []
+            for priority in (Log.ERROR, Log.WARNING, Log.NOTICE, Log.DEBUG):
+                if dropped.has_key(priority):
+                    counts.append('%d %s' % (dropped[priority],
+                                             self.priorityNames[priority]))
+            lines.append(self.format(time.time(), Log.WARNING,
+                '%d messages were dropped because the log was overloaded '
+                '(%s).' % (reduce(lambda a, b: a+b, dropped.values()),
+                           string.join(counts, ', '))))
+        if lines:
+            try:
+                self.logfile.write(string.join(lines, ''))
+                self.logfile.flush()
+            except (IOError, OSError):
+                pass
+
+    def flush(self):
+        if self.queue is not None and self.pid == os.getpid() and \
+           self.thread.isAlive():
+            self.queue.join()
+        else:
+            Log.flush(self)
+
+    def close(self):
+        """Writes out every queued message, and stops the writer thread."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.queue is not None and self.pid == os.getpid():
+            self.queue.put(None)
+            self.thread.join(5.0)
+        Log.flush(self)
+
+
+class ExceptionReport:
+    """A description of an exception, which is only formatted when it's turned
+    into a string.
+
+    This lets an exception be logged without formatting its traceback in the
+    thread where the exception happened (see the AsyncLog class).
+    """
+    def __init__(self, heading, exc_info):
+        self.heading = heading
+        self.exc_info = exc_info
+
+    def __str__(self):
+        return '-'*40 + '\n' + self.heading + '\n' + \
+               ''.join(traceback.format_exception(*self.exc_info)) + '-'*40
+
+
+# The path at which the server's statistics can be fetched with an HTTP GET
+# request, and the content type of the response.
+METRICS_PATH = '/metrics'
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class MoosicRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    """A SimpleXMLRPCRequestHandler that also answers GET requests for
+    METRICS_PATH with the statistics kept in moosic.server.stats, in the text
+    format that is read by Prometheus.
+    """
+    def do_GET(self):
+        if self.path != METRICS_PATH:
+            self.report_404()
+            return
+        response = stats.exposition()
+        self.send_response(200)
+        self.send_header('Content-type', METRICS_CONTENT_TYPE)
+        self.send_header('Content-length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+class UnixMoosicRequestHandler(MoosicRequestHandler):
     """An adaptation of SimpleXMLRPCRequestHandler for use with Unix sockets.
     """
     # The Nagle algorithm issue doesn't apply to non-TCP sockets.
@@ -402,14 +747,30 @@ class UnixMoosicRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
         return self.client_address
 
 
-class TcpMoosicRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+class TcpMoosicRequestHandler(MoosicRequestHandler):
     """An adaptation of SimpleXMLRPCRequestHandler for use with TCP sockets.
     """
     # Actually, no adaptation needs to be done.
     pass
 
 
-class UnixMoosicServer(SocketServer.UnixStreamServer,
+class CountingMixIn:
+    """Counts the requests handled by a server, and the bytes that they carry.
+
+    The counts are kept in moosic.server.stats, under the name given by the
+    "transport" attribute.  Only the XML-RPC payloads are counted, not the HTTP
+    headers around them.
+    """
+    transport = 'unix'
+
+    def _marshaled_dispatch(self, request, *args):
+        response = SimpleXMLRPCServer.SimpleXMLRPCDispatcher._marshaled_dispatch(
+                self, request, *args)
+        stats.transferred(self.transport, len(request), len(response))
+        return response
+
+
+class UnixMoosicServer(CountingMixIn, SocketServer.UnixStreamServer,
                        SimpleXMLRPCServer.SimpleXMLRPCServer):
     """A server that responds to Moosic requests via a Unix (local) socket.
     """
@@ -426,9 +787,11 @@ class UnixMoosicServer(SocketServer.UnixStreamServer,
         log_exception(request, client_address)
 
 
-class TcpMoosicServer(SimpleXMLRPCServer.SimpleXMLRPCServer):
+class TcpMoosicServer(CountingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer):
     """A server that responds to Moosic requests via TCP/IP.
     """
+    transport = 'tcp'
+
     def __init__(self, addr, logRequests=False):
         SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(self, addr,
                 requestHandler=TcpMoosicRequestHandler,
@@ -439,7 +802,7 @@ class TcpMoosicServer(SimpleXMLRPCServer.SimpleXMLRPCServer):
         log_exception(request, client_address)
 
 
-class ThreadedUnixMoosicServer(SocketServer.ThreadingMixIn,
+class ThreadedUnixMoosicServer(CountingMixIn, SocketServer.ThreadingMixIn,
                        SocketServer.UnixStreamServer,
                        SimpleXMLRPCServer.SimpleXMLRPCServer):
     """A server that responds to Moosic requests via a Unix (local) socket.
@@ -476,10 +839,12 @@ class ThreadedUnixMoosicServer(SocketServer.ThreadingMixIn,
         log_exception(request, client_address)
 
 
-class ThreadedTcpMoosicServer(SocketServer.ThreadingMixIn,
+class ThreadedTcpMoosicServer(CountingMixIn, SocketServer.ThreadingMixIn,
                       SimpleXMLRPCServer.SimpleXMLRPCServer):
     """A server that responds to Moosic requests via TCP/IP.
     """
+    transport = 'tcp'
+
     def __init__(self, addr, logRequests=False):
         SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(self, addr,
                 requestHandler=TcpMoosicRequestHandler,
@@ -515,10 +880,32 @@ def log_exception(request, client_address):
     # Ignore "broken pipe" errors.
     if isinstance(exception, IOError) and exception[0] == errno.EPIPE:
         return
-    data.log(Log.ERROR,
-        '-'*40 + '\n' + \
+    data.log(Log.ERROR, ExceptionReport(
         'Exception happened during processing of request from ' + \
-        str(client_address) + '\n' + \
-        ''.join(traceback.format_exception(*sys.exc_info())) + \
-        '-'*40
-    )
+        str(client_address), sys.exc_info()))
+
+
+def notify_service_manager(state):
+    """Sends a status message (e.g. "READY=1") to whatever started moosicd.
+
+    This speaks the protocol of sd_notify(3): the message is sent as a datagram
+    to the Unix socket named by the NOTIFY_SOCKET environment variable (where
+    a leading "@" stands for Linux's abstract namespace).  Nothing is done if
+    this variable isn't set.  The variable is removed afterwards, so that song
+    players don't inherit it.
+    """
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return
+    del os.environ['NOTIFY_SOCKET']
+    if address[0] == '@':
+        address = '\0' + address[1:]
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        try:
+            s.sendto(state, address)
+        except socket.error, e:
+            data.log(Log.WARNING, 'Cannot send "%s" to the notification '
+                     'socket "%s": %s' % (state, address, e))
+    finally:
+        s.close()
@@ -25,7 +25,7 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 
-import sys
+import sys, time
 import xmlrpclib
 
 # Some type names for use in method signatures.
@@ -62,6 +62,8 @@ class Registry:
         self._signatures = {}
         self._help = {}
         self._default_method = None
+        self._observer = None
+        self._profiler = None
         self._install_system_methods()
 
     def _install_system_methods (self):
@@ -107,9 +109,42 @@ class Registry:
         """Set a default method to handle otherwise unsupported requests."""
         self._default_method = method
 
+    def set_observer (self, observer):
+        """Set a function to be told about every call that is dispatched.
+
+        The observer is called with three arguments after each call: the name
+        of the method (or None if no such method is registered), the number of
+        seconds that the call took, and a flag that is true if the call failed.
+        """
+        self._observer = observer
+
+    def set_profiler (self, profiler):
+        """Set an object that may take over calls in order to profile them.
+
+        Before each call, the profiler's wants() method is called with the name
+        of the method.  If it returns true, the call is made by calling the
+        profiler's call() method with the name, the method, and the parameters,
+        instead of calling the method directly.
+        """
+        self._profiler = profiler
+
     def dispatch_call (self, name, params):
         """Dispatch an XML-RPC request, and return the result."""
 
+        if self._observer is None:
+            return self._dispatch_call(name, params)
+        start = time.time()
+        failed = 1
+        try:
+            result = self._dispatch_call(name, params)
+            failed = 0
+            return result
+        finally:
+            if not self._methods.has_key(name):
+                name = None
+            self._observer(name, time.time() - start, failed)
+
+    def _dispatch_call (self, name, params):
         try:
             # Try to find our method.
             if self._methods.has_key(name):
@@ -120,6 +155,9 @@ class Registry:
                 return self._no_such_method(name)
 
             # Call our method and return the result.
+            profiler = self._profiler
+            if profiler is not None and profiler.wants(name):
+                return profiler.call(name, method, params)
             return apply(method, params)
        #except:                     # DEBUG
        #    import traceback        #
@@ -38,7 +38,7 @@ from __future__ import generators
 import re, random, string, operator, os, os.path
 
 
-__all__ = ('grep', 'antigrep', 'staggered_merge', 'parse_range', 'wrap',
+__all__ = ('grep', 'grep_each', 'antigrep', 'staggered_merge', 'parse_range', 'wrap',
            'xmlrpc_server_doc', 'center_text', 'uniq', 'sh_escape', 'flatten',
            'canLoopOver', 'isStringLike', 'isScalar', 'make_string_filter')
 
@@ -176,6 +176,80 @@ def grep(regex, seq):
     return [i for i in seq if search(i)]
 
 
+# grep_each() only hands its work to other processes when the number of
+# regular expressions multiplied by the number of elements is at least this
+# large (about a third of a second of matching), since starting the processes and
+# sending back their results takes a good part of that.
+PARALLEL_GREP_MIN = 500000
+
+# The sequence that is being searched by grep_each(), which the processes that
+# it starts inherit instead of receiving it through a pipe.
+_grep_seq = None
+
+def _grep_list(regexes, seq):
+    """Returns a list of the result of grepping a list for each of a list of
+    regular expressions.
+    """
+    return [filter(re.compile(regex).search, seq) for regex in regexes]
+
+
+def _grep_chunk(args):
+    """Greps a slice of _grep_seq for each of a list of regular expressions.
+    This is run by the processes started by grep_each().
+    """
+    regexes, start, end = args
+    return _grep_list(regexes, _grep_seq[start:end])
+
+
+def grep_each(regexes, seq, processes=None):
+    """Returns a list that holds, for each of the given regular expressions
+    (which may be strings or regular expression objects), a list of the
+    elements of the list "seq" that match it, in their original order.
+
+    When there is enough work to make it worthwhile, the list is split into
+    chunks that are matched against all of the regular expressions in
+    "processes" separate processes (by default, one for each CPU), and the
+    results are put back together in order.  Otherwise, or if the processes
+    can't be started, all the matching is done in this process.
+    """
+    if processes is None:
+        processes = 1
+        if len(regexes) * len(seq) >= PARALLEL_GREP_MIN:
+            try:
+                import multiprocessing
+                processes = multiprocessing.cpu_count()
+            except (ImportError, NotImplementedError):
+                pass
+    if processes <= 1 or not seq:
+        return _grep_list(regexes, seq)
+    global _grep_seq
+    import multiprocessing
+    # Give each process a few chunks, so that a process that gets an easy chunk
+    # doesn't sit idle while the others finish.
+    size = -(-len(seq) // (processes * 4))
+    chunks = [(regexes, start, start + size)
+              for start in range(0, len(seq), size)]
+    _grep_seq = seq
+    try:
+        try:
+            pool = multiprocessing.Pool(processes)
+        except OSError:
+            return _grep_list(regexes, seq)
+        try:
+            results = pool.map(_grep_chunk, chunks, 1)
+        finally:
+            pool.terminate()
+    finally:
+        _grep_seq = None
+    output = []
+    for i in range(len(regexes)):
+        matches = []
+        for result in results:
+            matches.extend(result[i])
+        output.append(matches)
+    return output
+
+
 def antigrep(regex, seq):
     """Returns a list of the elements of "seq" that do not match the regular
     expression represented by "regex", which may be a string or a regular